@@ -17,6 +17,79 @@ if sys.version_info.major != 2 or sys.version_info.minor < 7:
         sys.version_info.minor, sys.version_info.micro))
     sys.exit(1)
 
+# The query server's socket, relative to the root of the build tree. This
+# must agree with muddled/query_server.py
+QUERY_SERVER_SOCKET = os.path.join('.muddle', 'query.sock')
+
+def ask_query_server(args):
+    """
+    Ask the query server for our build tree (if any) to run "muddle <args>".
+
+    Only "query" commands are sent to the server - see query_server.py for
+    how it works. We do this without importing the rest of muddle, since not
+    having to do that is much of the point.
+
+    Returns the command's return code, or None if we should run the command
+    ourselves (because it is not a query, or there is no server, or the
+    server did not answer).
+    """
+    if not args or args[0] != 'query' or 'MUDDLE_NO_QUERY_SERVER' in os.environ:
+        return None
+
+    # Find the root of the top-level build, as utils.find_root_and_domain()
+    # does (but without checking the .muddle directories as carefully)
+    current_dir = os.getcwd()
+    root_dir = current_dir
+    while not (os.path.isdir(os.path.join(root_dir, '.muddle')) and
+               not os.path.exists(os.path.join(root_dir, '.muddle', 'am_subdomain'))):
+        parent = os.path.dirname(root_dir)
+        if parent == root_dir:
+            return None
+        root_dir = parent
+    path = os.path.join(root_dir, QUERY_SERVER_SOCKET)
+    if not os.path.exists(path):
+        return None
+
+    import marshal
+    import socket
+    import struct
+
+    def receive_exactly(sock, length):
+        parts = []
+        while length:
+            data = sock.recv(min(length, 65536))
+            if not data:
+                raise EOFError('Connection closed')
+            parts.append(data)
+            length -= len(data)
+        return ''.join(parts)
+
+    # Socket names are limited to about 100 characters
+    relative = os.path.relpath(path)
+    if len(relative) < len(path):
+        path = relative
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(60)
+        sock.connect(path)
+        data = marshal.dumps({'args':args, 'cwd':current_dir,
+                              'env':dict(os.environ)})
+        sock.sendall(struct.pack('!I', len(data)) + data)
+        length, = struct.unpack('!I', receive_exactly(sock, 4))
+        reply = marshal.loads(receive_exactly(sock, length))
+    except (socket.error, EOFError, ValueError, struct.error):
+        return None
+    finally:
+        sock.close()
+    sys.stdout.write(reply['output'])
+    return reply['retcode']
+
+if __name__ == "__main__":
+    # Before we go to the trouble of importing muddle...
+    retcode = ask_query_server(sys.argv[1:])
+    if retcode is not None:
+        sys.exit(retcode)
+
 # Perform a nasty trick to enable us to import the package
 # that we are within. Unfortunately, if we're run via
 # 'python <this-directory>', then Python doesn't seem to
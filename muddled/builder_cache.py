@@ -0,0 +1,240 @@
+"""
+Caching the results of loading a build description.
+
+Loading a build description means running its Python code (and that of the
+build descriptions of any subdomains), which can take several seconds for
+a large build, and has to be done for every muddle command.
+
+The results (the rules, the checkout data, the environments, and so on)
+only depend on the build description checkouts, the files in .muddle that
+say where the build description is, and muddle itself. So we save them in
+.muddle/cache/builder, along with a hash of all of those things, and use
+them instead of reloading the build description until something changes.
+
+Not everything can be cached. If the rules refer to classes or functions
+defined in the build tree (for instance, an Action subclass defined in a
+build description), then they cannot be restored without running the build
+description again, and we just remember not to try.
+
+Setting the environment variable MUDDLE_NO_BUILDER_CACHE (to anything)
+stops muddle using the cache.
+"""
+
+import cPickle
+import cStringIO
+import hashlib
+import os
+import pickletools
+import sys
+
+CACHE_VERSION = 1
+
+# The .muddle files that determine which build description we load
+DESCRIPTION_FILES = ('Description', 'RootRepository', 'DescriptionBranch',
+                     'VersionsRepository', 'ReleaseSpec')
+
+# Builder attributes which do not come from loading the build description
+BUILDER_NOT_CACHED = ('invocation', 'db', 'muddle_binary', 'muddled_dir',
+                      'default_domain', 'release_spec', '_dependent_dirs',
+                      '_obj_dir_layouts', '_env_index', '_envs_for_label',
+                      'quiet_commands')
+
+# Database attributes which do not come from loading the build description
+DB_NOT_CACHED = ('root_path', 'RootRepository_pathfile', 'Description_pathfile',
+                 'DescriptionBranch_pathfile', 'VersionsRepository_pathfile',
+                 'just_pulled')
+
+# Directories and files within a build description checkout that we ignore
+IGNORED_DIRS = ('.git', '.bzr', '.svn', '.hg')
+IGNORED_EXTENSIONS = ('.pyc', '.pyo', '~')
+
+_muddled_fingerprint = None
+
+def cache_file_name(root_path):
+    return os.path.join(root_path, '.muddle', 'cache', 'builder')
+
+def cache_disabled():
+    return 'MUDDLE_NO_BUILDER_CACHE' in os.environ
+
+def _hash_file(hasher, path):
+    try:
+        with open(path, 'rb') as fd:
+            hasher.update('%d:'%os.fstat(fd.fileno()).st_size)
+            hasher.update(fd.read())
+    except IOError:
+        hasher.update('-')
+
+def _hash_directory(hasher, path):
+    """
+    Hash the names and contents of the files in 'path' and its subdirectories.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS)
+        for name in sorted(filenames):
+            if name.endswith(IGNORED_EXTENSIONS):
+                continue
+            filepath = os.path.join(dirpath, name)
+            hasher.update('%s\0'%os.path.relpath(filepath, path))
+            _hash_file(hasher, filepath)
+
+def _get_muddled_fingerprint():
+    """
+    Return a string identifying this version of muddle itself.
+
+    If muddle changes, the classes we've pickled may have changed, so we
+    take account of the size and modification time of each of its files.
+    """
+    global _muddled_fingerprint
+    if _muddled_fingerprint is None:
+        muddled_dir = os.path.split(os.path.abspath(__file__))[0]
+        parts = []
+        for dirpath, dirnames, filenames in os.walk(muddled_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith('.py'):
+                    st = os.stat(os.path.join(dirpath, name))
+                    parts.append('%s:%d:%d'%(os.path.join(dirpath, name),
+                                             st.st_size, st.st_mtime))
+        _muddled_fingerprint = '\n'.join(parts)
+    return _muddled_fingerprint
+
+def cache_key(root_path, default_domain, build_desc_dirs):
+    """
+    Return the key for a cache of the given build.
+
+    'build_desc_dirs' is the list of the (relative) directories of all of the
+    build description checkouts, as given by build_description_dirs().
+    """
+    hasher = hashlib.sha1()
+    hasher.update(repr((CACHE_VERSION, root_path, default_domain,
+                        build_desc_dirs)))
+    hasher.update(_get_muddled_fingerprint())
+    for name in DESCRIPTION_FILES:
+        hasher.update('\0%s\0'%name)
+        _hash_file(hasher, os.path.join(root_path, '.muddle', name))
+    for path in build_desc_dirs:
+        hasher.update('\0%s\0'%path)
+        _hash_directory(hasher, os.path.join(root_path, path))
+    return hasher.hexdigest()
+
+def build_description_dirs(builder):
+    """
+    Return the directories of all of the build description checkouts.
+
+    That is, those of the top-level build and of all of its subdomains, as
+    paths relative to the root of the build tree, sorted.
+    """
+    root_path = builder.db.root_path
+    dirs = set()
+    for label in builder.db.domain_build_desc_label.values():
+        path = builder.db.get_checkout_path(label)
+        dirs.add(os.path.relpath(path, root_path))
+    return sorted(dirs)
+
+def _uses_build_tree_code(data, root_path):
+    """
+    Does pickled 'data' refer to any code from within the build tree?
+    """
+    root_path = os.path.join(os.path.abspath(root_path), '')
+    for opcode, arg, pos in pickletools.genops(data):
+        if opcode.name != 'GLOBAL':
+            continue
+        module_name = arg.split(' ')[0]
+        module = sys.modules.get(module_name)
+        if module is None:
+            return True
+        filename = getattr(module, '__file__', None)
+        if filename and os.path.abspath(filename).startswith(root_path):
+            return True
+    return False
+
+def _persistent_ids(builder):
+    """
+    Objects that we don't cache, but which the cached objects may refer to.
+    """
+    return {id(builder):'builder', id(builder.db):'db'}
+
+def save_builder(builder):
+    """
+    Save the results of loading the build description for 'builder'.
+
+    If we can't do that, remember that, so we don't waste time trying again
+    until the build description changes.
+    """
+    import muddled.distribute as distribute
+
+    root_path = builder.db.root_path
+    build_desc_dirs = build_description_dirs(builder)
+    key = cache_key(root_path, builder.default_domain, build_desc_dirs)
+
+    state = {}
+    state['builder'] = dict((k, v) for (k, v) in builder.__dict__.items()
+                            if k not in BUILDER_NOT_CACHED)
+    state['db'] = dict((k, v) for (k, v) in builder.db.__dict__.items()
+                       if k not in DB_NOT_CACHED)
+    state['distributions'] = distribute.the_distributions
+
+    ids = _persistent_ids(builder)
+    pickler = cPickle.Pickler(2)
+    pickler.persistent_id = lambda obj: ids.get(id(obj))
+    try:
+        pickler.dump(state)
+        data = pickler.getvalue()
+    except (cPickle.PicklingError, TypeError, AttributeError):
+        data = None
+    if data is not None and _uses_build_tree_code(data, root_path):
+        data = None
+
+    filename = cache_file_name(root_path)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename + '.new', 'wb') as fd:
+            cPickle.dump((CACHE_VERSION, build_desc_dirs, key), fd, 2)
+            cPickle.dump(data, fd, 2)
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError):
+        # Not being able to write the cache is not an error
+        pass
+
+def load_builder(builder):
+    """
+    Restore the results of loading the build description into 'builder'.
+
+    'builder' should be newly constructed.
+
+    Returns True if we did so, or False if there was no valid cache for it.
+    """
+    import muddled.distribute as distribute
+
+    root_path = builder.db.root_path
+    filename = cache_file_name(root_path)
+    try:
+        with open(filename, 'rb') as fd:
+            version, build_desc_dirs, key = cPickle.load(fd)
+            if version != CACHE_VERSION:
+                return False
+            if key != cache_key(root_path, builder.default_domain, build_desc_dirs):
+                return False
+            data = cPickle.load(fd)
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError):
+        return False
+
+    if data is None:
+        # We've already found that we can't cache this build
+        return False
+
+    objects = {'builder':builder, 'db':builder.db}
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = objects.get
+    try:
+        state = unpickler.load()
+    except Exception:
+        # Whatever went wrong, loading the build description will fix it
+        return False
+
+    builder.__dict__.update(state['builder'])
+    builder.db.__dict__.update(state['db'])
+    distribute.the_distributions.update(state['distributions'])
+    return True
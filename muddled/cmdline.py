@@ -190,9 +190,12 @@ def guess_cmd_in_build(builder, current_dir):
 
     return command_name, args
 
-def _cmdline(args, current_dir, original_env, muddle_binary):
+def _cmdline(args, current_dir, original_env, muddle_binary, builder=None):
     """
     The actual command line, with no safety net...
+
+    If 'builder' is given, it is the Builder for the build tree we are in,
+    already loaded.
     """
 
     guess_what_to_do = False
@@ -229,7 +232,8 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
         guess_what_to_do = True
 
     # Are we in a muddle build?
-    builder = find_and_load(specified_root, muddle_binary)
+    if builder is None:
+        builder = find_and_load(specified_root, muddle_binary)
     if builder and guess_what_to_do:
         # We are, but we have to "guess" what to do
         command_name, args = guess_cmd_in_build(builder, current_dir)
@@ -256,7 +260,7 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
             raise utils.GiveUp("Command %s requires a build tree."%(command_name))
         command.without_build_tree(muddle_binary, current_dir, args)
 
-def cmdline(args, muddle_binary=None):
+def cmdline(args, muddle_binary=None, builder=None):
     """
     Work out what to do from a muddle command line.
 
@@ -267,6 +271,10 @@ def cmdline(args, muddle_binary=None):
     by muddle itself. It is important to get this right, as it is used in
     Makefiles to run muddle itself. If it is given as None then we shall
     make up what should be a sensible value.
+
+    'builder' may be the Builder for the build tree we are in, if it has
+    already been loaded (by the query server, for instance - see
+    query_server.py). Otherwise we find and load it ourselves.
     """
 
     # This is actually just a wrapper function, to allow us to neatly
@@ -286,7 +294,7 @@ def cmdline(args, muddle_binary=None):
 
     try:
         os.chdir(original_dir)          # In case we set it to shell_dir
-        _cmdline(args, original_dir, original_env, muddle_binary)
+        _cmdline(args, original_dir, original_env, muddle_binary, builder)
     finally:
         os.chdir(original_dir)          # Should not really be necessary...
         os.environ = original_env
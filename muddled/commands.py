@@ -37,13 +37,16 @@ import muddled.env_store as env_store
 import muddled.instr as instr
 import muddled.mechanics as mechanics
 import muddled.pkg as pkg
+import muddled.query_server as query_server
 import muddled.subst as subst
 import muddled.utils as utils
+import muddled.vcs.git_mirror as git_mirror
 import muddled.version_control as version_control
 import muddled.docreport
 
 from muddled.colourize import colourize
-from muddled.db import Database, InstructionFile
+from muddled.db import Database, InstructionFile, get_tag_store, \
+        convert_tag_store, clear_tags_of_types
 from muddled.depend import Label, label_list_to_string
 from muddled.utils import GiveUp, MuddleBug, Unsupported, \
         DirType, LabelTag, LabelType, find_label_dir, sort_domains
@@ -180,9 +183,16 @@ class Command(object):
     # if we encounter that switch
     allowed_switches = {}
 
+    # Similarly, subclasses may specify switches that take a value, which is
+    # the next word on the command line. These are held in the same form as
+    # 'allowed_switches', and the values found end up in 'switch_values',
+    # a dictionary of <token> : <value>
+    allowed_switches_with_values = {}
+
     # A list of the switches we were given, held as the first element
     # from one of the 'allowed_switches' tuples
     switches = []
+    switch_values = {}
 
     def __init__(self):
         self.options = { }
@@ -236,11 +246,18 @@ class Command(object):
         switches.
         """
         self.switches = []              # In case we're called again
+        self.switch_values = {}
         while args:
             word = args[0]
             if word[0] == '-':
                 if word in self.allowed_switches:
                     self.switches.append(self.allowed_switches[word])
+                elif word in self.allowed_switches_with_values:
+                    if len(args) < 2:
+                        raise GiveUp('Switch "%s" must be followed by a value'%word)
+                    token = self.allowed_switches_with_values[word]
+                    self.switch_values[token] = args[1]
+                    args = args[1:]
                 else:
                     raise GiveUp('Unexpected switch "%s"'%word)
             else:
@@ -251,6 +268,20 @@ class Command(object):
             raise GiveUp('Unexpected trailing arguments "%s"'%' '.join(args))
         return args
 
+    def jobs_from_switches(self):
+        """Return the number of jobs requested with '-j <jobs>', or 1.
+        """
+        value = self.switch_values.get('jobs')
+        if value is None:
+            return 1
+        try:
+            jobs = int(value)
+        except ValueError:
+            raise GiveUp('The number of jobs must be an integer, not "%s"'%value)
+        if jobs < 1:
+            raise GiveUp('The number of jobs must be at least 1, not %d'%jobs)
+        return jobs
+
     def with_build_tree(self, builder, current_dir, args):
         """
         Run this command with a build tree.
@@ -839,12 +870,21 @@ def kill_labels(builder, to_kill):
     except GiveUp, e:
         raise GiveUp("Can't kill %s - %s"%(str(lbl), e))
 
-def build_labels(builder, to_build):
+def build_labels(builder, to_build, jobs=1):
     if len(to_build) == 1:
         print "Building %s"%to_build[0]
     else:
         print "Building %d labels"%len(to_build)
 
+    if jobs > 1:
+        print "Using up to %d jobs"%jobs
+        try:
+            builder.build_labels_in_parallel(to_build, jobs)
+        except GiveUp,e:
+            raise GiveUp("Can't build %s - %s"%(label_list_to_string(to_build),
+                                                colourize(e)))
+        return
+
     try:
         for lbl in to_build:
             builder.build_label(lbl)
@@ -2929,27 +2969,23 @@ class QueryMakeEnv(QueryCommand):
             print 'Multiple rules for building %s'%label
             return
 
-        # Amend the environment as if we were about to build
-        old_env = os.environ
+        # Work out the environment as if we were about to build, starting
+        # from an empty environment
+        rule = list(rule_set)[0]
+        env = builder.build_env_for(label, base_env={})
+        build_action = rule.action
+        tmp = Label(LabelType.Checkout, build_action.co, domain=label.domain)
+        co_path = builder.db.get_checkout_path(tmp)
         try:
-            os.environ = {}
-            rule = list(rule_set)[0]
-            builder._build_label_env(label, env_store)
-            build_action = rule.action
-            tmp = Label(LabelType.Checkout, build_action.co, domain=label.domain)
-            co_path = builder.db.get_checkout_path(tmp)
-            try:
-                build_action._amend_env(co_path)
-            except AttributeError:
-		# The kernel builder, for instance, does not have _amend_env
-		# Of course, it also doesn't use any of the make.py classes...
-                pass
-            keys = os.environ.keys()
-            keys.sort()
-            for key in keys:
-                print '%s=%s'%(key,os.environ[key])
-        finally:
-            os.environ = old_env
+            env = build_action._amend_env(co_path, env)
+        except AttributeError:
+            # The kernel builder, for instance, does not have _amend_env
+            # Of course, it also doesn't use any of the make.py classes...
+            pass
+        keys = env.keys()
+        keys.sort()
+        for key in keys:
+            print '%s=%s'%(key,env[key])
 
 @subcommand('query', 'objdir', CAT_QUERY)
 class QueryObjdir(QueryCommand):
@@ -3509,6 +3545,8 @@ class StampSave(Command):
     * -before <when> - use the (last) revision id at or before <when>
     * -f, -force - "force" a revision id
     * -h, -head - use HEAD for all checkouts
+    * -j <jobs>, -jobs <jobs> - ask about up to <jobs> checkouts at once
+    * -quick - read git revision ids directly from each checkout's .git
     * -v <version>, -version <version>  - specify the version of stamp file
 
     These are explained more below. Switches may occur before or after
@@ -3564,6 +3602,17 @@ class StampSave(Command):
     In this case, the repository specified in the build description is used,
     and the revision id and status of each checkout is not checked.
 
+    If '-j <jobs>' or '-jobs <jobs>' is given, then up to <jobs> checkouts
+    are asked about at the same time. This is worthwhile for a large build,
+    particularly if some checkouts use a VCS that needs to contact a remote
+    server. The stamp file, and what is reported, are the same as otherwise.
+
+    If '-quick' is specified, then the revision id and branch of each git
+    checkout are read directly from the files in its .git directory, without
+    running git at all. This does not check for local changes, or anything
+    else that git would have been asked about. Other VCSs are asked as
+    normal. '-quick' is ignored if '-before' is given.
+
     By default, a version 2 stamp file will be created. This is equivalent
     to specifying '-version 2'. If '-version 1' is specified, then a version
     1 stamp file will be created instead. This is the version of stamp file
@@ -3584,6 +3633,7 @@ class StampSave(Command):
         filename = None
         when = None
         version = 2
+        quick = False
 
         while args:
             word = args.pop(0)
@@ -3595,6 +3645,13 @@ class StampSave(Command):
                 force = False
             elif word == '-before':
                 when = args.pop(0)
+            elif word in ('-j', '-jobs'):
+                if not args:
+                    raise GiveUp("%s must be followed by a number of jobs,"
+                                 " for 'stamp save'"%word)
+                self.switch_values = {'jobs':args.pop(0)}
+            elif word == '-quick':
+                quick = True
             elif word in ('-v', '-version'):
                 try:
                     version = int(args.pop(0))
@@ -3619,7 +3676,10 @@ class StampSave(Command):
         if self.no_op():
             return
 
-        stamp, problems = VersionStamp.from_builder(builder, force, just_use_head, before=when)
+        stamp, problems = VersionStamp.from_builder(builder, force, just_use_head,
+                                                    before=when,
+                                                    jobs=self.jobs_from_switches(),
+                                                    quick=quick)
 
         working_filename = '_temporary.stamp'
         print 'Writing to',working_filename
@@ -3660,7 +3720,7 @@ class StampSave(Command):
 @subcommand('stamp', 'version', CAT_EXPORT)
 class StampVersion(Command):
     """
-    :Syntax: muddle stamp version [-f[orce]|-v[ersion] <version>]
+    :Syntax: muddle stamp version [-f[orce]|-v[ersion] <version>|-j[obs] <jobs>|-quick]
 
     This is similar to "stamp save", but using a pre-determined stamp filename.
 
@@ -3694,7 +3754,7 @@ class StampVersion(Command):
     extension ".partial"), then the version stamp file will not be written.
 
     Note that '-f' is supported (although perhaps not recommended), but '-h' is
-    not.
+    not. '-j <jobs>' (or '-jobs <jobs>') and '-quick' are as for "stamp save".
 
     By default, a version 2 stamp file will be created. This is equivalent
     to specifying '-version 2'. If '-version 1' is specified, then a version
@@ -3718,12 +3778,21 @@ class StampVersion(Command):
     def with_build_tree(self, builder, current_dir, args):
         force = False
         version = 2
+        quick = False
 
         while args:
             word = args[0]
             args = args[1:]
             if word in ('-f', '-force'):
                 force = True
+            elif word in ('-j', '-jobs'):
+                if not args:
+                    raise GiveUp("%s must be followed by a number of jobs,"
+                                 " for 'stamp version'"%word)
+                self.switch_values = {'jobs':args[0]}
+                args = args[1:]
+            elif word == '-quick':
+                quick = True
             elif word in ('-v', '-version'):
                 try:
                     version = int(args[0])
@@ -3746,7 +3815,9 @@ class StampVersion(Command):
             return
 
         stamp, problems = VersionStamp.from_builder(builder, force,
-                                                    just_use_head=False)
+                                                    just_use_head=False,
+                                                    jobs=self.jobs_from_switches(),
+                                                    quick=quick)
 
         if problems:
             print problems
@@ -5392,6 +5463,12 @@ class Redeploy(DeploymentCommand):
     This is exactly equivalent to doing "muddle cleandeploy" for all the
     labels, followed by "muddle deploy" for them all.
 
+    The exception is a deployment that can be deployed incrementally (as a
+    file deployment can, by default). Its 'deploy/' directory is kept, and
+    only its '/deployed' tag is removed, so that only what has changed since
+    it was last deployed needs to be deployed again. Use "muddle cleandeploy"
+    and then "muddle deploy" to deploy such a deployment afresh.
+
     <deployment> should be a label fragment specifying a deployment, or one of
     _all and friends, as for any deployment command. The <type> defaults to
     "deployment", and the deployment <tag> will be "/deployed". See "muddle
@@ -5402,7 +5479,15 @@ class Redeploy(DeploymentCommand):
     """
 
     def build_these_labels(self, builder, labels):
-        build_a_kill_b(builder, labels, LabelTag.Clean, LabelTag.Deployed)
+        to_clean = []
+        for lbl in labels:
+            rule = builder.ruleset.rule_for_target(lbl)
+            if rule is not None and getattr(rule.action, 'incremental', False):
+                print "Killing: %s .. "%lbl
+                builder.kill_label(lbl)
+            else:
+                to_clean.append(lbl)
+        build_a_kill_b(builder, to_clean, LabelTag.Clean, LabelTag.Deployed)
         build_labels(builder, labels)
 
 @command('cleandeploy', CAT_DEPLOYMENT)
@@ -5514,7 +5599,7 @@ class Reconfigure(PackageCommand):
 @command('build', CAT_PACKAGE)
 class Build(PackageCommand):
     """
-    :Syntax: muddle build [ <package> ... ]
+    :Syntax: muddle build [-j <jobs>] [-q] [ <package> ... ]
 
     Build packages.
 
@@ -5547,10 +5632,30 @@ class Build(PackageCommand):
     This sequence is why a dependency on a package should normally be made
     on package:<name>{<role>}/postinstalled - that is the final stage of
     building any package.
+
+    If "-j <jobs>" is given, then up to <jobs> steps are run at the same
+    time, each as soon as everything it depends on has been done. Each step
+    is run in its own process, with its own environment. If a step fails,
+    no more steps are started, but those already running are allowed to
+    finish. For instance::
+
+        muddle build -j 8 _all
+
+    The commands run for each step, and their output, are written to a log
+    file for that step, in .muddle/logs. For instance, those for building
+    package:fred{x86}/built are in .muddle/logs/package/fred/x86-built.log.
+
+    If "-q" (or "-quiet") is given, then the commands and their output are
+    only written to the log files, and are not shown. If a command fails,
+    the end of its output is still reported.
     """
 
+    allowed_switches = {'-q': 'quiet', '-quiet': 'quiet'}
+    allowed_switches_with_values = {'-j': 'jobs', '-jobs': 'jobs'}
+
     def build_these_labels(self, builder, labels):
-        build_labels(builder, labels)
+        builder.quiet_commands = ('quiet' in self.switches)
+        build_labels(builder, labels, self.jobs_from_switches())
 
 @command('rebuild', CAT_PACKAGE)
 class Rebuild(PackageCommand):
@@ -5832,7 +5937,7 @@ class Push(CheckoutCommand):
 @command('pull', CAT_CHECKOUT, ['fetch', 'update'])   # we want to settle on one command
 class Pull(CheckoutCommand):
     """
-    :Syntax: muddle pull [-s[top]] [-noreload] [ <checkout> ... ]
+    :Syntax: muddle pull [-s[top]] [-noreload] [-j[obs] <jobs>] [ <checkout> ... ]
 
     Pull the specified checkouts from their remote repositories. Any problems
     will be (re)reported at the end.
@@ -5866,6 +5971,15 @@ class Pull(CheckoutCommand):
     re-reporting any problems at the end. If '-s' or '-stop' is given, then
     it will instead stop at the first problem.
 
+    If '-j <jobs>' or '-jobs <jobs>' is given, then up to <jobs> checkouts
+    will be pulled at the same time, each in its own process. The output
+    for each checkout is saved up and written out when its pull has
+    finished, so that the output for different checkouts does not get
+    mixed together. Any build descriptions are still pulled first, one
+    at a time, as described below. With '-s', no more pulls are started
+    after the first problem, but those already started are allowed to
+    finish.
+
     How build descriptions are treated specially
     --------------------------------------------
     If the build description is in the list of checkouts that should be
@@ -5911,6 +6025,7 @@ class Pull(CheckoutCommand):
     allowed_switches = {'-s': 'stop',
                         '-stop':'stop',
                         '-noreload':'noreload'}
+    allowed_switches_with_values = {'-j':'jobs', '-jobs':'jobs'}
 
     def build_these_labels(self, builder, labels):
 
@@ -5918,6 +6033,8 @@ class Pull(CheckoutCommand):
 
         do_build_descriptions_first = 'noreload' not in self.switches
 
+        jobs = self.jobs_from_switches()
+
         self.problems = []
         self.not_needed  = []
 
@@ -5929,8 +6046,11 @@ class Pull(CheckoutCommand):
             if do_build_descriptions_first and len(labels) > 1:
                 builder, labels = self.handle_build_descriptions_first(builder, labels)
 
-            for co in labels:
-                self.pull(builder, co)
+            if jobs > 1 and len(labels) > 1:
+                self.pull_in_parallel(builder, labels, jobs)
+            else:
+                for co in labels:
+                    self.pull(builder, co)
         finally:
             # Remember to commit the 'just pulled' information, whatever happens
             builder.db.just_pulled.commit()
@@ -6069,19 +6189,53 @@ class Pull(CheckoutCommand):
         """Do the work of pulling checkout 'co_label'
         """
         try:
-            # First clear the 'pulled' tag
-            builder.db.clear_tag(co_label)
-            # And then build it again
-            builder.build_label(co_label)
-        except Unsupported as e:
+            self.pull_label(builder, co_label)
+        except GiveUp as e:
+            self.note_problem(e)
+
+    def pull_label(self, builder, co_label):
+        """Pull checkout 'co_label', letting any exception through.
+        """
+        # First clear the 'pulled' tag
+        builder.db.clear_tag(co_label)
+        # And then build it again
+        builder.build_label(co_label)
+
+    def note_problem(self, e):
+        """Remember the GiveUp 'e' from a pull, to report at the end.
+
+        If we're meant to stop on the first problem, re-raises it instead.
+        """
+        if isinstance(e, Unsupported):
             print e
             self.not_needed.append(e)
-        except GiveUp as e:
-            if self.stop_on_problem:
-                raise
-            else:
-                print e
-                self.problems.append(e)
+        elif self.stop_on_problem:
+            raise e
+        else:
+            print e
+            self.problems.append(e)
+
+    def pull_in_parallel(self, builder, labels, jobs):
+        """Pull the checkouts in 'labels', up to 'jobs' at a time.
+
+        Each pull is done in a child process, and its output is written out
+        when it is finished. The checkouts that each child pulled are added
+        to our own 'just pulled' set.
+        """
+        def pull_in_child(co_label):
+            self.pull_label(builder, co_label)
+            return builder.db.just_pulled.labels
+
+        children = builder.run_in_children(sorted(labels), pull_in_child, jobs)
+        try:
+            for co, output, pulled, e in children:
+                sys.stdout.write(output)
+                if pulled:
+                    builder.db.just_pulled.labels.update(pulled)
+                if e is not None:
+                    self.note_problem(e)
+        finally:
+            children.close()
 
     def delete_pyc_files(self, builder, co_label):
         """Delete .pyc files in this checkout
@@ -6177,7 +6331,7 @@ class Merge(CheckoutCommand):
 @command('status', CAT_CHECKOUT)
 class Status(CheckoutCommand):
     """
-    :Syntax: muddle status [-v] [-j] [-quick] [ <checkout> ... ]
+    :Syntax: muddle status [-v] [-j] [-quick] [-jobs <jobs>] [ <checkout> ... ]
 
     Report on the status of checkouts that need attention.
 
@@ -6217,6 +6371,12 @@ class Status(CheckoutCommand):
     can gives depends upon whatever was last fetched into the local repository.
     It can typically inform you if there are local updates to be pushed, but
     will not (cannot) warn you if there are commits to be pulled.
+
+    If '-jobs <jobs>' is given, then up to <jobs> checkouts will be checked
+    at the same time, each in its own process. The report for each checkout
+    is written out when it has been checked, so the reports may not come
+    out in the same order as they would otherwise. (Note that '-j' is not
+    short for '-jobs' for this command.)
     """
 
     required_tag = LabelTag.CheckedOut
@@ -6224,6 +6384,7 @@ class Status(CheckoutCommand):
                         '-j': 'join',
                         '-quick' : 'quick'
                        }
+    allowed_switches_with_values = {'-jobs':'jobs'}
 
     # This checkout command *is* allowed in a release build
     def allowed_in_release_build(self):
@@ -6239,8 +6400,10 @@ class Status(CheckoutCommand):
         verbose = ('verbose' in self.switches)
         joined = ('join' in self.switches)
         quick = ('quick' in self.switches)
+        jobs = self.jobs_from_switches()
 
         something = []
+        to_check = []
         for co in labels:
             if not builder.db.is_tag(co):
                 print
@@ -6255,19 +6418,31 @@ class Status(CheckoutCommand):
                 something.append(co)
                 continue
 
+            if jobs > 1:
+                to_check.append(co)
+                continue
+
             try:
                 text = vcs_handler.status(builder, co, verbose, quick=quick)
-            except MuddleBug as err:
-                raise MuddleBug('Giving up in %s because:\n%s'%(co,err))
-            except GiveUp as err:
-                print err
+                err = None
+            except GiveUp as e:
+                text, err = None, e
+            if self.report_status(co, text, err):
                 something.append(co)
-                continue
 
-            if text:
-                print
-                print text.strip()
-                something.append(co)
+        if to_check:
+            def status_in_child(co):
+                vcs_handler = builder.db.get_checkout_vcs(co)
+                return vcs_handler.status(builder, co, verbose, quick=quick)
+
+            children = builder.run_in_children(to_check, status_in_child, jobs)
+            try:
+                for co, output, text, err in children:
+                    sys.stdout.write(output)
+                    if self.report_status(co, text, err):
+                        something.append(co)
+            finally:
+                children.close()
 
         if something:
             if joined:
@@ -6279,6 +6454,26 @@ class Status(CheckoutCommand):
         else:
             print 'All checkouts seemed clean'
 
+    def report_status(self, co, text, err):
+        """Report on the status of checkout 'co'.
+
+        'text' is what its VCS handler's status() method returned, and 'err'
+        is the GiveUp exception it raised instead, if any.
+
+        Returns True if the checkout needs attention.
+        """
+        if isinstance(err, MuddleBug):
+            raise MuddleBug('Giving up in %s because:\n%s'%(co,err))
+        elif err is not None:
+            print err
+            return True
+        elif text:
+            print
+            print text.strip()
+            return True
+        else:
+            return False
+
 @command('reparent', CAT_CHECKOUT)
 class Reparent(CheckoutCommand):
     """
@@ -6443,7 +6638,7 @@ class Import(CheckoutCommand):
 @command('checkout', CAT_CHECKOUT)
 class Checkout(CheckoutCommand):
     """
-    :Syntax: muddle checkout [ <checkout> ... ]
+    :Syntax: muddle checkout [-j[obs] <jobs>] [ <checkout> ... ]
 
     Checks out the specified checkouts.
 
@@ -6467,12 +6662,48 @@ class Checkout(CheckoutCommand):
         (The value of _just_pulled is cleared at the start of "muddle pull"
         or "muddle checkout", and set at the end - the list of checkout labels
         is actually stored in the file .muddle/_just_pulled.)
+
+    If '-j <jobs>' or '-jobs <jobs>' is given, then up to <jobs> checkouts
+    will be checked out at the same time, each in its own process. The
+    output for each checkout is saved up and written out when it has
+    finished, so that the output for different checkouts does not get mixed
+    together. If any checkouts fail, the rest are still attempted, and the
+    problems are reported at the end.
     """
 
+    allowed_switches_with_values = {'-j':'jobs', '-jobs':'jobs'}
+
     def build_these_labels(self, builder, labels):
         builder.db.just_pulled.clear()
-        for co in labels:
-            builder.build_label(co)
+        jobs = self.jobs_from_switches()
+        if jobs == 1 or len(labels) < 2:
+            for co in labels:
+                builder.build_label(co)
+            return
+
+        def checkout_in_child(co_label):
+            builder.build_label(co_label)
+            return builder.db.just_pulled.labels
+
+        problems = []
+        children = builder.run_in_children(labels, checkout_in_child, jobs)
+        try:
+            for co, output, checked_out, e in children:
+                sys.stdout.write(output)
+                if checked_out:
+                    builder.db.just_pulled.labels.update(checked_out)
+                if e is not None:
+                    print e
+                    problems.append(e)
+        finally:
+            children.close()
+
+        if problems:
+            print '\nThe following problems occurred:'
+            for e in problems:
+                print
+                print str(e).rstrip()
+            raise GiveUp()
 
 @command('sync', CAT_CHECKOUT)
 class Sync(CheckoutCommand):
@@ -7193,6 +7424,10 @@ class VeryClean(Command):
     depend on whether the subdomain is defined in the build description - it
     is done purely on the basis of what directories are actually present.
 
+    If a (sub)domain keeps its tags in .muddle/TagLog (see "muddle help
+    tag-store"), then the package and deployment tags are removed from that
+    instead.
+
     As usual, 'muddle -n veryclean' will report on what it would do, without
     actually doing it.
 
@@ -7240,6 +7475,13 @@ class VeryClean(Command):
                 for directory in ('package', 'deployment'):
                     delete_directory(os.path.join('.muddle', 'tags', directory))
 
+                if os.path.exists(os.path.join('.muddle', 'TagLog')):
+                    if self.no_op():
+                        print 'Would remove package and deployment tags from .muddle/TagLog'
+                    else:
+                        print 'Removing package and deployment tags from .muddle/TagLog'
+                        clear_tags_of_types(path, ('package', 'deployment'))
+
                 if os.path.exists('domains'):
                     subdomains = os.listdir('domains')
                     for name in subdomains:
@@ -7248,6 +7490,244 @@ class VeryClean(Command):
         # And our top level is, of course, the top domain
         tidy_domain(builder.db.root_path)
 
+@command('git-mirror', CAT_MISC)
+class GitMirror(Command):
+    """
+    :Syntax: muddle git-mirror
+    :or:     muddle git-mirror set <directory>
+    :or:     muddle git-mirror unset
+    :or:     muddle git-mirror prune [<days>]
+    :or:     muddle git-mirror repair
+
+    Report on, or manage, the local mirror of the git repositories that
+    this build tree's checkouts come from.
+
+    If there is a mirror directory, it holds a bare copy of each remote
+    repository that git checkouts are cloned from. "muddle checkout" then
+    only fetches what is not already in the mirror from the remote
+    repository, and "muddle pull" (and "muddle merge") update the mirror
+    once, and fetch from that. The mirror can be shared between build trees,
+    and by several muddle commands at the same time.
+
+    The mirror directory is given by the file .muddle/GitMirror, or if that
+    does not exist, by the environment variable MUDDLE_GIT_MIRROR. If neither
+    is set, no mirror is used.
+
+    With no arguments, reports which mirror directory is used, and the
+    mirrors in it.
+
+    With "set", writes <directory> to .muddle/GitMirror, so that this build
+    tree uses it. With "unset", deletes .muddle/GitMirror.
+
+    With "prune", deletes the mirrors that have not been used for <days>
+    days (the default is 30). Checkouts do not depend on the mirror, so this
+    is always safe.
+
+    With "repair", removes any lock files left behind by interrupted git
+    commands, and checks each mirror with "git fsck", making it again from
+    its remote repository if necessary.
+    """
+
+    def requires_build_tree(self):
+        return True
+
+    def with_build_tree(self, builder, current_dir, args):
+        syntax = ("Syntax: muddle git-mirror [set <directory> | unset |"
+                  " prune [<days>] | repair]")
+        root_path = builder.db.root_path
+        if not args:
+            self.report(root_path)
+            return
+
+        what = args[0]
+        if what == 'set' and len(args) == 2:
+            if self.no_op():
+                print 'Would set git mirror directory to %s'%args[1]
+            else:
+                git_mirror.set_mirror_dir(root_path, args[1])
+                self.report(root_path)
+        elif what == 'unset' and len(args) == 1:
+            if self.no_op():
+                print 'Would unset git mirror directory'
+            else:
+                git_mirror.set_mirror_dir(root_path, None)
+                self.report(root_path)
+        elif what == 'prune' and len(args) <= 2:
+            try:
+                days = float(args[1]) if len(args) == 2 else 30
+            except ValueError:
+                raise GiveUp('The number of days must be a number,'
+                             ' not "%s"'%args[1])
+            mirror_dir = self.mirror_dir(root_path)
+            if self.no_op():
+                print 'Would delete mirrors in %s not used for %g days'%(
+                        mirror_dir, days)
+                return
+            deleted = git_mirror.prune_mirrors(mirror_dir, days)
+            print 'Deleted %d mirror%s'%(len(deleted),
+                                         '' if len(deleted) == 1 else 's')
+        elif what == 'repair' and len(args) == 1:
+            mirror_dir = self.mirror_dir(root_path)
+            if self.no_op():
+                print 'Would repair the mirrors in %s'%mirror_dir
+                return
+            repaired = git_mirror.repair_mirrors(mirror_dir)
+            for path, what in repaired:
+                print '%s: %s'%(path, what)
+            if not repaired:
+                print 'Nothing needed repairing'
+        else:
+            print syntax
+
+    def mirror_dir(self, root_path):
+        mirror_dir = git_mirror.get_mirror_dir(root_path)
+        if not mirror_dir:
+            raise GiveUp('There is no git mirror directory for this build tree')
+        return mirror_dir
+
+    def report(self, root_path):
+        mirror_dir = git_mirror.get_mirror_dir(root_path)
+        if not mirror_dir:
+            print 'There is no git mirror directory for this build tree'
+            return
+        if os.path.exists(git_mirror.mirror_dir_file(root_path)):
+            print 'Git mirror directory %s (from .muddle/GitMirror)'%mirror_dir
+        else:
+            print 'Git mirror directory %s (from $%s)'%(mirror_dir,
+                                                        git_mirror.MIRROR_ENV)
+        for path, url, last_used in git_mirror.list_mirrors(mirror_dir):
+            print '  %s\n    %s, last used %s'%(os.path.basename(path),
+                    url if url else '<unknown repository>',
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)))
+
+@command('tag-store', CAT_MISC)
+class TagStore(Command):
+    """
+    :Syntax: muddle tag-store
+    :or:     muddle tag-store log
+    :or:     muddle tag-store files
+
+    Report on, or change, how muddle remembers which labels have been
+    asserted (that is, which tags are set).
+
+    Traditionally, each tag is a separate file in .muddle/tags/, named
+    .muddle/tags/<type>/<name>/<role>-<tag>. For a large build, checking
+    all those files (for instance, for a "muddle build _all" that has
+    nothing to do) can be slow, especially if the build tree is on a
+    network filesystem.
+
+    Alternatively, all the tags can be kept in a single file,
+    .muddle/TagLog, which muddle reads once, and appends to when tags
+    change.
+
+    With no arguments, reports which is being used for the top-level build
+    and for each subdomain.
+
+    With "log", moves the tags from .muddle/tags/ to .muddle/TagLog.
+
+    With "files", moves the tags from .muddle/TagLog back to .muddle/tags/.
+
+    In both cases, this is done for the top-level build and for every
+    subdomain (as found in the 'domains/' directory, whether or not it is
+    used by the build description).
+
+    Build trees that have never had "muddle tag-store log" run in them
+    carry on using .muddle/tags/.
+    """
+
+    def requires_build_tree(self):
+        return True
+
+    def with_build_tree(self, builder, current_dir, args):
+        if len(args) > 1 or (args and args[0] not in ('log', 'files')):
+            print "Syntax: muddle tag-store [log | files]"
+            return
+
+        def all_domains(path):
+            yield path
+            domains_dir = os.path.join(path, 'domains')
+            if os.path.isdir(domains_dir):
+                for name in sorted(os.listdir(domains_dir)):
+                    for sub_path in all_domains(os.path.join(domains_dir, name)):
+                        yield sub_path
+
+        root_path = builder.db.root_path
+        for path in all_domains(root_path):
+            where = os.path.relpath(path, root_path)
+            if where == '.':
+                where = 'top-level build'
+            if not args:
+                if get_tag_store(path).is_log:
+                    print '%s: .muddle/TagLog'%where
+                else:
+                    print '%s: .muddle/tags/'%where
+            elif self.no_op():
+                print 'Would move tags for %s to %s'%(where,
+                        '.muddle/TagLog' if args[0] == 'log' else '.muddle/tags/')
+            else:
+                count = convert_tag_store(path, args[0] == 'log')
+                if count is None:
+                    print '%s: nothing to do'%where
+                else:
+                    print '%s: moved %d tag%s'%(where, count, '' if count == 1 else 's')
+
+@command('query-server', CAT_MISC)
+class QueryServer(Command):
+    """
+    :Syntax: muddle query-server
+    :or:     muddle query-server start
+    :or:     muddle query-server stop
+
+    Start, stop, or report on the query server for this build tree.
+
+    Muddle Makefiles often run "$(MUDDLE) query ..." (for instance, to find
+    the obj/ directory of another package), and each time muddle has to
+    start up and load the build description again. The query server keeps
+    the build description loaded, and answers "muddle query" commands much
+    more quickly.
+
+    With "start", starts the server, which then runs in the background.
+    While it is running, any "muddle query" command run in this build tree
+    is answered by the server (the command is the same, and so should the
+    answer be). If the build description changes, the server loads it again
+    before answering its next query.
+
+    With "stop", stops the server. It also stops by itself if it is not
+    asked anything for two hours.
+
+    With no arguments, reports whether there is a server, and if so, what
+    it has done.
+
+    The server listens on the socket .muddle/query.sock. Setting the
+    environment variable MUDDLE_NO_QUERY_SERVER (to anything) stops muddle
+    using it.
+    """
+
+    def requires_build_tree(self):
+        return True
+
+    def with_build_tree(self, builder, current_dir, args):
+        if len(args) > 1 or (args and args[0] not in ('start', 'stop')):
+            print "Syntax: muddle query-server [start | stop]"
+            return
+
+        root_path = builder.db.root_path
+        if not args:
+            status = query_server.server_status(root_path)
+            if status is None:
+                print 'There is no query server for %s'%root_path
+            else:
+                sys.stdout.write(status)
+        elif self.no_op():
+            print 'Would %s the query server for %s'%(args[0], root_path)
+        elif args[0] == 'start':
+            pid = query_server.start_server(builder, builder.muddle_binary)
+            print 'Started query server for %s, process %d'%(root_path, pid)
+        elif query_server.stop_server(root_path):
+            print 'Stopped query server for %s'%root_path
+        else:
+            print 'There is no query server for %s'%root_path
+
 @command('instruct', CAT_MISC)
 class Instruct(Command):
     """
@@ -5,12 +5,81 @@ There is apparently no standard way to do this from python.
 Ugh.
 """
 
+import hashlib
 import os
 import stat
 
 import muddled.utils as utils
 import muddled.filespec as filespec
 
+class Children(object):
+    """
+    The children of a directory File.
+
+    This behaves like the list of Files that it replaces - one can append()
+    to it and iterate over it, and the children come out in the order they
+    were added - but it also indexes them by name, so that finding or
+    removing a child by name does not mean searching through all of them.
+
+    A directory cannot contain two files with the same name, so appending
+    a File with the same name as an existing child replaces that child, in
+    the same place.
+    """
+
+    # There is one of these for every File, so keep them small and cheap
+    # to create. (In Python 2, OrderedDict is neither.)
+    __slots__ = ('order', 'index')
+
+    def __init__(self, files=None):
+        # The children in order, with None where a child has been removed
+        self.order = []
+        # Maps child name to its index in self.order
+        self.index = {}
+        if files:
+            for f in files:
+                self.append(f)
+
+    def append(self, f):
+        where = self.index.get(f.name)
+        if where is None:
+            self.index[f.name] = len(self.order)
+            self.order.append(f)
+        else:
+            self.order[where] = f
+
+    def get(self, name, default=None):
+        where = self.index.get(name)
+        if where is None:
+            return default
+        return self.order[where]
+
+    def remove_name(self, name):
+        """
+        Remove the child called 'name', if there is one.
+        """
+        where = self.index.pop(name, None)
+        if where is None:
+            return
+        self.order[where] = None
+        # Don't let the holes build up
+        if len(self.order) > 2*len(self.index) + 8:
+            self.order = [f for f in self.order if f is not None]
+            self.index = dict((f.name, n) for (n, f) in enumerate(self.order))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        for f in self.order:
+            if f is not None:
+                yield f
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return 'Children(%r)'%list(self)
+
 class File(object):
     """
     Represents a file in a CPIO archive.
@@ -39,16 +108,11 @@ class File(object):
         get utter rubbish. No guarantees you get a valid
         archive either though ..
 
-        * key_name is the name of the key under which this file is stored
-          in the parent hierarchy. It's a complete hack, but essential for
-          finding a file in the key map quickly without which deletion
-          becomes an O(n^2) operation (and N = number of files in the root
-          fs, so it's quite high).
-
         * self.name      - is the name of the file in the target archive.
         * self.fs_name   - is the name of the file in the underlying filesystem.
         * self.orig_file - is the name of the file from which the data in this
           file object comes.
+        * self.children  - is the Children of this file, if it is a directory.
 
         """
         self.dev = 0
@@ -63,15 +127,11 @@ class File(object):
         self.data = None
         self.orig_file = None
         # Children of this directory, if it is one.
-        self.children = [ ]
+        self.children = Children()
         self.fs_name = None
 
     def delete_child_with_name(self, in_name):
-        for i in range(0, len(self.children)):
-            if self.children[i].name == in_name:
-                del self.children[i]
-                return
-
+        self.children.remove_name(in_name)
 
     def rename(self, name):
         self.name = name
@@ -108,7 +168,8 @@ class Hierarchy(object):
 
     def __init__(self, map, roots):
         """
-        * self.map   - maps names in the target archive to file objects.
+        * self.map   - maps names in the target archive to file objects. It is
+          our index of every file in the hierarchy, by target path.
         * self.roots - is a subset of self.map that just maps the root objects.
         """
         self.map = map
@@ -120,42 +181,69 @@ class Hierarchy(object):
 
         We need to keep the hierarchy sensibly updated.
 
-        We merge the maps. We then kill all children and iterate over
-        everything in the resulting map, finding a parent to add it
-        to. This fails to preserve the order of files in directories,
-        but the result is correct in every other way.
+        Files in other replace any files in self with the same name, taking
+        their place in their parent directory, and inheriting any children
+        that other does not provide. Files from other that are new to self
+        come after the existing files in their directory.
 
         Anything in the result that does not have a parent is a root.
+
+        We only need to look at the files in other, and at the roots of both
+        hierarchies, since everything else already has the right parent.
         """
 
-        # Merge
+        # Merge, remembering which files were replaced
+        replaced = [ ]
         for (k,v) in other.map.items():
+            old = self.map.get(k)
             self.map[k] = v
-
-        # Obliterate any children.
-        for v in self.map.values():
-            v.children =  [ ]
-
-        # Wipe roots
-        self.roots = { }
-
-        for (k,v) in self.map.items():
+            if (old is not None and old is not v):
+                replaced.append((k, old, v))
+
+        for (k, old, v) in replaced:
+            # The new file inherits the old file's children, in their order,
+            # followed by any new children from other
+            if (old.children):
+                if (v.mode & File.S_DIR) == 0:
+                    raise utils.GiveUp("Attempt to merge file %s over directory"
+                                       " %s, which has children"%(v, k))
+                children = Children(self.map[c.name] for c in old.children)
+                for c in v.children:
+                    children.append(c)
+                v.children = children
+            # .. and takes the place of the old file in its parent
+            if (k not in self.roots):
+                parent_node = self.map.get(os.path.dirname(k))
+                if (parent_node is not None):
+                    self._add_child(parent_node, v, k)
+
+        # Anything that was a root in either hierarchy may now have a parent
+        new_roots = { }
+        for k in self.roots.keys() + other.roots.keys():
+            v = self.map[k]
             (a,b) = os.path.split(k)
 
             parent_node = self.map.get(a)
 
-            #print "Merge: k = %s a = %s b = %s parent_node = %s"%(k,a,b,parent_node)
             if (parent_node is None) or (a=="/" and b==""):
-                #print "root[k] = v (%s -> %s)"%(k, v.key_name)
-                self.roots[k] = v
-            elif (parent_node.mode & File.S_DIR) != 0:
-                # Got a parent.
-                parent_node.children.append(v)
+                new_roots[k] = v
             else:
-                raise utils.GiveUp("Attempt to merge file %s when parent '%s' ('%s') is not a directory: dir mode flag = 0x%x"%(k,parent_node,a, File.S_DIR))
+                self._add_child(parent_node, v, k)
+
+        self.roots = new_roots
 
         # .. and that's all, folks.
 
+    def _add_child(self, parent_node, v, k):
+        """
+        Add 'v' (called 'k') to the children of 'parent_node'.
+        """
+        if (parent_node.mode & File.S_DIR) == 0:
+            raise utils.GiveUp("Attempt to merge file %s when parent '%s' ('%s') is"
+                               " not a directory: dir mode flag = 0x%x"%(k,
+                                   parent_node, os.path.dirname(k), File.S_DIR))
+        parent_node.children.append(v)
+
     def normalise(self):
         """
         Normalise the hierarchy into one with a single root.
@@ -206,7 +294,10 @@ class Hierarchy(object):
                                     " circular roots?: %s"%self)
 
 
-    def render(self, to_file, logProgress = False):
+    def render(self, to_file, logProgress = False, hardLinks = None):
+        """
+        Render the hierarchy as a CPIO archive - see Archive.render().
+        """
 
         # Right. Trace each root into a list ..
         file_list = [ ]
@@ -216,7 +307,7 @@ class Hierarchy(object):
         ar = Archive()
         # We know this is in the right order, so we can hack a bit ..
         ar.files = file_list
-        ar.render(to_file, logProgress)
+        return ar.render(to_file, logProgress, hardLinks)
 
     def erase_target(self, file_name):
         """
@@ -225,21 +316,23 @@ class Hierarchy(object):
         """
 
         #print "Erase %s .. "%file_name
-        # Irritatingly, we need to iterate to find the name, since
-        # the map doesn't contain target names - only source ones :-(
-
         if (file_name in self.roots):
             del self.roots[file_name]
 
-        if (file_name in self.map):
-            obj = self.map[file_name]
-            for c in obj.children:
-                self.erase_target(c.name)
-
         par = self.parent_from_key(file_name)
         if (par is not None):
             par.delete_child_with_name(file_name)
 
+        obj = self.map.pop(file_name, None)
+        if (obj is not None):
+            # We're getting rid of obj, so we don't need to tidy up its own
+            # children, just forget about them
+            to_forget = list(obj.children)
+            while to_forget:
+                c = to_forget.pop()
+                self.map.pop(c.name, None)
+                to_forget.extend(c.children)
+
 
     def parent_from_key(self, key_name):
         up = os.path.dirname(key_name)
@@ -333,22 +426,22 @@ class CpioFileDataProvider(filespec.FileSpecDataProvider):
             print "> Warning: No files in %s [vroot = %s] in this cpio archive.. "%(dir,vroot)
             return [ ]
 
-        # Read everything in this directory.
+        # Read everything in this directory (and, if we're recursing, in
+        # the directories below it), working down from the File objects
+        # we've already found rather than looking each directory up again
         result = [ ]
+        self._list_children(obj, '', recursively, result)
+        return result
+
+    def _list_children(self, obj, prefix, recursively, result):
         for elem in obj.children:
-            last_elem = os.path.basename(elem.name)
             # We want the last element only ..
-            result.append(last_elem)
+            name = prefix + os.path.basename(elem.name)
+            result.append(name)
 
-            if (recursively):
+            if (recursively and elem.children):
                 # .. and recurse ..
-                #print "> l_f_u recurse dir = %s, elem.name = %s last = %s"%(dir, elem.name, last_elem)
-                inner = self.list_files_under(os.path.join(dir, last_elem), True,
-                                              vroot = vroot)
-                for thing in inner:
-                    result.append(os.path.join(last_elem, thing))
-
-        return result
+                self._list_children(elem, name + '/', True, result)
 
     def abs_match(self, filespec, vroot = None):
         """
@@ -536,102 +629,286 @@ class Archive(object):
             self.add_file(f)
 
 
-    def render(self, to_file, logProgress = False):
+    def render(self, to_file, logProgress = False, hardLinks = None):
         """
         Render a CPIO archive to the given file.
+
+        'to_file' may be the name of a file, or a file-like object open for
+        writing (for instance, the input of a pipe to a compression program).
+        In the latter case, we only ever write to it, so it does not need to
+        support seek() or tell(), and we do not close it.
+
+        The data for each file is copied across in chunks of at most
+        CHUNK_SIZE bytes, so the memory we need does not depend on how big
+        the files are.
+
+        'hardLinks' says whether (and how) to store regular files that are
+        the same as each other as hard links, so that their data is only
+        written once:
+
+        * None means don't - every file gets its own copy of its data.
+        * "inode" means files that are hard links to each other in the file
+          system (they have the same device and inode number).
+        * "content" means that, as well as those, files with the same content
+          (as determined by their SHA1 hash) are stored as hard links.
+
+        In either case, files are only linked if they also have the same
+        mode, uid and gid in the archive, since hard links share those.
+
+        Returns the number of bytes of file data that using hard links saved
+        us from writing (which is 0 if 'hardLinks' is None).
         """
 
-        f_out = open(to_file, "wb")
+        if hardLinks not in (None, "inode", "content"):
+            raise utils.GiveUp("Unexpected value for hardLinks, %r, should be"
+                               " None, \"inode\" or \"content\""%hardLinks)
+
+        if isinstance(to_file, basestring):
+            with open(to_file, "wb") as f_out:
+                return self._render_to(f_out, logProgress, hardLinks)
+        else:
+            return self._render_to(to_file, logProgress, hardLinks)
+
+    def _render_to(self, f_out, logProgress, hardLinks):
+        """
+        Render a CPIO archive to the file object 'f_out'.
+        """
 
         file_list = list(self.files)
         # There's a trailer on every cpio archive ..
         file_list.append(file_from_data("TRAILER!!!", ""))
 
+        # We need to know about the real files before we start
+        stats = {}
+        for f in file_list:
+            if (f.orig_file is not None):
+                stats[id(f)] = os.lstat(f.orig_file)
+
+        if (hardLinks is None):
+            links = {}
+        else:
+            links = _find_hard_links(file_list, stats, hardLinks == "content")
+        saved = 0
+
+        # We count what we've written ourselves, rather than using tell(),
+        # since we may be writing to a pipe
+        pos = 0
+
         for f in file_list:
-            # We need to know our data size, so pull in the data now.
+            # We need to know our data size before we write the header
+            copy_from = None
+            link = links.get(id(f))
             if (f.orig_file is not None):
                 # Is this a real file at all?
-                orig_stat = os.lstat(f.orig_file)
+                orig_stat = stats[id(f)]
 
-                if (stat.S_ISREG(orig_stat.st_mode)):
-                    f_in = open(f.orig_file, "rb")
-                    file_data = f_in.read()
-                    f_in.close()
+                if (link is not None and not link[3]):
+                    # A hard link to a file whose data we've already written
+                    file_data = None
+                    data_size = 0
+                    saved += orig_stat.st_size
+                elif (stat.S_ISREG(orig_stat.st_mode)):
+                    copy_from = f.orig_file
+                    file_data = None
+                    data_size = orig_stat.st_size
                 elif (stat.S_ISLNK(orig_stat.st_mode)):
                     file_data = os.readlink(f.orig_file)
+                    data_size = len(file_data)
                 else:
                     # No data
                     file_data = None
+                    data_size = 0
             else:
                 file_data = f.data
-
-            if (file_data is None):
-                # There is actually no data.
-                data_size = 0
-            else:
-                # There is data, but it may be a zero-length string.
-                data_size = len(file_data)
-
-            # name_size includes the terminating NUL
-            name_size = len(f.name) + 1
-
-            # This is a bit inefficient, but it has the advantage of clarity.
-            hdr_array = [ ]
-
-            # cpio, as is UNIX's wont, is almost entirely undocumented:
-            # http://refspecs.freestandards.org/LSB_3.1.0/LSB-Core-generic/LSB-Core-generic/pkgformat.html
-            # has a spec for the SVR4 portable format (-Hnewc), which is
-            # understood by newer Linux kernels as an initrd format.
-
-
-            # Magic
-            hdr_array.append("070701")
-            hdr_array.append("%08X"%f.ino)
-            hdr_array.append("%08X"%f.mode)
-            hdr_array.append("%08X"%f.uid)
-            hdr_array.append("%08X"%f.gid)
-            hdr_array.append("%08X"%f.nlink)
-            hdr_array.append("%08X"%f.mtime)
-            hdr_array.append("%08X"%data_size)
-            hdr_array.append("%08X"%os.major(f.dev))
-            hdr_array.append("%08X"%os.minor(f.dev))
-            hdr_array.append("%08X"%os.major(f.rdev))
-            hdr_array.append("%08X"%os.minor(f.rdev))
-            hdr_array.append("%08X"%name_size)
-            # And a zero checksum (?!)
-            hdr_array.append("%08x"%0)
+                if (file_data is None):
+                    data_size = 0
+                else:
+                    # There is data, but it may be a zero-length string.
+                    data_size = len(file_data)
 
             if (logProgress):
                 print "> Packing %s .. "%(f.name)
 
-            f_out.write("".join(hdr_array))
-            f_out.write(f.name)
-            f_out.write("\0")
+            # The header, the name (with its terminating NUL), and then
+            # padding to a 4-byte boundary
+            header = _newc_header(f, data_size, len(f.name) + 1, link)
+            pos += len(header) + len(f.name) + 1
+            padding = _padding(pos)
+            f_out.write('%s%s\0%s'%(header, f.name, padding))
+            pos += len(padding)
+
+            if (copy_from is not None):
+                copied = _copy_data(copy_from, f_out)
+                if (copied != data_size):
+                    raise utils.GiveUp("File %s changed size (from %d to %d bytes)"
+                                       " whilst it was being added to the CPIO"
+                                       " archive"%(copy_from, data_size, copied))
+            elif (file_data is not None):
+                f_out.write(file_data)
+            pos += data_size
 
-            # Now we need to pad to a 4-byte boundary.
-            pos = f_out.tell()
-            if (pos%4):
-                for i in range(0, 4-(pos%4)):
-                    f_out.write("\0")
+            # .. and pad again.
+            padding = _padding(pos)
+            if (padding):
+                f_out.write(padding)
+                pos += len(padding)
 
+        if (hardLinks is not None and logProgress):
+            print "> Hard links saved %d bytes"%saved
 
-            if (file_data is not None):
-                f_out.write(file_data)
+        # And that's all, folks.
+        return saved
 
-            # .. and pad again.
-            pos = f_out.tell()
-            if (pos%4):
-                for i in range(0, 4-(pos%4)):
-                    f_out.write("\0")
+# The size of the chunks in which we copy file data into an archive
+CHUNK_SIZE = 1024 * 1024
 
-            # Make very sure we throw this data away after we're done
-            # using it - it's typically several megabytes.
-            file_data = None
+# cpio, as is UNIX's wont, is almost entirely undocumented:
+# http://refspecs.freestandards.org/LSB_3.1.0/LSB-Core-generic/LSB-Core-generic/pkgformat.html
+# has a spec for the SVR4 portable format (-Hnewc), which is
+# understood by newer Linux kernels as an initrd format.
+#
+# The fields are: magic, ino, mode, uid, gid, nlink, mtime, filesize,
+# devmajor, devminor, rdevmajor, rdevminor, namesize and (a zero) check
+_NEWC_HEADER = "070701" + "%08X" * 12 + "%08x"
 
+def _newc_header(f, data_size, name_size, link=None):
+    """
+    Return the newc header for File 'f'.
 
-        f_out.close()
-        # And that's all, folks.
+    'name_size' includes the terminating NUL of the name.
+
+    If 'link' is given, it is the (dev, ino, nlink, has_data) tuple that
+    _find_hard_links() returned for 'f', and overrides those values.
+    """
+    if (link is None):
+        (dev, ino, nlink) = (f.dev, f.ino, f.nlink)
+    else:
+        (dev, ino, nlink) = link[:3]
+    return _NEWC_HEADER%(ino, f.mode, f.uid, f.gid, nlink, f.mtime,
+                         data_size, os.major(dev), os.minor(dev),
+                         os.major(f.rdev), os.minor(f.rdev), name_size, 0)
+
+def _hash_file(file_name):
+    """
+    Return the SHA1 hash of the contents of 'file_name'.
+    """
+    hasher = hashlib.sha1()
+    with open(file_name, "rb") as f_in:
+        while True:
+            data = f_in.read(CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def _find_hard_links(file_list, stats, by_content=False):
+    """
+    Work out which of the regular files in 'file_list' to store as hard links.
+
+    'stats' maps id(file) to the result of os.lstat() on its orig_file, for
+    each file that has one.
+
+    Files are linked if they have the same device and inode number or, if
+    'by_content' is true, if they have the same content. They must also have
+    the same mode, uid and gid. If the same file is in more than one set of
+    linked files (because its copies have different modes or owners), every
+    set after the first is given an inode number that is not otherwise used
+    in the archive.
+
+    Returns a dictionary mapping id(file) to a tuple (dev, ino, nlink,
+    has_data) for every regular file. For a set of linked files, they all have
+    the same 'dev' and 'ino' (normally those of the first of them), 'nlink'
+    is how many of them there are, and 'has_data' is only true for the
+    first - the Linux kernel expects the data to come with the first hard
+    link, and GNU cpio does not mind which.
+
+    Regular files that are not linked get an 'nlink' of 1, so that nothing
+    reading the archive tries to link them to anything else.
+    """
+    groups = {}
+    order = []
+    for f in file_list:
+        st = stats.get(id(f))
+        if (st is None or not stat.S_ISREG(st.st_mode)):
+            continue
+        key = (st.st_dev, st.st_ino, f.mode, f.uid, f.gid)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(f)
+
+    if by_content:
+        # Only files of the same size can have the same content, so only
+        # hash files when we must
+        by_size = {}
+        for key in order:
+            first = groups[key][0]
+            size = stats[id(first)].st_size
+            if (size > 0):
+                by_size.setdefault((size, first.mode, first.uid, first.gid),
+                                   []).append(key)
+        by_hash = {}
+        for keys in by_size.values():
+            if (len(keys) < 2):
+                continue
+            for key in keys:
+                first = groups[key][0]
+                by_hash.setdefault((_hash_file(first.orig_file),) + key[2:],
+                                   []).append(key)
+        for keys in by_hash.values():
+            # Fold the later groups into the first
+            for key in keys[1:]:
+                groups[keys[0]].extend(groups[key])
+                del groups[key]
+
+    position = dict((id(f), index) for (index, f) in enumerate(file_list))
+    for files in groups.values():
+        files.sort(key=lambda f: position[id(f)])
+    # Every (dev, ino) already in the archive, so that we don't reuse one
+    used = set((f.dev, f.ino) for f in file_list)
+    used.update((st.st_dev, st.st_ino) for st in stats.values())
+    given = set()
+    next_ino = 1
+
+    links = {}
+    for files in sorted(groups.values(), key=lambda files: position[id(files[0])]):
+        first = files[0]
+        st = stats[id(first)]
+        dev, ino = st.st_dev, st.st_ino
+        if ((dev, ino) in given):
+            # The same file is in another group (with a different mode or
+            # owner), and anything reading the archive would link the two
+            # groups together if they shared an inode number
+            while ((dev, next_ino) in used):
+                next_ino += 1
+            ino = next_ino
+            used.add((dev, ino))
+        given.add((dev, ino))
+        for f in files:
+            links[id(f)] = (dev, ino, len(files), f is first)
+    return links
+
+def _padding(pos):
+    """
+    Return the NULs needed to pad from 'pos' to a 4-byte boundary.
+    """
+    return "\0" * (-pos % 4)
+
+def _copy_data(file_name, f_out):
+    """
+    Copy the contents of 'file_name' to the file object 'f_out', in chunks.
 
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    with open(file_name, "rb") as f_in:
+        while True:
+            data = f_in.read(CHUNK_SIZE)
+            if not data:
+                break
+            f_out.write(data)
+            copied += len(data)
+    return copied
 
 # End file.
 
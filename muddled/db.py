@@ -3,9 +3,12 @@ Contains code which maintains the muddle database,
 held in root/.muddle
 """
 
+import atexit
 import errno
+import fcntl
 import os
 import re
+import shutil
 import xml.dom
 import xml.dom.minidom
 import traceback
@@ -1173,28 +1176,57 @@ class Database(object):
         return os.path.join(dir, leaf)
 
 
-    def tag_file_name(self, label):
+    def tag_root(self, label):
         """
-        If this file exists, the given label is asserted.
+        Return the root directory of the (sub)domain that 'label' belongs to.
 
-        To make life a bit easier, we group labels.
+        This is the directory whose .muddle directory holds the label's tag.
         """
-
         if label.domain:
-            root = os.path.join(self.root_path, domain_subpath(label.domain))
+            return os.path.join(self.root_path, domain_subpath(label.domain))
         else:
-            root = self.root_path
+            return self.root_path
 
+    def tag_key(self, label):
+        """
+        Return the key for the given label within its domain's tag store.
+
+        This is the path of its tag file relative to .muddle/tags.
+        """
         if (label.role is None):
             leaf = label.tag
         else:
             leaf = "%s-%s"%(label.role, label.tag)
 
-        return os.path.join(root,
+        return os.path.join(label.type, label.name, leaf)
+
+    def tag_file_name(self, label):
+        """
+        If this file exists, the given label is asserted.
+
+        To make life a bit easier, we group labels.
+
+        (This is only meaningful for domains whose tags are stored as
+        individual files - see TagDirectory.)
+        """
+        return os.path.join(self.tag_root(label),
                             ".muddle",
                             "tags",
-                            label.type,
-                            label.name, leaf)
+                            self.tag_key(label))
+
+    def log_file_name(self, label):
+        """
+        Return the name of the file that logs the commands run to build
+        'label', and their output.
+
+        Logs for all domains are kept in the top-level .muddle/logs
+        directory, laid out in the same way as tags.
+        """
+        parts = [self.root_path, '.muddle', 'logs']
+        if label.domain:
+            parts.append(domain_subpath(label.domain))
+        parts.append('%s.log'%self.tag_key(label))
+        return os.path.join(*parts)
 
     def is_tag(self, label):
         """
@@ -1203,7 +1235,7 @@ class Database(object):
         if (label.transient):
             return (label in self.local_tags)
         else:
-            return (os.path.exists(self.tag_file_name(label)))
+            return get_tag_store(self.tag_root(label)).is_set(self.tag_key(label))
 
     def set_tag(self, label):
         """
@@ -1216,22 +1248,28 @@ class Database(object):
         if (label.transient):
             self.local_tags.add(label)
         else:
-            file_name = self.tag_file_name(label)
-            (dir,name) = os.path.split(file_name)
-            utils.ensure_dir(dir)
-            f = open(file_name, "w+")
-            f.write(utils.iso_time())
-            f.write("\n")
-            f.close()
+            get_tag_store(self.tag_root(label)).set(self.tag_key(label))
 
     def clear_tag(self, label):
         if (label.transient):
             self.local_tags.discard(label)
         else:
-            try:
-                os.remove(self.tag_file_name(label))
-            except:
-                pass
+            get_tag_store(self.tag_root(label)).clear(self.tag_key(label))
+
+    def flush_tags(self):
+        """
+        Make sure any tag changes we have made are written to disc.
+
+        This should be done before anything else (another muddle process,
+        for instance) might want to look at the tags.
+        """
+        flush_tag_stores()
+
+    def refresh_tags(self):
+        """
+        Notice any changes to tags made by other processes.
+        """
+        refresh_tag_stores()
 
     def commit(self):
         """
@@ -1244,7 +1282,265 @@ class Database(object):
         self.Description_pathfile.commit()
         self.DescriptionBranch_pathfile.commit()
         self.VersionsRepository_pathfile.commit()
+        self.flush_tags()
+
+
+class TagDirectory(object):
+    """
+    Tags stored as individual files, in .muddle/tags.
+
+    This is the traditional way of storing tags. Each asserted label has
+    a file called .muddle/tags/<type>/<name>/<role>-<tag> (or just <tag> if
+    the label has no role), containing the time it was asserted.
+
+    Tag keys (see Database.tag_key) are the paths of those files, relative
+    to .muddle/tags.
+    """
+
+    is_log = False
+
+    def __init__(self, root_path):
+        self.tags_dir = os.path.join(root_path, '.muddle', 'tags')
+
+    def is_set(self, key):
+        return os.path.exists(os.path.join(self.tags_dir, key))
+
+    def set(self, key, when=None):
+        file_name = os.path.join(self.tags_dir, key)
+        utils.ensure_dir(os.path.dirname(file_name))
+        with open(file_name, "w+") as f:
+            f.write(when or utils.iso_time())
+            f.write("\n")
+
+    def clear(self, key):
+        try:
+            os.remove(os.path.join(self.tags_dir, key))
+        except OSError:
+            pass
+
+    def items(self):
+        """
+        Return a dictionary of tag key : time asserted, for all our tags.
+        """
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(self.tags_dir):
+            for name in filenames:
+                file_name = os.path.join(dirpath, name)
+                with open(file_name) as f:
+                    when = f.read().strip()
+                result[os.path.relpath(file_name, self.tags_dir)] = when
+        return result
+
+    def flush(self):
+        pass
+
+    def refresh(self):
+        pass
+
+class TagLog(object):
+    """
+    Tags stored in a single append-only file, .muddle/TagLog.
+
+    Each line of the file is either::
+
+        +<key> <time asserted>
+
+    or::
+
+        -<key>
+
+    saying that the tag with that key (see Database.tag_key) has been set or
+    cleared. Later lines override earlier ones.
+
+    We read the file once, when first asked about a tag, and thereafter
+    answer questions from memory. Changes are written out when flush() is
+    called, or when muddle exits. We only ever append to the file, and hold
+    a lock on it (with fcntl.lockf, which also works over NFS) whilst we do
+    so, or whilst we read it, so several muddle processes can safely update
+    the same tag log, as long as each calls refresh() if it needs to know
+    what the others have done.
+    """
+
+    is_log = True
+
+    def __init__(self, root_path):
+        self.file_name = os.path.join(root_path, '.muddle', 'TagLog')
+        self.tags = None
+        self.offset = 0
+        self.pending = []
+        self.registered = False
+
+    def refresh(self):
+        """
+        Write our changes, and then read any changes made by other processes.
+        """
+        self.flush()
+        if self.tags is None:
+            self.tags = {}
+        try:
+            with open(self.file_name, 'rb') as f:
+                fcntl.lockf(f, fcntl.LOCK_SH)
+                f.seek(self.offset)
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        # Ignore any incomplete line being written by another process
+        # at the moment - we'll see it next time
+        end = data.rfind('\n') + 1
+        self.offset += end
+        for line in data[:end].splitlines():
+            if line.startswith('+'):
+                key, _, when = line[1:].partition(' ')
+                self.tags[key] = when
+            elif line.startswith('-'):
+                self.tags.pop(line[1:], None)
+
+    def is_set(self, key):
+        if self.tags is None:
+            self.refresh()
+        return key in self.tags
+
+    def _record(self, line):
+        self.pending.append(line)
+        if not self.registered:
+            # Make sure we don't forget anything when muddle exits
+            atexit.register(self.flush)
+            self.registered = True
+
+    def set(self, key, when=None):
+        if self.tags is None:
+            self.refresh()
+        when = when or utils.iso_time()
+        self.tags[key] = when
+        self._record('+%s %s\n'%(key, when))
+
+    def clear(self, key):
+        if self.tags is None:
+            self.refresh()
+        if key in self.tags:
+            del self.tags[key]
+            self._record('-%s\n'%key)
+
+    def items(self):
+        if self.tags is None:
+            self.refresh()
+        return dict(self.tags)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = ''.join(self.pending)
+        self.pending = []
+        fd = os.open(self.file_name, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+        try:
+            # O_APPEND on its own is not enough over NFS, where two clients
+            # appending at once can overwrite each other's lines. Closing the
+            # file releases the lock
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
+
+    def rewrite(self, tags):
+        """
+        Replace the entire content of the tag log with the given tags.
+
+        'tags' is a dictionary of tag key : time asserted.
+
+        This is only intended for use when nothing else is using the log
+        (in particular, another process could lose changes it makes while
+        we are doing this).
+        """
+        self.pending = []
+        new_name = self.file_name + '.new'
+        with open(new_name, 'wb') as f:
+            for key in sorted(tags.keys()):
+                f.write('+%s %s\n'%(key, tags[key]))
+            size = f.tell()
+        os.rename(new_name, self.file_name)
+        self.tags = dict(tags)
+        self.offset = size
+
+# Tag stores, by (normalised) domain root directory. We keep these at module
+# level so that all the Databases (for instance, of subdomains) share them
+_tag_stores = {}
+
+def get_tag_store(root_path):
+    """
+    Return the tag store for the domain with the given root directory.
+
+    This is a TagLog if the domain has a .muddle/TagLog file, otherwise
+    a TagDirectory.
+    """
+    root_path = os.path.normpath(root_path)
+    store = _tag_stores.get(root_path)
+    if store is None:
+        if os.path.exists(os.path.join(root_path, '.muddle', 'TagLog')):
+            store = TagLog(root_path)
+        else:
+            store = TagDirectory(root_path)
+        _tag_stores[root_path] = store
+    return store
+
+def flush_tag_stores():
+    for store in _tag_stores.values():
+        store.flush()
+
+def refresh_tag_stores():
+    for store in _tag_stores.values():
+        store.refresh()
 
+def convert_tag_store(root_path, to_log):
+    """
+    Convert the tags for the domain at 'root_path' to a different store.
+
+    If 'to_log' is true, then the tags are moved from .muddle/tags to
+    .muddle/TagLog, otherwise the other way round.
+
+    Returns the number of tags moved, or None if the tags were already
+    stored in the requested way.
+    """
+    root_path = os.path.normpath(root_path)
+    old = get_tag_store(root_path)
+    if old.is_log == to_log:
+        return None
+
+    old.flush()
+    tags = old.items()
+    if to_log:
+        new = TagLog(root_path)
+        new.rewrite(tags)
+        shutil.rmtree(old.tags_dir, ignore_errors=True)
+    else:
+        new = TagDirectory(root_path)
+        for key, when in tags.items():
+            new.set(key, when)
+        os.remove(old.file_name)
+    _tag_stores[root_path] = new
+    return len(tags)
+
+def clear_tags_of_types(root_path, types):
+    """
+    Clear all the tags with labels of the given types, for the given domain.
+
+    For a TagDirectory, this is just the same as deleting the directories
+    .muddle/tags/<type>, for each type.
+    """
+    store = get_tag_store(root_path)
+    if store.is_log:
+        store.flush()
+        tags = store.items()
+        for key in tags.keys():
+            if key.split(os.sep)[0] in types:
+                del tags[key]
+        store.rewrite(tags)
+    else:
+        for type in types:
+            shutil.rmtree(os.path.join(store.tags_dir, type), ignore_errors=True)
 
 class PathFile(object):
     """
@@ -0,0 +1,394 @@
+"""
+Utilities to read Debian package (.deb) files, without needing dpkg.
+
+A .deb file is an "ar" archive, containing (in order) a "debian-binary"
+member, a "control.tar" and a "data.tar", each of the tar files possibly
+compressed (for instance, "data.tar.xz"). The data.tar holds the files that
+the package installs.
+
+extract() streams the data.tar straight out of the .deb, writing each file
+to wherever it is wanted as it goes, so nothing is unpacked to a temporary
+directory first, and nothing needs to be copied or walked afterwards.
+
+Python can decompress gzip and bzip2 itself. For xz, lzma and zstd, we pipe
+the data through the "xz" or "zstd" program.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+from muddled.utils import GiveUp, current_env
+
+AR_MAGIC = '!<arch>\n'
+
+# How tarfile should read each sort of data.tar, if it can do so itself
+_TAR_MODES = {'': 'r|', '.gz': 'r|gz', '.bz2': 'r|bz2'}
+
+# Otherwise, the program to decompress it with
+_DECOMPRESSORS = {'.xz':   ['xz', '-dc'],
+                  '.lzma': ['xz', '-dc', '--format=lzma'],
+                  '.zst':  ['zstd', '-dc']}
+
+class _MemberFile(object):
+    """
+    A file-like object for reading the data of one member of an ar archive.
+    """
+
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        if not size:
+            return ''
+        data = self.fd.read(size)
+        self.left -= len(data)
+        return data
+
+def ar_members(fd, path):
+    """
+    Yield (name, size) for each member of the ar archive open as 'fd'.
+
+    'path' is the archive's name, for use in error messages.
+
+    When each member is yielded, 'fd' is at the start of its data, which the
+    caller may read as much of as it likes.
+    """
+    if fd.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise GiveUp('%s is not a Debian package (it is not an ar archive)'%path)
+    offset = len(AR_MAGIC)
+    while True:
+        fd.seek(offset)
+        header = fd.read(60)
+        if not header:
+            return
+        if len(header) != 60 or header[58:60] != '`\n':
+            raise GiveUp('%s is corrupt: bad ar member header at'
+                         ' offset %d'%(path, offset))
+        name = header[:16].rstrip()
+        if name.endswith('/'):          # as GNU ar writes them
+            name = name[:-1]
+        try:
+            size = int(header[48:58])
+        except ValueError:
+            raise GiveUp('%s is corrupt: bad ar member size at'
+                         ' offset %d'%(path, offset))
+        yield name, size
+        # Members start on an even offset
+        offset += 60 + size + (size & 1)
+
+class _DataTar(object):
+    """
+    Open the data.tar in the .deb open as 'fd', as a TarFile to be read in
+    order (which is all we need, and all that a pipe allows).
+    """
+
+    def __init__(self, fd, path):
+        self.fd = fd
+        self.path = path
+        self.proc = None
+        self.feeder = None
+
+    def __enter__(self):
+        for name, size in ar_members(self.fd, self.path):
+            if name.startswith('data.tar'):
+                break
+        else:
+            raise GiveUp('%s has no data.tar member'%self.path)
+
+        member = _MemberFile(self.fd, size)
+        suffix = name[len('data.tar'):]
+        if suffix in _TAR_MODES:
+            self.tar = tarfile.open(fileobj=member, mode=_TAR_MODES[suffix])
+            return self.tar
+        if suffix not in _DECOMPRESSORS:
+            raise GiveUp('%s: unsupported data member %s'%(self.path, name))
+
+        cmd = _DECOMPRESSORS[suffix]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         env=current_env())
+        except OSError as e:
+            raise GiveUp('Unable to run "%s" to decompress %s in %s: %s'%(
+                         ' '.join(cmd), name, self.path, e))
+
+        def feed():
+            try:
+                while True:
+                    data = member.read(64*1024)
+                    if not data:
+                        break
+                    self.proc.stdin.write(data)
+            except IOError:
+                # The decompressor stopped reading - it will say why
+                pass
+            finally:
+                self.proc.stdin.close()
+
+        self.feeder = threading.Thread(target=feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+        self.tar = tarfile.open(fileobj=self.proc.stdout, mode='r|')
+        return self.tar
+
+    def __exit__(self, etype, value, tb):
+        self.tar.close()
+        if self.proc:
+            # Read anything left, so the decompressor can finish
+            while self.proc.stdout.read(64*1024):
+                pass
+            self.feeder.join()
+            retcode = self.proc.wait()
+            if retcode and etype is None:
+                raise GiveUp('Decompressing the data in %s failed with'
+                             ' return code %d'%(self.path, retcode))
+        return False
+
+def _member_path(name, deb_path):
+    """
+    Return the path of tar member 'name' relative to the package's root.
+
+    >>> _member_path('./usr/lib/', 'x.deb')
+    'usr/lib'
+    >>> _member_path('./', 'x.deb')
+    ''
+    >>> _member_path('./usr/../../etc/passwd', 'x.deb')
+    Traceback (most recent call last):
+    ...
+    GiveUp: x.deb contains "./usr/../../etc/passwd", which is outside the package
+    """
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise GiveUp('%s contains "%s", which is outside the'
+                     ' package'%(deb_path, name))
+    return '/'.join(parts)
+
+def _targets(name, places):
+    """
+    Return where the package's file 'name' should be written, for each of
+    'places' (None for each place that does not want it).
+
+    >>> _targets('usr/lib/libz.so', [('', '/obj/obj'), ('usr/lib', '/obj/lib'),
+    ...                              ('usr/include', '/obj/include')])
+    ['/obj/obj/usr/lib/libz.so', '/obj/lib/libz.so', None]
+    >>> _targets('usr/lib', [('usr/lib', '/obj/lib'), ('usr/libexec', '/x')])
+    ['/obj/lib', None]
+    """
+    targets = []
+    for prefix, directory in places:
+        if not prefix:
+            targets.append(os.path.join(directory, name) if name else directory)
+        elif name == prefix:
+            targets.append(directory)
+        elif name.startswith(prefix + '/'):
+            targets.append(os.path.join(directory, name[len(prefix)+1:]))
+        else:
+            targets.append(None)
+    return targets
+
+def rewritten_link(target, path, link_root):
+    """
+    Return what symbolic link 'path', to 'target', should refer to instead,
+    if absolute links are relative to 'link_root'.
+
+    An absolute link to /<where> becomes a link to <link_root>/<where>, and
+    a relative link becomes an absolute link to the same place.
+
+    >>> rewritten_link('/lib/libz.so.1', '/obj/lib/libz.so', '/obj')
+    '/obj/lib/libz.so.1'
+    >>> rewritten_link('libz.so.1', '/obj/obj/usr/lib/libz.so', '/obj')
+    '/obj/obj/usr/lib/libz.so.1'
+    """
+    if target.startswith('/'):
+        return os.path.join(link_root, target[1:])
+    return os.path.join(os.path.dirname(path), target)
+
+def _set_mode_and_time(path, info):
+    os.chmod(path, info.mode & 07777)
+    os.utime(path, (info.mtime, info.mtime))
+
+def _copy_file(src, dst, info):
+    shutil.copyfile(src, dst)
+    _set_mode_and_time(dst, info)
+
+class _Extraction(object):
+    """
+    The state of one call of extract().
+    """
+
+    def __init__(self, deb_path, places, link_root):
+        self.deb_path = deb_path
+        self.places = [(prefix, os.path.abspath(directory))
+                       for prefix, directory in places]
+        self.link_root = link_root
+        self.written = []
+        # Package path -> where we first wrote it, for hard links
+        self.first_written = {}
+        # Directories whose mode and time we must set when we've finished,
+        # since we may not be able to write into them once we have (and
+        # writing into them would change their time anyway)
+        self.dir_modes = []
+        # Directories we know are inside the place they should be
+        self.safe_dirs = set()
+        for prefix, directory in self.places:
+            self.safe_dirs.add(os.path.realpath(directory))
+
+    def make_parent(self, path, directory):
+        """
+        Make sure the directory containing 'path' exists, and is inside
+        'directory' (and not, for instance, reached through a symbolic link
+        to somewhere else entirely).
+        """
+        parent = os.path.dirname(path)
+        if parent in self.safe_dirs:
+            return
+        if path == directory:
+            # The place itself, which is wherever our caller asked for
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            return
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        real = os.path.realpath(parent)
+        top = os.path.realpath(directory)
+        if real != top and not real.startswith(top + os.sep):
+            raise GiveUp('%s: not writing %s, since it would be outside'
+                         ' %s'%(self.deb_path, path, directory))
+        self.safe_dirs.add(parent)
+
+    def remove_old(self, path):
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+        elif os.path.exists(path):
+            raise GiveUp('%s: cannot replace directory %s'%(self.deb_path, path))
+
+    def member(self, tar, info):
+        name = _member_path(info.name, self.deb_path)
+        targets = _targets(name, self.places)
+        wanted = [(place, path) for place, path in zip(self.places, targets) if path]
+        if not wanted:
+            return
+
+        if info.isdir():
+            for (prefix, directory), path in wanted:
+                if os.path.islink(path):
+                    # Whatever it refers to is not ours to change (and
+                    # make_parent will check anything we write inside it)
+                    continue
+                if not os.path.isdir(path):
+                    self.make_parent(path, directory)
+                    self.remove_old(path)
+                    os.mkdir(path)
+                self.dir_modes.append((path, info))
+                self.written.append(path)
+            return
+
+        if not (info.isfile() or info.issym() or info.islnk()):
+            # Devices, fifos and the like are not ours to make
+            return
+
+        done = []
+        for (prefix, directory), path in wanted:
+            if info.issym() and os.path.isdir(path) and not os.path.islink(path):
+                # A link replacing one of our own directories (for
+                # instance, "lib" as a link to "usr/lib"), which we keep
+                continue
+            self.make_parent(path, directory)
+            self.remove_old(path)
+            if info.issym():
+                target = info.linkname
+                if self.link_root is not None:
+                    target = rewritten_link(target, path, self.link_root)
+                os.symlink(target, path)
+            elif info.islnk():
+                self.hard_link(info, path, targets)
+            elif done:
+                # We already have the data - copying it is cheaper than
+                # reading it again (which a pipe won't let us do anyway)
+                _copy_file(done[0], path, info)
+            else:
+                src = tar.extractfile(info)
+                with open(path, 'wb') as fd:
+                    shutil.copyfileobj(src, fd, 64*1024)
+                _set_mode_and_time(path, info)
+            done.append(path)
+
+        if done:
+            self.first_written.setdefault(name, done[0])
+            self.written.extend(done)
+
+    def hard_link(self, info, path, targets):
+        """
+        Make 'path' a hard link to what the package links it to, preferring
+        our copy of that in the same place, if we made one.
+        """
+        linked = _member_path(info.linkname, self.deb_path)
+        source = None
+        index = targets.index(path)
+        linked_targets = _targets(linked, self.places)
+        if linked_targets[index] and os.path.lexists(linked_targets[index]):
+            source = linked_targets[index]
+        else:
+            source = self.first_written.get(linked)
+        if source is None:
+            raise GiveUp('%s: %s is a hard link to %s, which we have not'
+                         ' extracted'%(self.deb_path, info.name, info.linkname))
+        try:
+            os.link(source, path)
+        except OSError:
+            _copy_file(source, path, info)
+
+    def finish(self):
+        # Deepest first, so that setting a directory's time is not undone
+        # by changing something inside it
+        for path, info in reversed(self.dir_modes):
+            _set_mode_and_time(path, info)
+
+def extract(deb_path, places, link_root=None):
+    """
+    Extract the files in Debian package 'deb_path'.
+
+    'places' is a sequence of (prefix, directory) pairs. Each file in the
+    package whose path (relative to the package's root, e.g., "usr/lib/libz.so")
+    is 'prefix', or starts with 'prefix/', is written to 'directory', with
+    'prefix' removed from its path. A file may be wanted by several places.
+    A prefix of '' matches everything, so [('', install_dir)] does the same
+    as "dpkg-deb -X <deb_path> <install_dir>".
+
+    If 'link_root' is given, then symbolic links are rewritten as they are
+    extracted, as described in rewritten_link().
+
+    Devices, fifos and the like are not extracted. File ownership is not
+    set.
+
+    Returns a list of the paths written (files, links and directories).
+    """
+    extraction = _Extraction(deb_path, places, link_root)
+    with open(deb_path, 'rb') as fd:
+        with _DataTar(fd, deb_path) as tar:
+            for info in tar:
+                extraction.member(tar, info)
+    extraction.finish()
+    return extraction.written
+
+def file_hash(path):
+    """
+    Return the SHA1 hash of the content of the file 'path', as a hex string.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(1024*1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+# End file.
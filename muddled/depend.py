@@ -3,11 +3,29 @@ Dependency sets and dependency management
 """
 
 import re
-import copy
 
 from muddled.utils import GiveUp, MuddleBug, label_type_to_tag, LabelType, \
         sort_domains, total_ordering
 
+# Our flyweight cache of interned labels (see Label._intern). This maps the
+# parts of a label that contribute to its hash (plus its flags) to a
+# secondary index by domain, so labels that differ only by domain do not
+# have to be told apart by comparing them, one by one.
+_interned = {}
+
+# When the cache gets this big, we just start it again
+INTERNED_LABELS_LIMIT = 20000
+
+def clear_label_cache():
+    """
+    Forget all the interned labels.
+
+    This must be done before loading a sub-build, and before changing the
+    domain of labels, so that labels in different domains never share the
+    same instance.
+    """
+    _interned.clear()
+
 @total_ordering
 class Label(object):
     """
@@ -71,7 +89,15 @@ class Label(object):
 
     If you're implementing a new copy-constructor and changing the new
     instance's label before returning it, don't forget to call rehash().
-    If you don't, Really Bad Things will happen.
+    If you don't, Really Bad Things will happen. Better still, use _intern().
+
+    Labels are made by copying other labels (for instance, with copy_with_tag)
+    a great deal, so the copy-constructors "intern" the labels they return.
+    This means that equal labels are usually the same instance, which saves
+    memory, and makes comparing them quicker. It is still necessary to
+    compare labels with "==", though, since labels made by calling Label()
+    directly are not interned. Labels have __slots__, so it is not possible
+    to add other attributes to them.
 
 
     .. note:: The *flags* on a label are not immutable, and are regarded as
@@ -88,6 +114,9 @@ class Label(object):
               work as the same key in a dictionary (for instance).
     """
 
+    __slots__ = ('_type', '_domain', '_name', '_role', '_tag', '_hashcode',
+                 'transient', 'system', '_unswept')
+
     # Let's make a record of what conventional flag characters are
     FLAG_SYSTEM       = 'S'
     FLAG_TRANSIENT    = 'T'
@@ -279,49 +308,30 @@ class Label(object):
         All the non-wildcard parts of 'target' are copied, to overwrite
         the equivalent parts of the new label.
         """
-        new = self.copy()
-
         #print "unify src = %s"%self
-        if (target._type != "*"):
-            new._type = target._type
-
-        if (target._domain != "*"):
-            new._domain = target._domain
-
-        if (target._name != "*"):
-            new._name = target._name
-
-        if (target._role != "*"):
-            new._role = target._role
-
-        if (target._tag != "*"):
-            new._tag = target._tag
-
-        new.system = target.system
-        new.transient = target.transient
-        new.rehash()
-        return new
+        return Label._intern(
+                self._type if target._type == "*" else target._type,
+                self._name if target._name == "*" else target._name,
+                self._role if target._role == "*" else target._role,
+                self._tag if target._tag == "*" else target._tag,
+                target.transient, target.system,
+                self._domain if target._domain == "*" else target._domain)
 
     def copy_with_tag(self, new_tag, system = None, transient = None):
         """
         Return a copy of self, with the tag changed to new_tag.
         """
         Label._check_part('tag', new_tag)
-        cp = self.copy()
-        cp._tag = new_tag
-        cp.system = system
-        cp.transient = transient
-        cp.rehash()
-        return cp
+        return Label._intern(self._type, self._name, self._role, new_tag,
+                             transient, system, self._domain)
 
     def copy_with_role(self, new_role):
         """
         Return a copy of self, with the role changed to new_role.
         """
         Label._check_part('role', new_role)
-        cp = self.copy()
-        cp._role = new_role
-        return cp
+        return Label._intern(self._type, self._name, new_role, self._tag,
+                             self.transient, self.system, self._domain)
 
     def copy_with_domain(self, new_domain):
         """
@@ -335,9 +345,8 @@ class Label(object):
         if new_domain is not None:
             # Check it looks like a valid domain name
             Label.split_domain(new_domain)
-        cp = self.copy()
-        cp._domain = new_domain
-        return cp
+        return Label._intern(self._type, self._name, self._role, self._tag,
+                             self.transient, self.system, new_domain)
 
     def is_definite(self):
         """
@@ -497,8 +506,65 @@ class Label(object):
     def copy(self):
         """
         Return a copy of this label.
+
+        The copy is always a new instance (it is not interned), and so may
+        safely be amended (but see rehash()).
+        """
+        cp = object.__new__(Label)
+        cp._type = self._type
+        cp._domain = self._domain
+        cp._name = self._name
+        cp._role = self._role
+        cp._tag = self._tag
+        cp._hashcode = self._hashcode
+        cp.transient = self.transient
+        cp.system = self.system
+        cp._unswept = self._unswept
+        return cp
+
+    @staticmethod
+    def _intern(type, name, role, tag, transient, system, domain):
         """
-        return copy.copy(self)
+        Return a label with the given parts, from our cache if we can.
+
+        Note that the parts are *not* checked, so they must come from an
+        existing label, or have been checked already.
+
+        For instance:
+
+            >>> a = Label._intern('package', 'fred', None, 'built', False, False, 'x')
+            >>> b = Label._intern('package', 'fred', None, 'built', False, False, 'x')
+            >>> a is b
+            True
+            >>> c = Label._intern('package', 'fred', None, 'built', False, False, None)
+            >>> a is c
+            False
+            >>> c
+            Label('package', 'fred', role=None, tag='built')
+        """
+        key = (type, name, role, tag, bool(transient), bool(system))
+        domains = _interned.get(key)
+        if domains is None:
+            if len(_interned) >= INTERNED_LABELS_LIMIT:
+                _interned.clear()
+            domains = _interned[key] = {}
+        else:
+            label = domains.get(domain)
+            if label is not None:
+                return label
+
+        label = object.__new__(Label)
+        label._type = type
+        label._domain = domain
+        label._name = name
+        label._role = role
+        label._tag = tag
+        label._hashcode = hash( (type, name, role, tag) )
+        label.transient = transient
+        label.system = system
+        label._unswept = False
+        domains[domain] = label
+        return label
 
     def __repr__(self):
         parts = [repr(self._type),
@@ -574,7 +640,9 @@ class Label(object):
 
         *Does* take the domains (if any) into account.
         """
-        if self._type != other._type:
+        if self is other:
+            return True
+        elif self._type != other._type:
             return False
         elif self._domain != other._domain:
             return False
@@ -588,6 +656,8 @@ class Label(object):
             return True
 
     def __ne__(self, other):
+        if self is other:
+            return False
         return not self.__eq__(other)
 
     def __lt__(self, other):
@@ -625,12 +695,26 @@ class Label(object):
         Returns the cached hashcode for a label (set up in __init__).
         The relevant fields are immutable (see hashcode), so this is valid.
 
-        Note that there are a couple of mutating-copy-constructors lurking
-        in this class. If you add a new one you are on your honour to update
-        the cache by calling self._hashcode = self.hashcode().
+        Note that the domain does not contribute to the hash, since it may
+        be changed (see _change_domain). Labels that differ only by domain
+        thus have the same hash. We avoid that mattering in our own cache of
+        interned labels by indexing them by domain separately.
+
+        If you add a new mutating-copy-constructor, you are on your honour to
+        update the cache by calling self.rehash().
         """
         return self._hashcode
 
+    def __reduce__(self):
+        """
+        Pickle a label as the arguments needed to construct it.
+
+        This means that an unpickled label is hashable as soon as it exists,
+        which matters when it is a dictionary key in a pickled object graph.
+        """
+        return (Label, (self._type, self._name, self._role, self._tag,
+                        self.transient, self.system, self._domain))
+
     def rehash(self):
         """
         Calculate the hash for a label.
@@ -658,7 +742,10 @@ class Label(object):
             >>> print l
             a:b{c}/d[D]
 
+        Since this is the first step in changing the domain of labels, it
+        also forgets our interned labels (see clear_label_cache()).
         """
+        _interned.clear()
         self._unswept = True
 
     def _change_domain(self, domain, verbose=False):
@@ -874,8 +961,12 @@ class Label(object):
             transient = Label.FLAG_TRANSIENT in flags
             system    = Label.FLAG_SYSTEM in flags
 
-        return Label(type, name, role=role, tag=tag, transient=transient,
-                     system=system, domain=domain)
+        # Our regular expression has already checked all of the parts except
+        # for the nesting of the domain
+        if domain is not None:
+            Label.split_domain(domain)
+
+        return Label._intern(type, name, role, tag, transient, system, domain)
 
     @staticmethod
     def from_fragment(fragment, default_type, default_role=None, default_domain=None):
@@ -979,6 +1070,10 @@ class Action(object):
 
         * in_deps -  Is the set whose dependencies have been satisified.
 
+        The environment for building the label is not in os.environ, but
+        is used by the utils.runX() functions, and is returned by
+        utils.current_env().
+
         Returns True on success, False or throw otherwise.
         """
         pass
@@ -1061,6 +1156,10 @@ class Rule(object):
             raise MuddleBug("Attempt to create a rule with an object rule "
                             "which isn't an action but a %s."%(action.__class__.__name__))
 
+        # The RuleSets we have been added to. They index our dependencies,
+        # so need telling when we gain a new one.
+        self._rulesets = []
+
     def replace_target(self, new_t):
         self.target = new_t
 
@@ -1111,6 +1210,8 @@ class Rule(object):
         Add a dependency on the given Label.
         """
         self.deps.add(label)
+        for ruleset in self._rulesets:
+            ruleset._index_dependency(self, label)
 
     def merge(self, deps):
         """
@@ -1181,6 +1282,16 @@ class Rule(object):
         # XXX string representation (for instance)?
         return hash(self.target) | hash(self.action)
 
+    def __getstate__(self):
+        # Our RuleSets re-register themselves when they are unpickled
+        state = self.__dict__.copy()
+        del state['_rulesets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rulesets = []
+
     def to_string(self, showSystem = True, showUser = True):
         """
         Return a string representing this dependency set.
@@ -1234,6 +1345,11 @@ class Rule(object):
         return " ".join(output)
 
 
+# The parts of a label that RuleSet indexes its targets by, in order
+_LABEL_PARTS = ('_type', '_name', '_role', '_tag', '_domain')
+
+_NO_LABELS = frozenset()
+
 class RuleSet(object):
     """
     A collection of rules that encapsulate how you can get from A to B.
@@ -1242,9 +1358,10 @@ class RuleSet(object):
     targets are merged - it's assumed that the objects will be
     the same.
 
-    Informally, we cache some of the label look-ups for a major
-    improvement in build time; the half billion lookups were taking
-    over a hundred seconds to do!
+    Informally, we index our targets by each part of their labels, so that
+    we can find the targets matching a wildcarded label without trying
+    every one; the half billion lookups were taking over a hundred seconds
+    to do!
 
     CAVEAT: Be aware that new rules (when added) can be merged into existing
     rules.  Since we don't *copy* rules when we add them, this could be a cause
@@ -1253,7 +1370,182 @@ class RuleSet(object):
 
     def __init__(self):
         self.map = { }
-        self.cache = { }
+
+        # 'targets_by_part' has a dictionary for each of _LABEL_PARTS,
+        # mapping each value of that part to the set of our targets with
+        # that value. A target with a wildcard ('*') in a part is in the
+        # '*' set for that part, since it matches any value.
+        #
+        # Since it uses domains, this index must be rebuilt (with
+        # _rebuild_index) if the domain of our targets is changed.
+        self.targets_by_part = tuple({ } for part in _LABEL_PARTS)
+
+        # Our generation is incremented whenever our rules change, and
+        # 'plans' caches the results of needed_to_build() for the generation
+        # 'plans_generation'.
+        self.generation = 0
+        self.plans = { }
+        self.plans_generation = 0
+
+        # We also keep a "reverse" index of dependencies, so that we can
+        # find the rules that depend on a label without looking at every
+        # dependency of every rule:
+        #
+        # * 'dependents' maps each dependency label to the set of rules
+        #   that depend on it.
+        # * 'dependencies_by_name' maps (type, name) to the set of dependency
+        #   labels with that type and name.
+        # * 'wildcard_dependencies' is the set of dependency labels with a
+        #   wildcarded type or name, which may match any (type, name).
+        #
+        # Note that a label's hash does not include its domain, and we do
+        # not use the domain in our keys, so the domain changes made when a
+        # build is included as a subdomain do not upset these.
+        self.dependents = { }
+        self.dependencies_by_name = { }
+        self.wildcard_dependencies = set()
+
+    def __getstate__(self):
+        # Don't pickle our caches and indices - they are cheap to recreate,
+        # and, since they use Rules as keys, may not be unpickled correctly
+        return {'map':self.map}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.map = state['map']
+        self._rebuild_index()
+
+    def _index_dependency(self, rule, label):
+        """
+        Remember that 'rule' depends on 'label'.
+
+        This is called by Rule.add(), as well as by ourselves.
+        """
+        self.generation += 1
+        rules = self.dependents.get(label)
+        if rules is None:
+            self.dependents[label] = set([rule])
+            key = (label.type, label.name)
+            labels = self.dependencies_by_name.get(key)
+            if labels is None:
+                self.dependencies_by_name[key] = set([label])
+            else:
+                labels.add(label)
+            if label.type == '*' or label.name == '*':
+                self.wildcard_dependencies.add(label)
+        else:
+            rules.add(rule)
+
+    def _index_target(self, label):
+        """
+        Add 'label' to our index of targets.
+        """
+        for part, index in zip(_LABEL_PARTS, self.targets_by_part):
+            value = getattr(label, part)
+            labels = index.get(value)
+            if labels is None:
+                index[value] = set([label])
+            else:
+                labels.add(label)
+
+    def _unindex_target(self, label):
+        """
+        Remove 'label' from our index of targets.
+        """
+        for part, index in zip(_LABEL_PARTS, self.targets_by_part):
+            value = getattr(label, part)
+            labels = index[value]
+            labels.discard(label)
+            if not labels:
+                del index[value]
+
+    def _index_rule(self, rule):
+        """
+        Remember a rule we have just started to hold in our map.
+        """
+        if self not in rule._rulesets:
+            rule._rulesets.append(self)
+        self._index_target(rule.target)
+        for label in rule.deps:
+            self._index_dependency(rule, label)
+
+    def _rebuild_dependency_index(self):
+        """
+        Recalculate our reverse dependency index from scratch.
+        """
+        self.dependents = { }
+        self.dependencies_by_name = { }
+        self.wildcard_dependencies = set()
+        for rule in self.map.values():
+            for label in rule.deps:
+                self._index_dependency(rule, label)
+
+    def _rebuild_index(self):
+        """
+        Recalculate our indices from scratch.
+
+        This must be done if the domain of our labels has been changed.
+        """
+        self.generation += 1
+        self.targets_by_part = tuple({ } for part in _LABEL_PARTS)
+        self.dependents = { }
+        self.dependencies_by_name = { }
+        self.wildcard_dependencies = set()
+        for rule in self.map.values():
+            self._index_rule(rule)
+
+    def _match_targets(self, label):
+        """
+        Return a new set of our targets that match 'label', which may be
+        wildcarded.
+
+        This gives the same result as trying label.just_match() on each of
+        our targets, but we start with the targets for the part of 'label'
+        with the fewest candidates, and then intersect that with the targets
+        for each of its other parts.
+
+        For instance:
+
+            >>> r = RuleSet()
+            >>> for text in ('package:fred{x86}/built', 'package:fred{arm}/built',
+            ...              'package:jim{x86}/built', 'package:*{x86}/built',
+            ...              'checkout:fred/checked_out'):
+            ...     r.add(Rule(Label.from_string(text), None))
+            >>> def show(text):
+            ...     print label_list_to_string(sorted(r._match_targets(
+            ...                                 Label.from_string(text))))
+            >>> show('package:fred{x86}/built')
+            package:*{x86}/built package:fred{x86}/built
+            >>> show('package:fred{*}/*')
+            package:*{x86}/built package:fred{arm}/built package:fred{x86}/built
+            >>> show('*:fred/*')
+            checkout:fred/checked_out
+            >>> show('package:(sub)fred{x86}/built')
+            <BLANKLINE>
+        """
+        buckets = []
+        for part, index in zip(_LABEL_PARTS, self.targets_by_part):
+            value = getattr(label, part)
+            if value == '*':
+                continue
+            exact = index.get(value, _NO_LABELS)
+            wild = index.get('*', _NO_LABELS)
+            buckets.append((len(exact) + len(wild), exact, wild))
+
+        if not buckets:
+            return set(self.map)
+
+        buckets.sort(key=lambda bucket: bucket[0])
+        size, exact, wild = buckets[0]
+        found = exact | wild
+        for size, exact, wild in buckets[1:]:
+            if not found:
+                break
+            if wild:
+                found = (found & exact) | (found & wild)
+            else:
+                found = found & exact
+        return set(found)
 
     def add(self, rule):
         """
@@ -1264,14 +1556,15 @@ class RuleSet(object):
 
         If this rule is for a new target, just remember it.
         """
-        # Invalidate our look-up cache
-        self.cache = { }
+        self.generation += 1
 
         # Do we have the same target?
         inst = self.map.get(rule.target, None)
         if (inst is None):
             self.map[rule.target] = rule
+            self._index_rule(rule)
         else:
+            # Any new dependencies get indexed by inst.add()
             inst.merge(rule)
 
 
@@ -1289,24 +1582,25 @@ class RuleSet(object):
         """
         rules = set()
         if (useMatch):
-            cached = self.cache.get(label, None)
-            if (cached is None):
-                for (k,v) in self.map.items():
-                    #if (label.match(k) is not None):
-                    if label.just_match(k):
-                        rules.add(v)
-                self.cache[label] = rules
-            else:
-                rules = cached
+            for k in self._match_targets(label):
+                rules.add(self.map[k])
         elif (useTags):
             rule = self.map.get(label, None)
             if (rule is not None):
                 rules.add(rule)
         else:
-            for (k,v) in self.map.items():
-                if (k.match_without_tag(label)):
-                    rules.add(v)
-
+            # Exactly the same apart from the tag
+            found = None
+            for part, index in zip(_LABEL_PARTS, self.targets_by_part):
+                if part == '_tag':
+                    continue
+                labels = index.get(getattr(label, part), _NO_LABELS)
+                if found is None:
+                    found = labels
+                else:
+                    found = found & labels
+            for k in found:
+                rules.add(self.map[k])
 
         return rules
 
@@ -1325,16 +1619,12 @@ class RuleSet(object):
 
         Returns a set of suitable targets, or an empty set if there are none.
         """
-        result_set = set()
-
         if (useMatch):
-            for k in self.map.keys():
-                if (k.match(target) is not None):
-                    result_set.add(k)
-        elif target in self.map.keys():
-            result_set.add(target)
-
-        return result_set
+            return self._match_targets(target)
+        elif target in self.map:
+            return set([target])
+        else:
+            return set()
 
     def rule_for_target(self, target, createIfNotPresent = False):
         """
@@ -1351,7 +1641,8 @@ class RuleSet(object):
         if (createIfNotPresent and (rv is None)):
             rv = Rule(target, None)
             self.map[target] = rv
-            self.cache = { }
+            self._index_rule(rv)
+            self.generation += 1
 
         return rv
 
@@ -1372,24 +1663,23 @@ class RuleSet(object):
         """
         result_set = set()
 
-        # This is an exception to Don't Repeat Yourself, which saves 11% runtime.
         if useMatch:
-            for v in self.map.values():
-                for dep in v.deps:
-                    if dep.match(label) is not None:
-                        result_set.add(v)
-                        break
+            if label.type == '*' or label.name == '*':
+                # We can't narrow things down by name, so try everything
+                candidates = self.dependents.keys()
+            else:
+                candidates = list(self.wildcard_dependencies)
+                candidates.extend(self.dependencies_by_name.get((label.type,
+                                                                 label.name), ()))
+            for dep in candidates:
+                if dep.match(label) is not None:
+                    result_set.update(self.dependents[dep])
         elif useTags:
-            for v in self.map.values():
-                if (label in v.deps):
-                    result_set.add(v)
+            result_set.update(self.dependents.get(label, ()))
         else:
-            for v in self.map.values():
-                for dep in v.deps:
-                    if dep.match_without_tag(label):
-                        result_set.add(v)
-                        break
-
+            for dep in self.dependencies_by_name.get((label.type, label.name), ()):
+                if dep.match_without_tag(label):
+                    result_set.update(self.dependents[dep])
 
         return result_set
 
@@ -1410,39 +1700,37 @@ class RuleSet(object):
         This is a pain, and depends heavily on CatenatedObject
         """
 
-        new_map = { }
-
-
-        # First, collect anything that might be rewritten.
-        for (k,v) in self.map.items():
-            new_k = None
-            new_v = v
-
+        # First, take out anything that will be rewritten. Anything that
+        # unifies with 'source' must match it, so we only need to look at
+        # the targets that do.
+        rewrite = []
+        for k in self._match_targets(source):
             if (k.unifies(source)):
-                copied_source = k.copy_and_unify_with(target)
-                new_v.replace_target(copied_source)
-                new_k = copied_source
-                if False:
-                    print "Ruleset: rewrite src = %s\n" \
-                          "                   k = %s\n" \
-                          "                    to %s"%(source,k,copied_source)
-            else:
-                new_k = k
-
-            if (new_k in new_map):
-                old_v = new_map[new_k]
-                old_v.catenate_and_merge(new_v)
+                rewrite.append((k, self.map.pop(k)))
+                self._unindex_target(k)
+
+        # Then put it back with its new target
+        for (k,v) in rewrite:
+            copied_source = k.copy_and_unify_with(target)
+            v.replace_target(copied_source)
+            if False:
+                print "Ruleset: rewrite src = %s\n" \
+                      "                   k = %s\n" \
+                      "                    to %s"%(source,k,copied_source)
+
+            old_v = self.map.get(copied_source)
+            if (old_v is not None):
+                old_v.catenate_and_merge(v)
             else:
-                new_map[new_k] = new_v
+                self.map[copied_source] = v
+                self._index_target(copied_source)
 
-        # Now, rename everything in the dependencies and copy
-        # back ..
-        for (k,v) in new_map.items():
+        # Now, rename everything in the dependencies
+        for v in self.map.values():
             v.unify_dependencies(source, target)
 
-        # .. and new_map is the new map.
-        self.map = new_map
-        self.cache = { }
+        self.generation += 1
+        self._rebuild_dependency_index()
 
 
     def to_string(self, matchLabel = None,
@@ -1620,120 +1908,217 @@ def needed_to_build(ruleset, target, useTags = True, useMatch = False):
           we do not.
 
     Returns a list of rules.
+
+    The rules are returned in "waves": first the rules whose targets have no
+    dependencies, then the rules whose dependencies are all satisfied by the
+    first wave, and so on. Within each wave, rules are sorted by target.
+
+    The result is remembered until the rule set next changes, so asking
+    the same question again is cheap.
+
+    For instance:
+
+        >>> rs = RuleSet()
+        >>> for name in ('fred', 'jim'):
+        ...     rs.add(Rule(Label.from_string('checkout:%s/checked_out'%name), None))
+        >>> r = Rule(Label.from_string('package:bob{x86}/built'), None)
+        >>> r.add(Label.from_string('checkout:jim/checked_out'))
+        >>> r.add(Label.from_string('checkout:fred/checked_out'))
+        >>> rs.add(r)
+        >>> print rule_list_to_string(needed_to_build(rs, r.target))
+        [ checkout:fred/checked_out <- [ ], checkout:jim/checked_out <- [ ], package:bob{x86}/built <- [ checkout:fred/checked_out, checkout:jim/checked_out ],  ]
+
+    If the dependencies are circular, we give up, and say where the cycle is:
+
+        >>> rs.rule_for_target(Label.from_string('checkout:jim/checked_out')).add(r.target)
+        >>> try:
+        ...     needed_to_build(rs, r.target)
+        ... except GiveUp as e:
+        ...     print str(e).splitlines()[-1]
+        cycle = checkout:jim/checked_out -> package:bob{x86}/built -> checkout:jim/checked_out
     """
 
-    # rule_list stores the list of rules we're about to return.
-    rule_list = [ ]
-    # rule_target_set stores the set of targets resulting from rule_list
-    # (i.e. if you'd obeyed rule_list, you'd have asserted all these labels)
-    rule_target_set = set()
-
-    # The set of labels we'd like to see asserted.
-    targets = set()
-    targets.update(ruleset.targets_match(target, useMatch=useMatch))
-
-    done_something = True
-    trace = False
-
-    while done_something:
-        done_something = False
-
-        if trace:
-            print "\n> Loop"
-
-        # Remove anything we've already satisfied from our list of targets.
-        targets = targets - rule_target_set
-
-        # Have we succeeded?
-        if len(targets) == 0:
-            # Yep!
-            if trace:
-                print
-                print "To build %s we need:"%target
-                for r in rule_list:
-                    print '    %s'%r
-                print
-            return rule_list
-
-        # In that case, we need to go through all the dependencies of the
-        # targets, adding each either to the target list or the rule_list.
-        new_targets = set()
-
-        for tgt in targets:
-            if trace:
-                print "\nLooking at target %s"%tgt
-            rules = ruleset.rules_for_target(tgt, useTags)
-            if rules is None:
-                raise MuddleBug("No rule found for target %s"%tgt)
-
-            # This is slightly icky. Technically, in the presence of wildcard
-            # rules, there can be several rules which build a target.
-            #
-            # Since we use wildcard rules to add extra rules to targets,
-            # we need to satisfy every rule that builds this target.
-
-            # Every dependency has either already been satisfied or
-            # needs to be.
-            can_build_target = True
-
-            if len(rules) == 0:
-                raise MuddleBug("Rule list is empty for target %s"%tgt)
-
-            if trace:
-                print "Rules for %s:"%tgt
-                for r in rules:
-                    print '    %s'%r
-
-            rule = None
-            for rule in rules:
-                if trace:
-                    print "Looking at rule %s"%rule
-                for dep in rule.deps:
-                    if dep not in rule_target_set:
-                        if trace:
-                            print "  Cannot build %s because it needs %s"%(tgt, dep)
-                            # .. and we can't build this target until we have.
-
-                        # We need to satisfy this dependency, so add it
-                        # to targets. The test here is purely so we can
-                        # detect circular dependencies.
-                        if dep not in new_targets and dep not in targets:
-                            if trace:
-                                print "  Add new target %s"%str(dep)
-                            new_targets.add(dep)
-                            done_something = True
-                        elif trace:
-                            if dep in targets: print "  ..already in targets"
-                            if dep in new_targets: print "  ..already in new_targets"
-
-                        can_build_target = False
-
-            if can_build_target:
-                # All dependencies are already satisfied, so we can ..
-                if trace:
-                    print "Add build rule: target %s"%tgt
-                    for rule in rules:
-                        print "                rule %s"%rule
-                for rule in rules:
-                    rule_list.append(rule)
-                rule_target_set.add(tgt)
-                done_something = True
-            else:
-                # Can't satisfy our dependencies. Still a target.
-                new_targets.add(tgt)
+    if ruleset.plans_generation != ruleset.generation:
+        ruleset.plans = { }
+        ruleset.plans_generation = ruleset.generation
+
+    key = (target, useTags, useMatch)
+    plan = ruleset.plans.get(key)
+    if plan is None:
+        plan = _plan_build(ruleset, target, useTags, useMatch)
+        ruleset.plans[key] = plan
+
+    # Our callers are allowed to alter what we give them
+    return list(plan)
+
+def _plan_build(ruleset, target, useTags, useMatch):
+    """
+    Work out the rules needed to build 'target', for needed_to_build().
+    """
 
-        targets = new_targets
+    # First, find all the labels that we need to assert. For each, we
+    # remember the rules that build it, and the labels it depends on.
+    #
+    # This is slightly icky. Technically, in the presence of wildcard
+    # rules, there can be several rules which build a target.
+    #
+    # Since we use wildcard rules to add extra rules to targets,
+    # we need to satisfy every rule that builds this target.
+    rules_for = {}
+    deps_of = {}
+    needed_by = {}
+
+    to_look_at = list(ruleset.targets_match(target, useMatch=useMatch))
+    for tgt in to_look_at:
+        needed_by[tgt] = []
+    while to_look_at:
+        tgt = to_look_at.pop()
+        rules = ruleset.rules_for_target(tgt, useTags)
+        if rules is None:
+            raise MuddleBug("No rule found for target %s"%tgt)
+        if len(rules) == 0:
+            raise MuddleBug("Rule list is empty for target %s"%tgt)
+        if len(rules) > 1:
+            rules = sorted(rules)
+        rules_for[tgt] = rules
+
+        deps = set()
+        for rule in rules:
+            deps.update(rule.deps)
+        deps_of[tgt] = deps
+
+        for dep in deps:
+            if dep not in needed_by:
+                needed_by[dep] = []
+                to_look_at.append(dep)
+            needed_by[dep].append(tgt)
+
+    # Then (Kahn's algorithm) repeatedly take all of the labels whose
+    # dependencies have been satisfied
+    waiting_for = {}
+    wave = []
+    for tgt, deps in deps_of.items():
+        if deps:
+            waiting_for[tgt] = len(deps)
+        else:
+            wave.append(tgt)
+
+    rule_list = []
+    while wave:
+        wave.sort()
+        next_wave = []
+        for tgt in wave:
+            rule_list.extend(rules_for[tgt])
+            for other in needed_by[tgt]:
+                waiting_for[other] -= 1
+                if waiting_for[other] == 0:
+                    del waiting_for[other]
+                    next_wave.append(other)
+        wave = next_wave
+
+    if not waiting_for:
+        return rule_list
 
     # If we get here, we can never satisfy the remaining set of
     # targets because the graph is circular or incomplete.
-    targets = list(targets)
-    targets.sort()
+    targets = sorted(waiting_for.keys())
     raise GiveUp("Dependency graph is circular or incomplete. \n" +
                  "building = %s\n"%target +
                  "targets = %s \n"%label_set_to_string(targets,
                                                        start_with='[\n    ',
                                                        end_with='\n]',
-                                                       join_with='\n    '))
+                                                       join_with='\n    ') +
+                 "cycle = %s"%" -> ".join(map(str, _find_cycle(targets[0],
+                                                              deps_of,
+                                                              waiting_for))))
+
+def _find_cycle(start, deps_of, unsatisfied):
+    """
+    Return a dependency cycle reachable from 'start', as a list of labels.
+
+    Each label in the result depends on the next, and the last label is the
+    same as the first.
+
+    'unsatisfied' must contain 'start', and each of its labels must have
+    at least one dependency that is also in 'unsatisfied' (as is the case
+    for the labels left over by needed_to_build()). This guarantees that
+    we will find a cycle.
+    """
+    path = [start]
+    where = {start:0}
+    while True:
+        for dep in sorted(deps_of[path[-1]]):
+            if dep in unsatisfied:
+                break
+        if dep in where:
+            return path[where[dep]:] + [dep]
+        where[dep] = len(path)
+        path.append(dep)
+
+
+def rule_list_prerequisites(rule_list):
+    """
+    Given a list of rules, in an order in which they may be obeyed (as
+    returned by needed_to_build()), work out which of them must be obeyed
+    before each rule.
+
+    Returns a list of the same length as 'rule_list', each entry being the
+    set of indices (into 'rule_list') of the rules that must be obeyed
+    before the rule at that position.
+
+    A rule must wait for any earlier rule whose target matches one of its
+    dependencies (this is the same matching that needed_to_build() uses).
+    Rules with the same target are also kept in their original order.
+
+    Only earlier rules are considered, so obeying the rules in any order
+    that respects the result will never do anything that obeying them in
+    list order would not. For instance:
+
+        >>> l = Label.from_string('package:fred{bob}/initial')
+        >>> r = RuleSet()
+        >>> depend_chain(None, l, ['built', 'installed'], r)
+        >>> depend_chain(None, package('jim', 'bob', 'initial'), ['built'], r)
+        >>> rules = needed_to_build(r, package('*', 'bob', 'built'), useMatch=True)
+        >>> [str(x.target) for x in rules]
+        ['package:fred{bob}/initial', 'package:jim{bob}/initial', 'package:fred{bob}/built', 'package:jim{bob}/built']
+        >>> rule_list_prerequisites(rules)
+        [set([]), set([]), set([0]), set([1])]
+    """
+    # Definite targets can be looked up directly, but wildcarded targets
+    # (rare, but allowed) have to be matched against each dependency
+    by_target = {}
+    wildcard_targets = []
+
+    prerequisites = []
+    for index, rule in enumerate(rule_list):
+        before = set()
+        for dep in rule.deps:
+            if dep.is_definite():
+                before.update(by_target.get(dep, ()))
+                for other, other_target in wildcard_targets:
+                    if dep.just_match(other_target):
+                        before.add(other)
+            else:
+                for other in range(index):
+                    if dep.just_match(rule_list[other].target):
+                        before.add(other)
+
+        target = rule.target
+        if target.is_definite():
+            same = by_target.setdefault(target, [])
+        else:
+            same = [other for other, other_target in wildcard_targets
+                    if other_target == target]
+            wildcard_targets.append((index, target))
+        if same:
+            before.add(same[-1])
+        if target.is_definite():
+            same.append(index)
+
+        before.discard(index)
+        prerequisites.append(before)
+
+    return prerequisites
 
 
 def required_by(ruleset, label, useTags = True, useMatch = True):
@@ -1766,24 +2151,27 @@ def required_by(ruleset, label, useTags = True, useMatch = True):
     for r in rules:
         depends.add(r.target)
 
-
+    # Each label only needs looking up once, so we only look at the labels
+    # that were added in the previous pass
+    to_look_at = depends
     while True:
         extra = set()
 
-        for dep in depends:
+        for dep in to_look_at:
             # Merge in everything that depends on dep
             new_rules = ruleset.rules_which_depend_on(dep, useTags, useMatch = useMatch)
 
             # Each target depends on us ..
             for rule in new_rules:
                 # If we're not already in the depends set, add us ..
-                if (not (rule.target in depends)):
+                if (not (rule.target in depends)) and (not (rule.target in extra)):
                     return_val.append(rule.target)
                     extra.add(rule.target)
 
         # Anything to add?
         if len(extra) > 0:
             depends = depends.union(extra)
+            to_look_at = extra
         else:
             return depends
 
@@ -1843,10 +2231,8 @@ def normalise_checkout_label(label, tag='*'):
             not label.system and not label.transient:
         return label
     else:
-        new = label.copy_with_tag(tag)
-        new._role = None    # a bit naughty, but the simplest way
-        new.rehash()
-        return new
+        return Label._intern(label.type, label.name, None, tag, False, False,
+                             label.domain)
 
 # Some simple ways of constructing labels
 def checkout(name, tag='*', domain=None):
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""
+Apply a plan of changes to files, usually as root.
+
+    $ sudo python apply_plan.py <plan-file>
+
+Deployments that need privilege to apply their instructions (to chown
+files, or make device nodes) work out which files each instruction
+applies to, and write the resulting plan to a file, as JSON. They then
+run this module, as a script, under sudo. This means that muddle (and
+the build description) need not be loaded again to apply the instructions,
+and also that only this module is run as root. For the same reasons, this
+module only uses the Python standard library.
+
+The plan is a list of operations, each of which is a list starting with
+its name:
+
+* ["chmod", <mode>, <paths>] - <mode> is either a number, or a symbolic
+  mode that is passed to the chmod program.
+* ["chown", <uid>, <gid>, <paths>] - either id may be -1, to leave it
+  unchanged. Symbolic links are changed, not what they refer to.
+* ["mknod", <path>, <mode>, <major>, <minor>, <uid>, <gid>] - <mode>
+  includes the file type (character or block device).
+
+Paths are written as Latin-1, so that any bytes survive being written as JSON.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# How many paths to give each run of the "chmod" program
+CHMOD_BATCH_SIZE = 1000
+
+def _path(text):
+    if isinstance(text, unicode):
+        return text.encode('latin-1')
+    return text
+
+def write_plan(plan, fd):
+    json.dump(plan, fd, encoding='latin-1')
+
+def read_plan(fd):
+    return json.load(fd)
+
+def apply_plan(plan):
+    """
+    Apply the operations in 'plan', in order.
+    """
+    for op in plan:
+        what = op[0]
+        if what == 'chmod':
+            mode, paths = op[1], [_path(p) for p in op[2]]
+            if isinstance(mode, (int, long)):
+                for path in paths:
+                    os.chmod(path, mode)
+                mode = '%04o'%mode
+            else:
+                for n in range(0, len(paths), CHMOD_BATCH_SIZE):
+                    subprocess.check_call(['chmod', mode, '--'] +
+                                          paths[n:n+CHMOD_BATCH_SIZE])
+            print '> chmod %s: %d file%s'%(mode, len(paths),
+                                           '' if len(paths) == 1 else 's')
+        elif what == 'chown':
+            uid, gid, paths = op[1], op[2], [_path(p) for p in op[3]]
+            for path in paths:
+                os.lchown(path, uid, gid)
+            print '> chown %d:%d: %d file%s'%(uid, gid, len(paths),
+                                              '' if len(paths) == 1 else 's')
+        elif what == 'mknod':
+            path, mode, major, minor, uid, gid = op[1:]
+            path = _path(path)
+            os.mknod(path, mode, os.makedev(major, minor))
+            os.lchown(path, uid, gid)
+            # mknod() is subject to our umask
+            os.chmod(path, mode & 07777)
+            print '> mknod %s'%path
+        else:
+            raise ValueError('Unknown operation %r in plan'%what)
+
+def main(args):
+    if len(args) != 1:
+        print __doc__
+        return 2
+    with open(args[0]) as fd:
+        plan = read_plan(fd)
+    try:
+        apply_plan(plan)
+    except (EnvironmentError, ValueError, subprocess.CalledProcessError) as e:
+        print >> sys.stderr, 'Failed to apply instructions: %s'%e
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -11,16 +11,164 @@ This deployment is used to collect elements from:
 into deployment directories, usually to be processed by some external tool.
 """
 
+import errno
+import grp
 import os
+import pwd
+import stat
+import sys
+import tempfile
 
 import muddled.depend as depend
 import muddled.utils as utils
 import muddled.filespec as filespec
 import muddled.deployment as deployment
+import muddled.deployments.apply_plan as apply_plan
 
 from muddled.depend import Action, Label
 from muddled.utils import GiveUp, MuddleBug
 
+def _lookup_id(builder, text, db, what):
+    """
+    Return the numeric id for user or group 'text'.
+
+    'db' is the pwd or grp module, and 'what' says which, for error messages.
+    """
+    if text.isdigit():
+        if db is pwd:
+            return utils.parse_uid(builder, text)
+        else:
+            return utils.parse_gid(builder, text)
+    try:
+        if db is pwd:
+            return pwd.getpwnam(text).pw_uid
+        else:
+            return grp.getgrnam(text).gr_gid
+    except KeyError:
+        raise GiveUp("Unknown %s '%s'"%(what, text))
+
+def _lookup_ids(builder, new_user, new_group):
+    """
+    Return the (uid, gid) for a chown, with -1 for either that is None.
+    """
+    uid = gid = -1
+    if new_user is not None:
+        uid = _lookup_id(builder, new_user, pwd, 'user')
+    if new_group is not None:
+        gid = _lookup_id(builder, new_group, grp, 'group')
+    return uid, gid
+
+def change_mode(files, new_mode):
+    """
+    Change the mode of each of the named files to 'new_mode'.
+
+    This is done in this process, with os.chmod(). If 'new_mode' is symbolic
+    (e.g., "a+x"), which utils.parse_mode() does not understand, we instead run
+    the "chmod" program, but on many files at a time.
+
+    Symbolic links are left alone, as "chmod -R" would do - their own mode
+    does not matter, and following them might change a file outside the
+    directory tree we were asked to alter.
+
+    Returns the number of files changed.
+    """
+    files = [f for f in files if not os.path.islink(f)]
+    if new_mode and new_mode[0].isdigit():
+        clear_bits, set_bits = utils.parse_mode(new_mode)
+        for f in files:
+            try:
+                mode = stat.S_IMODE(os.stat(f).st_mode)
+                os.chmod(f, (mode & ~clear_bits) | set_bits)
+            except OSError as e:
+                raise GiveUp("Cannot chmod %s %s: %s"%(new_mode, f, e))
+    else:
+        batch_size = apply_plan.CHMOD_BATCH_SIZE
+        for start in range(0, len(files), batch_size):
+            utils.run0(["chmod", new_mode, "--"] +
+                       files[start:start+batch_size],
+                       show_command=False)
+    return len(files)
+
+def change_owner(builder, files, new_user, new_group):
+    """
+    Change the owner and/or group of each of the named files.
+
+    Either of 'new_user' or 'new_group' may be None, to leave that unchanged.
+    Names and numeric ids are both allowed.
+
+    This is done in this process, with os.lchown(), so a symbolic link is
+    itself changed, and not the file it refers to.
+
+    Returns the number of files changed.
+    """
+    uid, gid = _lookup_ids(builder, new_user, new_group)
+    for f in files:
+        try:
+            os.lchown(f, uid, gid)
+        except OSError as e:
+            raise GiveUp("Cannot chown %s:%s %s: %s"%(new_user or '',
+                                                      new_group or '', f, e))
+    return len(files)
+
+def plan_change_mode(files, new_mode):
+    """
+    Return the plan operation that change_mode() would perform.
+
+    See muddled.deployments.apply_plan for what a plan is.
+    """
+    files = [f for f in files if not os.path.islink(f)]
+    if new_mode and new_mode[0].isdigit():
+        # A numeric mode sets all the mode bits, so doesn't care what they were
+        clear_bits, set_bits = utils.parse_mode(new_mode)
+        return ["chmod", set_bits, files]
+    else:
+        return ["chmod", new_mode, files]
+
+def plan_change_owner(builder, files, new_user, new_group):
+    """
+    Return the plan operation that change_owner() would perform.
+    """
+    uid, gid = _lookup_ids(builder, new_user, new_group)
+    return ["chown", uid, gid, files]
+
+def apply_with_privilege(plan):
+    """
+    Apply 'plan' (a list of operations) as root.
+
+    The plan may also contain callables, for instructions that do not know
+    how to plan themselves (see InstructionImplementor.plan()). These are
+    called in this process, as we reach them, so everything is still done in
+    the order the instructions were given.
+
+    If we are not already root, then we write each run of operations to a
+    temporary file, and run muddled/deployments/apply_plan.py on it with sudo.
+    """
+    operations = []
+    for item in plan:
+        if callable(item):
+            _apply_operations(operations)
+            operations = []
+            item()
+        else:
+            operations.append(item)
+    _apply_operations(operations)
+
+def _apply_operations(plan):
+    if not plan:
+        return
+    if os.geteuid() == 0:
+        apply_plan.apply_plan(plan)
+        return
+
+    fd, plan_file = tempfile.mkstemp(prefix='muddle_plan_', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            apply_plan.write_plan(plan, f)
+        helper = os.path.splitext(apply_plan.__file__)[0] + '.py'
+        utils.run0(["sudo", sys.executable, helper, plan_file])
+    finally:
+        os.remove(plan_file)
+
 class InstructionImplementor(object):
     def prepare(self, builder, instruction, role, path):
         """
@@ -33,6 +181,16 @@ class InstructionImplementor(object):
     def apply(self, builder, instruction, role, path):
         pass
 
+    def plan(self, builder, instruction, role, path):
+        """
+        Returns a list of the operations that apply() would perform, so that
+        they can be performed later, with privilege.
+
+        By default, we return a function that calls apply(), which
+        apply_with_privilege() calls (without privilege) when it reaches it.
+        """
+        return [lambda: self.apply(builder, instruction, role, path)]
+
     def needs_privilege(self, builder, instr, role, path):
         False
 
@@ -42,15 +200,17 @@ class CollectApplyChmod(InstructionImplementor):
         return True
 
     def apply(self, builder, instr, role, path):
-
         dp = filespec.FSFileSpecDataProvider(path)
-
         files = dp.abs_match(instr.filespec)
-        # @todo We _really_ need to use xargs here ..
-        for f in files:
-            utils.run0(["chmod", instr.new_mode, f])
+        count = change_mode(files, instr.new_mode)
+        print '> chmod %s: %d file%s'%(instr.new_mode, count,
+                                       '' if count == 1 else 's')
         return True
 
+    def plan(self, builder, instr, role, path):
+        dp = filespec.FSFileSpecDataProvider(path)
+        return [plan_change_mode(dp.abs_match(instr.filespec), instr.new_mode)]
+
     def needs_privilege(self, builder, instr, role, path):
         # You don't, in general, need root to change permissions.
         # Except, you do in order to chmod setuid after a chown ...
@@ -64,34 +224,42 @@ class CollectApplyChown(InstructionImplementor):
     def apply(self, builder, instr, role, path):
         return self._prep_or_apply(builder, instr, role, path, False)
 
+    def plan(self, builder, instr, role, path):
+        dp = filespec.FSFileSpecDataProvider(path)
+        return [plan_change_owner(builder, dp.abs_match(instr.filespec),
+                                  instr.new_user, instr.new_group)]
+
     def _prep_or_apply(self, builder, instr, role, path, is_prepare):
 
         # NB: take care to apply a chown command to the file named,
-        # even if it is a symbolic link (the default is --reference,
-        # which would only apply the chown to the file the symbolic
-        # link references)
+        # even if it is a symbolic link (so we use lchown, which does not
+        # follow the link to the file it references)
 
         dp = filespec.FSFileSpecDataProvider(path)
         files = dp.abs_match(instr.filespec)
-        if instr.new_user is None:
-            cmd = ["chgrp", instr.new_group]
-        elif instr.new_group is None:
-            cmd = ["chown", "--no-dereference", instr.new_user]
-        else:
-            cmd = ["chown", "--no-dereference",
-                   "%s:%s"%(instr.new_user, instr.new_group)]
 
-        for f in files:
-            if is_prepare:
-                # @TODO: This doesn't handle directories that have been
-                # chowned and will collapse in a soggy heap. If support for
-                # those is required, need to either:
-                #   sudo rm -rf dir
-                #   sudo chown -R <nonprivuser> dir
-                #   or just run the whole rsync under sudo.
-                utils.run0(["rm", "-f", f])
-            else:
-                utils.run0([cmd, f])
+        if is_prepare:
+            # @TODO: This doesn't handle directories that have been
+            # chowned, which are left alone. If support for those is
+            # required, need to either:
+            #   sudo rm -rf dir
+            #   sudo chown -R <nonprivuser> dir
+            #   or just run the whole rsync under sudo.
+            count = 0
+            for f in files:
+                if os.path.isdir(f) and not os.path.islink(f):
+                    continue
+                try:
+                    os.remove(f)
+                    count += 1
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise GiveUp("Cannot remove %s: %s"%(f, e))
+            what = 'removed'
+        else:
+            count = change_owner(builder, files, instr.new_user, instr.new_group)
+            what = 'chown %s:%s'%(instr.new_user or '', instr.new_group or '')
+        print '> %s: %d file%s'%(what, count, '' if count == 1 else 's')
 
     def needs_privilege(self, builder, instr, role, path):
         return True
@@ -251,22 +419,28 @@ class CollectDeploymentBuilder(Action):
                                      " found in label %s (filename %s)"%(lbl, fn))
 
 
-        print "Rerunning muddle to apply instructions .. "
-
-        permissions_label = Label(utils.LabelType.Deployment,
-                                  label.name, None, # XXX label.role,
-                                  utils.LabelTag.InstructionsApplied,
-                                  domain = label.domain)
-
-        cmd = [builder.muddle_binary, "buildlabel", str(permissions_label)]
-        if need_root_for:
+        # We apply the instructions here, rather than by running muddle again
+        # (perhaps with sudo) to build our "instructionsapplied" label. If we
+        # need root, we work out what to do to which files, and just hand that
+        # over to be done with sudo.
+        deploy_path = builder.deploy_path(label)
+        if need_root_for and os.geteuid() != 0:
             print "I need root to do %s - sorry! - running sudo .."%(', '.join(sorted(need_root_for)))
-            utils.run0(["sudo"] + cmd)
+            self.apply_instructions(builder, label, False, deploy_path,
+                                    privileged=True)
         else:
-            utils.run0(cmd)
+            self.apply_instructions(builder, label, False, deploy_path)
+
+    def apply_instructions(self, builder, label, prepare, deploy_path,
+                           privileged=False):
+        """
+        Prepare for, or apply, our instructions to 'deploy_path'.
 
-    def apply_instructions(self, builder, label, prepare, deploy_path):
+        If 'privileged' is true, then the instructions are planned, and the
+        resulting plan is then applied as root - see apply_with_privilege().
+        """
 
+        plan = []
         for asm in self.assemblies:
             lbl = Label(utils.LabelType.Package, '*', asm.from_label.role,
                         '*', domain = asm.from_label.domain)
@@ -284,12 +458,16 @@ class CollectDeploymentBuilder(Action):
                     if iname in self.app_dict:
                         if prepare:
                             self.app_dict[iname].prepare(builder, instr, lbl.role, deploy_path)
+                        elif privileged:
+                            plan.extend(self.app_dict[iname].plan(builder, instr, lbl.role, deploy_path))
                         else:
                             self.app_dict[iname].apply(builder, instr, lbl.role, deploy_path)
                     else:
                         raise GiveUp("%s deployments don't know about instruction %s"%(self.what, iname) +
                                      " found in label %s (filename %s)"%(lbl, fn))
 
+        apply_with_privilege(plan)
+
 
 def _inside_of_deploy(builder, name, the_action):
     """This implements the common code from the public 'deploy()' function.
@@ -13,6 +13,7 @@ cpio. Ugh.
 
 import types
 import os
+import subprocess
 
 import muddled
 import muddled.env_store
@@ -24,6 +25,11 @@ import muddled.cpiofile as cpiofile
 from muddled.depend import Action
 from muddled.utils import GiveUp, LabelType, LabelTag
 
+# The compression methods we support, as the program to use and the
+# extension it adds to the file name
+COMPRESSORS = { "gzip" : ("gzip", ".gz"),
+                "bzip2" : ("bzip2", ".bz2") }
+
 class CpioInstructionImplementor(object):
 
     def apply(self, builder, instruction, role, path):
@@ -34,7 +40,8 @@ class CpioDeploymentBuilder(Action):
     Builds the specified CPIO deployment.
     """
 
-    def __init__(self, target_file, target_base, compressionMethod=None, pruneFunc=None):
+    def __init__(self, target_file, target_base, compressionMethod=None, pruneFunc=None,
+                 hardLinks="inode"):
         """
         * 'target_file' is the CPIO file to construct.
         * 'target_base' is an array of pairs mapping labels to target locations, or
@@ -45,11 +52,15 @@ class CpioDeploymentBuilder(Action):
           pruneFunc(Hierarchy) to prune the hierarchy prior to packing. Usually
           something like deb.deb_prune, it's intended to remove spurious stuff like
           manpages from initrds and the like.
+        * 'hardLinks' says which files to store as hard links, so that their
+          data only appears once in the archive - None, "inode" or "content".
+          See cpiofile.Archive.render() for details.
         """
         self.target_file = target_file
         self.target_base = target_base
         self.compression_method = compressionMethod
         self.prune_function = pruneFunc
+        self.hard_links = hardLinks
 
     def __str__(self):
         result = "cpioDeploymentBuilder{"
@@ -58,7 +69,8 @@ class CpioDeploymentBuilder(Action):
         for (l,tgt) in self.target_base:
             result = result + "(%s,%s) "%(l,tgt)
         result = result + ",compression=%s"%self.compression_method
-        result = result + ",prune=%s}"%self.prune_function
+        result = result + ",prune=%s"%self.prune_function
+        result = result + ",hard_links=%s}"%self.hard_links
         return result
 
 
@@ -121,6 +133,15 @@ class CpioDeploymentBuilder(Action):
             raise GiveUp("Attempt to build a CPIO deployment with a"
                          " package label of type %s"%(label.tag))
 
+        if (self.hard_links not in (None, "inode", "content")):
+            raise GiveUp("Invalid hard link method %s specified for cpio"
+                         " deployment. Pick None, inode or content."%self.hard_links)
+
+        if (self.compression_method is not None and
+            self.compression_method not in COMPRESSORS):
+            raise GiveUp("Invalid compression method %s"%self.compression_method +
+                         "specified for cpio deployment. Pick gzip or bzip2.")
+
         # Collect all the relevant files ..
         if label.type == LabelType.Deployment:
             deploy_dir = builder.deploy_path(label)
@@ -197,17 +218,38 @@ class CpioDeploymentBuilder(Action):
                         raise GiveUp("CPIO deployments don't know about "
                                      "the instruction %s (lbl %s, file %s)"%(iname, lbl, fn))
         # .. and write the file.
-        print "> Writing %s .. "%deploy_file
-        the_hierarchy.render(deploy_file, True)
-
-        if (self.compression_method is not None):
-            if (self.compression_method == "gzip"):
-                utils.run0(["gzip", "-f", deploy_file])
-            elif (self.compression_method == "bzip2"):
-                utils.run0(["bzip2", "-f", deploy_file])
+        if (self.compression_method is None):
+            target_file = deploy_file
+        else:
+            (program, extension) = COMPRESSORS[self.compression_method]
+            target_file = deploy_file + extension
+        print "> Writing %s .. "%target_file
+
+        # Write to a temporary file first, so that if anything goes wrong we
+        # don't leave behind a truncated archive that looks like a real one
+        temp_file = target_file + ".tmp"
+        try:
+            if (self.compression_method is None):
+                the_hierarchy.render(temp_file, True, self.hard_links)
             else:
-                raise GiveUp("Invalid compression method %s"%self.compression_method +
-                             "specified for cpio deployment. Pick gzip or bzip2.")
+                # Compress the archive as we write it, rather than writing it
+                # out and then compressing it
+                with open(temp_file, "wb") as f_out:
+                    proc = subprocess.Popen([program, "-c"], stdin=subprocess.PIPE,
+                                            stdout=f_out, env=utils.current_env())
+                    try:
+                        the_hierarchy.render(proc.stdin, True, self.hard_links)
+                    finally:
+                        proc.stdin.close()
+                        retcode = proc.wait()
+                if retcode:
+                    raise GiveUp("Compressing %s with %s failed with"
+                                 " retcode %d"%(deploy_file, program, retcode))
+            os.rename(temp_file, target_file)
+        except:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
 
 
 class CIApplyChmod(CpioInstructionImplementor):
@@ -339,7 +381,7 @@ class CpioWrapper(object):
 
 
 def create(builder, target_file, name, compressionMethod = None,
-           pruneFunc = None):
+           pruneFunc = None, hardLinks = "inode"):
     """
     Create a CPIO deployment and return it.
 
@@ -366,6 +408,16 @@ def create(builder, target_file, name, compressionMethod = None,
       something like deb.deb_prune, it's intended to remove spurious stuff like
       manpages from initrds and the like.
 
+    * 'hardLinks' says which regular files to store in the archive as hard
+      links to each other, so that their data is only stored once:
+
+        * None means none of them
+        * 'inode' means files that are hard links in the install directories
+        * 'content' means those, and also files with the same content
+
+      In all cases, files are only linked if they have the same mode, owner
+      and group in the archive.
+
     Normal usage is thus something like::
 
         fw = cpio.create(builder, 'firmware.cpio', deployment)
@@ -402,7 +454,8 @@ def create(builder, target_file, name, compressionMethod = None,
                      " should be a string or a package/deployment label,"
                      " not %s"%type(name))
 
-    the_action = CpioDeploymentBuilder(target_file, [], compressionMethod, pruneFunc)
+    the_action = CpioDeploymentBuilder(target_file, [], compressionMethod, pruneFunc,
+                                       hardLinks)
 
     the_rule = depend.Rule(label, the_action)
 
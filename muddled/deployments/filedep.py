@@ -4,7 +4,13 @@ role subdirectory in the /deployed directory, applying
 appropriate instructions.
 """
 
+import copy
+import cPickle
+import errno
+import hashlib
 import os
+import shutil
+import stat
 
 import muddled.env_store
 import muddled.depend as depend
@@ -14,7 +20,8 @@ import muddled.deployment as deployment
 
 from muddled.depend import Action
 from muddled.deployments.collect import InstructionImplementor, \
-        CollectApplyChown, CollectApplyChmod
+        CollectApplyChown, CollectApplyChmod, change_mode, change_owner, \
+        plan_change_owner, apply_with_privilege
 
 class FIApplyChmod(CollectApplyChmod):
 
@@ -29,30 +36,101 @@ class FIApplyMknod(InstructionImplementor):
     def apply(self, builder, instr, role, path):
 
         if (instr.type == "char"):
-            mknod_type = "c"
+            mknod_type = stat.S_IFCHR
         else:
-            mknod_type = "b"
+            mknod_type = stat.S_IFBLK
 
         abs_file = os.path.join(path, instr.file_name)
-        utils.run0("mknod %s %s %s %s"%(abs_file, mknod_type,
-                                        instr.major, instr.minor))
-        utils.run0("chown %s:%s %s"%(instr.uid, instr.gid, abs_file))
-        utils.run0("chmod %s %s"%(instr.mode, abs_file))
+        try:
+            os.mknod(abs_file, mknod_type | 0600,
+                     os.makedev(int(instr.major), int(instr.minor)))
+        except OSError as e:
+            raise utils.GiveUp("Cannot make device node %s: %s"%(abs_file, e))
+        change_owner(builder, [abs_file], instr.uid, instr.gid)
+        # Only now that it has the right owner do we give it its real mode
+        change_mode([abs_file], instr.mode)
+
+    def plan(self, builder, instr, role, path):
+        if (instr.type == "char"):
+            mknod_type = stat.S_IFCHR
+        else:
+            mknod_type = stat.S_IFBLK
+
+        clear_bits, mode = utils.parse_mode(instr.mode)
+        abs_file = os.path.join(path, instr.file_name)
+        chown = plan_change_owner(builder, [abs_file], instr.uid, instr.gid)
+        return [["mknod", abs_file, mknod_type | mode,
+                 int(instr.major), int(instr.minor), chown[1], chown[2]]]
 
     def needs_privilege(self, builder, instr, role, path):
         return True
 
+# The version of the manifest files we write
+MANIFEST_VERSION = 1
+
+def _scan_install_dirs(install_dirs):
+    """
+    Describe what deploying 'install_dirs' (in order) would produce.
+
+    Returns a dictionary mapping each path, relative to the deployment
+    directory, to a tuple (source path, mode, size, mtime, inode). As with
+    copying the directories in turn, later directories win.
+    """
+    entries = {}
+    for install_dir in install_dirs:
+        if not os.path.isdir(install_dir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(install_dir):
+            rel_dir = os.path.relpath(dirpath, install_dir)
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                entries[os.path.normpath(os.path.join(rel_dir, name))] = \
+                        (path, st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+    return entries
+
+def _remove(path):
+    """
+    Remove 'path', whatever it is, if it exists.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+class _ChangedFileSpec(object):
+    """
+    A filespec that only matches those files of another which have changed.
+    """
+
+    def __init__(self, filespec, changed):
+        self.filespec = filespec
+        self.changed = changed
+
+    def match(self, data_provider):
+        return [f for f in self.filespec.match(data_provider)
+                if os.path.normpath(f.lstrip('/')) in self.changed]
+
 class FileDeploymentBuilder(Action):
     """
     Builds the specified file deployment
     """
 
-    def __init__(self, roles, target_dir):
+    def __init__(self, roles, target_dir, incremental=True):
         """
         role is actually a list of (role, domain) pairs.
+
+        If 'incremental' is true, then we remember what we deployed, and next
+        time only copy (and apply instructions to) what has changed. See
+        deploy_with_domains().
         """
         self.target_dir = target_dir
         self.roles = roles
+        self.incremental = incremental
 
         self.app_dict = {"chown" : CollectApplyChown(),
                          "chmod" : FIApplyChmod(),
@@ -116,8 +194,50 @@ class FileDeploymentBuilder(Action):
         else:
             raise utils.GiveUp("Attempt to build a deployment with an unexpected tag in label %s"%(label))
 
-    def deploy(self, builder, label):
-        deploy_dir = builder.deploy_path(label)
+    def _manifest_path(self, builder, label):
+        """
+        Where we remember what we last deployed.
+        """
+        return os.path.join(builder.db.tag_root(label), ".muddle", "cache",
+                            "deployments", label.name)
+
+    def _instructions_hash(self, builder):
+        """
+        Return a hash of the instructions we would obey, and where from.
+        """
+        hasher = hashlib.sha1()
+        for role, domain in self.roles:
+            hasher.update("%s\0%s\0"%(role, domain))
+            lbl = depend.Label(utils.LabelType.Package, "*", role, "*", domain=domain)
+            pairs = builder.db.scan_instructions(lbl)
+            for filename in sorted(pair[1] for pair in pairs):
+                hasher.update("%s\0"%filename)
+                with open(filename, "rb") as fd:
+                    hasher.update(fd.read())
+        return hasher.hexdigest()
+
+    def _write_manifest(self, path, manifest):
+        utils.ensure_dir(os.path.dirname(path))
+        with open(path + ".new", "wb") as fd:
+            cPickle.dump(manifest, fd, 2)
+        os.rename(path + ".new", path)
+
+    def _read_manifest(self, path):
+        """
+        Return the manifest at 'path', or None if there is no (usable) manifest.
+        """
+        try:
+            with open(path, "rb") as fd:
+                manifest = cPickle.load(fd)
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                cPickle.UnpicklingError):
+            return None
+        if not isinstance(manifest, dict) or \
+                manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def _deploy_everything(self, builder, label, deploy_dir):
         # First off, delete the target directory
         utils.recursively_remove(deploy_dir)
         utils.ensure_dir(deploy_dir)
@@ -130,9 +250,89 @@ class FileDeploymentBuilder(Action):
             install_dir = builder.role_install_path(role, domain = domain)
             utils.recursively_copy(install_dir, deploy_dir, object_exactly=True)
 
+    def _deploy_changes(self, label, deploy_dir, old_entries, new_entries):
+        """
+        Bring 'deploy_dir' up to date, given what was in the install
+        directories when we last deployed, and what is there now.
+
+        Returns the set of (relative) paths we copied.
+        """
+        # Remove things in reverse order, so directory contents go first
+        removed = sorted(set(old_entries) - set(new_entries), reverse=True)
+        for rel in removed:
+            _remove(os.path.join(deploy_dir, rel))
+
+        changed = sorted(rel for rel, entry in new_entries.items()
+                         if old_entries.get(rel) != entry)
+        for rel in changed:
+            src = new_entries[rel][0]
+            dst = os.path.join(deploy_dir, rel)
+            if stat.S_ISDIR(new_entries[rel][1]):
+                if os.path.islink(dst) or (os.path.lexists(dst) and
+                                           not os.path.isdir(dst)):
+                    _remove(dst)
+                if not os.path.isdir(dst):
+                    os.mkdir(dst)
+            else:
+                _remove(dst)
+                utils.copy_file(src, dst, object_exactly=True, preserve=True)
+
+        # Directory metadata goes last, as filling them in changes it
+        for rel in reversed(changed):
+            if stat.S_ISDIR(new_entries[rel][1]):
+                utils.copy_file_metadata(new_entries[rel][0],
+                                         os.path.join(deploy_dir, rel))
+
+        print "> %s: Deployed %d changed item%s, removed %d"%(label.name,
+                len(changed), '' if len(changed) == 1 else 's', len(removed))
+        return set(changed)
+
+    def deploy(self, builder, label):
+        deploy_dir = builder.deploy_path(label)
+
+        if not self.incremental:
+            self._deploy_everything(builder, label, deploy_dir)
+        else:
+            install_dirs = [builder.role_install_path(role, domain=domain)
+                            for role, domain in self.roles]
+            manifest_path = self._manifest_path(builder, label)
+            manifest = self._read_manifest(manifest_path)
+            instructions = self._instructions_hash(builder)
+            new_entries = _scan_install_dirs(install_dirs)
+
+            changed = None
+            if manifest is None:
+                print "> %s: No record of the last deployment"%label.name
+            elif manifest["instructions"] != instructions:
+                print "> %s: Instructions have changed"%label.name
+            elif not os.path.isdir(deploy_dir):
+                print "> %s: Deployment directory is missing"%label.name
+            else:
+                try:
+                    changed = self._deploy_changes(label, deploy_dir,
+                                                   manifest["entries"],
+                                                   new_entries)
+                except (IOError, OSError) as e:
+                    print "> %s: Cannot update deployment (%s)"%(label.name, e)
+
+            if changed is None:
+                # We are about to lose what we deployed last time
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+                self._deploy_everything(builder, label, deploy_dir)
+
+            # Once the instructions have been applied (to the paths that
+            # have changed, or to everything), this becomes our manifest
+            self._write_manifest(manifest_path + ".pending",
+                                 {"version" : MANIFEST_VERSION,
+                                  "instructions" : instructions,
+                                  "entries" : new_entries,
+                                  "changed" : changed})
+
         # This is somewhat tricky as it potentially requires privilege elevation.
-        # Privilege elevation is done by hooking back into ourselves via a
-        # build command to a label we registered earlier.
+        # If it does, we work out which files each instruction applies to, and
+        # hand the resulting plan to a small helper run with sudo (rather than
+        # running all of muddle again with sudo).
         #
         # Note that you cannot split instruction application - once the first
         # privilege-requiring instruction is executed, all further instructions
@@ -159,26 +359,33 @@ class FileDeploymentBuilder(Action):
                                             "instruction %s"%iname +
                                             " found in label %s (filename %s)"%(lbl, fn))
 
-        print "Rerunning muddle to apply instructions .. "
-
-        permissions_label = depend.Label(utils.LabelType.Deployment,
-                                         label.name, None, # XXX label.role,
-                                         utils.LabelTag.InstructionsApplied,
-                                         domain = label.domain)
-
-        if need_root_for:
+        if need_root_for and os.geteuid() != 0:
             print "I need root to do %s - sorry! - running sudo .."%(', '.join(sorted(need_root_for)))
-            utils.run0("sudo %s buildlabel '%s'"%(builder.muddle_binary,
-                                                  permissions_label))
+            self.apply_instructions(builder, label, privileged=True)
         else:
-            utils.run0("%s buildlabel '%s'"%(builder.muddle_binary,
-                                             permissions_label))
+            self.apply_instructions(builder, label)
 
-    def apply_instructions(self, builder, label):
+    def apply_instructions(self, builder, label, privileged=False):
+        """
+        Apply our instructions to our deployment directory.
 
+        If 'privileged' is true, then the instructions are planned, and the
+        resulting plan is then applied as root - see apply_with_privilege().
+        """
+
+        # If we deployed incrementally, we only want to apply instructions
+        # to what we changed
+        manifest_path = self._manifest_path(builder, label)
+        pending = self._read_manifest(manifest_path + ".pending")
+        if pending is None:
+            changed = None
+        else:
+            changed = pending["changed"]
+
+        plan = []
+        deploy_dir = builder.deploy_path(label)
         for role, domain in self.roles:
             lbl = depend.Label(utils.LabelType.Package, "*", role, "*", domain=domain)
-            deploy_dir = builder.deploy_path(label)
             instr_list = builder.load_instructions(lbl)
             for (lbl, fn, instrs) in instr_list:
                 print "File deployment: Applying instructions for role %s, label %s .. "%(role, lbl)
@@ -186,15 +393,30 @@ class FileDeploymentBuilder(Action):
                     # Obey this instruction.
                     iname = instr.outer_elem_name()
                     print 'Instruction:', iname
-                    if iname in self.app_dict:
-                        self.app_dict[iname].apply(builder, instr, role, deploy_dir)
-                    else:
+                    if iname not in self.app_dict:
                         raise utils.GiveUp("File deployments don't know about instruction %s"%iname +
                                             " found in label %s (filename %s)"%(lbl, fn))
+                    if changed is not None:
+                        if hasattr(instr, "filespec"):
+                            instr = copy.copy(instr)
+                            instr.filespec = _ChangedFileSpec(instr.filespec, changed)
+                        elif os.path.lexists(os.path.join(deploy_dir,
+                                                          instr.file_name)):
+                            # We made this device node last time
+                            continue
+                    if privileged:
+                        plan.extend(self.app_dict[iname].plan(builder, instr, role, deploy_dir))
+                    else:
+                        self.app_dict[iname].apply(builder, instr, role, deploy_dir)
+
+        apply_with_privilege(plan)
+
+        if pending is not None:
+            os.rename(manifest_path + ".pending", manifest_path)
 
 
 # Legacy function to register a deployment without domains.
-def deploy(builder, target_dir, name, roles):
+def deploy(builder, target_dir, name, roles, incremental=True):
     """
     Register a file deployment.
 
@@ -217,16 +439,20 @@ def deploy(builder, target_dir, name, roles):
     will also be created.
 
     The deployment should eventually be located at 'target_dir'.
+
+    'incremental' is as for deploy_with_domains().
     """
     new_roles = [ ]
     for r in roles:
         new_roles.append( (r, builder.default_domain) )
 
-    return deploy_with_domains(builder, target_dir, name, new_roles)
+    return deploy_with_domains(builder, target_dir, name, new_roles,
+                               incremental)
 
 
 # A function which registers the standard dependencies for a file deployment.
-def deploy_with_domains(builder, target_dir, name, role_domains):
+def deploy_with_domains(builder, target_dir, name, role_domains,
+                        incremental=True):
     """
     Register a file deployment.
 
@@ -248,9 +474,18 @@ def deploy_with_domains(builder, target_dir, name, role_domains):
     will also be created.
 
     The deployment should eventually be located at 'target_dir'.
+
+    If 'incremental' is true, then each deployment is remembered (in
+    .muddle/cache/deployments), and the next deployment only copies what
+    has been added to or changed in the install directories since then,
+    removes what has gone, and only applies instructions to what it copied.
+    If there is no record of the last deployment, or the instructions have
+    changed, then everything is deployed afresh, as happens if 'incremental'
+    is false. "muddle redeploy" keeps the 'deploy/' directory of such a
+    deployment, so that it can be updated in this way.
     """
 
-    the_action = FileDeploymentBuilder(role_domains, target_dir)
+    the_action = FileDeploymentBuilder(role_domains, target_dir, incremental)
 
     dep_label = depend.Label(utils.LabelType.Deployment, name, None,
                              utils.LabelTag.Deployed)
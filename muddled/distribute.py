@@ -30,6 +30,7 @@ Actions and mechanisms relating to distributing build trees
 import os
 from fnmatch import fnmatchcase
 
+from muddled.db import TagDirectory, get_tag_store
 from muddled.depend import Action, Rule, Label, needed_to_build, label_list_to_string
 from muddled.utils import GiveUp, MuddleBug, LabelTag, LabelType, \
         copy_without, normalise_dir, find_local_relative_root, \
@@ -832,6 +833,22 @@ def distribute_package(builder, name, label, obj=False, install=True,
             for name in actual_names:
                 distribute_checkout_files(builder, name, make_co, [makefile_name])
 
+def _copy_logged_tags(src_store, tgt_root, type, name, leaves=None):
+    """Copy tags from a TagLog into the equivalent tag files under 'tgt_root'.
+
+    Copies the tags for labels of the given 'type' and 'name' - and, if
+    'leaves' is given, only those whose <role>-<tag> is in 'leaves'.
+
+    The distributed build tree always uses tag files (see "muddle help
+    tag-store").
+    """
+    prefix = os.path.join(type, name, '')
+    tgt_store = TagDirectory(tgt_root)
+    for key, when in src_store.items().items():
+        if key.startswith(prefix):
+            if leaves is None or key[len(prefix):] in leaves:
+                tgt_store.set(key, when)
+
 def _set_checkout_tags(builder, label, target_dir):
     """Copy checkout muddle tags
     """
@@ -845,7 +862,12 @@ def _set_checkout_tags(builder, label, target_dir):
     if DEBUG:
         print '..copying %s'%src_tags_dir
         print '       to %s'%tgt_tags_dir
-    copy_without(src_tags_dir, tgt_tags_dir, preserve=True, verbose=VERBOSE)
+    src_store = get_tag_store(os.path.join(root_path, local_root))
+    if src_store.is_log:
+        _copy_logged_tags(src_store, os.path.join(target_dir, local_root),
+                          'checkout', label.name)
+    else:
+        copy_without(src_tags_dir, tgt_tags_dir, preserve=True, verbose=VERBOSE)
 
 def _set_package_tags(builder, label, target_dir, which_tags):
     """Copy package tags.
@@ -869,6 +891,14 @@ def _set_package_tags(builder, label, target_dir, which_tags):
     # and only tags up to having built our obj/ hierarchy
     if not os.path.exists(tgt_tags_dir):
         os.makedirs(tgt_tags_dir)
+
+    src_store = get_tag_store(os.path.join(root_path, local_root))
+    if src_store.is_log:
+        leaves = ['%s-%s'%(label.role, tag) for tag in which_tags]
+        _copy_logged_tags(src_store, os.path.join(target_dir, local_root),
+                          'package', label.name, leaves)
+        return
+
     for tag in which_tags:
         tag_filename = '%s-%s'%(label.role, tag)
         tag_file = os.path.join(src_tags_dir, tag_filename)
@@ -2,11 +2,16 @@
 Contains the mechanics of muddle.
 """
 
+import cPickle
+import errno
+import heapq
 import os
 import re
 import sys
+import tempfile
 import traceback
 
+import muddled.builder_cache as builder_cache
 import muddled.db as db
 import muddled.depend as depend
 import muddled.pkg as pkg
@@ -41,6 +46,11 @@ def check_build_name(name):
                      " 'A'-'Z', 'a'-'z', '0'-'9', '_' or '-')"%name)
 
 
+# The subdirectories of a package's obj directory that set_default_variables()
+# looks for, in the packages it depends on
+OBJ_DIR_LAYOUT = ("include", "lib", "lib/pkgconfig", "share/pkgconfig",
+                  "kerneldir", "kernelsource")
+
 class Builder(object):
     """
     A builder does stuff following rules derived from a build description.
@@ -51,7 +61,9 @@ class Builder(object):
 
     * self.db - The metadata database for this project.
     * self.ruleset - The rules describing this build
-    * self.env - A dictionary of label to environment
+    * self.env - A dictionary of label to environment. If you change this
+      directly (rather than with get_environment_for()), call
+      environments_changed() afterwards.
     * self.default_roles - The roles to build when you don't specify any.
       These will also be used for "guessing" a role for a package when one
       is not specified. '_default_roles' is calculated from this.
@@ -136,6 +148,20 @@ class Builder(object):
         self.unifications = []
         # XXX -----------------------------------------------------------------
 
+        # Remembered by get_dependent_package_dirs() and set_default_variables()
+        # for the rest of this muddle command - see there
+        self._dependent_dirs = {}
+        self._obj_dir_layouts = {}
+
+        # Remembered by list_environments_for(), until our environments
+        # change - see there
+        self._env_index = None
+        self._envs_for_label = {}
+
+        # If true, the commands run to build labels (and their output) are
+        # only written to each label's log, and not shown - see _obey_rule()
+        self.quiet_commands = False
+
         # Guess a default build name
         # Whilst the build description filename should be a legal Python
         # module name (and thus only include alphanumerics and underscores),
@@ -392,7 +418,13 @@ class Builder(object):
         Find all the dependent packages for label and return a set of
         the object directories for each. Mainly used as a helper function
         by ``set_default_variables()``.
+
+        The answer is remembered until the rule set next changes.
         """
+        generation, dirs = self._dependent_dirs.get(label, (None, None))
+        if generation == self.ruleset.generation:
+            return set(dirs)
+
         return_set = set()
         rules = depend.needed_to_build(self.ruleset, label)
         for r in rules:
@@ -408,8 +440,40 @@ class Builder(object):
                     obj_dir = self.package_obj_path(r.target)
                     return_set.add(obj_dir)
 
+        self._dependent_dirs[label] = (self.ruleset.generation,
+                                       frozenset(return_set))
         return return_set
 
+    def _obj_dir_layout(self, obj_dir):
+        """
+        Return which of the OBJ_DIR_LAYOUT subdirectories exist in 'obj_dir'.
+
+        The answer is remembered until a package using 'obj_dir' is
+        (re)installed - see _set_tag().
+        """
+        layout = self._obj_dir_layouts.get(obj_dir)
+        if layout is None:
+            layout = frozenset(name for name in OBJ_DIR_LAYOUT
+                               if os.path.isdir(os.path.join(obj_dir, name)))
+            self._obj_dir_layouts[obj_dir] = layout
+        return layout
+
+    def _set_tag(self, label):
+        """
+        Set the tag for 'label', and forget anything that makes out of date.
+        """
+        self.db.set_tag(label)
+        if (label.type == LabelType.Package and
+            label.tag in (LabelTag.Installed, LabelTag.PostInstalled)):
+            self._obj_dir_layouts.pop(self.package_obj_path(label), None)
+
+    def _refresh_tags(self):
+        """
+        Notice tags set by other processes, and forget what they may make
+        out of date.
+        """
+        self.db.refresh_tags()
+        self._obj_dir_layouts = {}
 
     def set_default_variables(self, label, store):
         """
@@ -581,30 +645,25 @@ class Builder(object):
             set_kernel_dir = None
             set_ksource_dir = None
             for d in dep_dirs:
-                inc_dir = os.path.join(d, "include")
-                if (os.path.exists(inc_dir) and os.path.isdir(inc_dir)):
-                    inc_dirs.append(inc_dir)
+                layout = self._obj_dir_layout(d)
+                if "include" in layout:
+                    inc_dirs.append(os.path.join(d, "include"))
 
-                lib_dir = os.path.join(d, "lib")
-                if (os.path.exists(lib_dir) and os.path.isdir(lib_dir)):
-                    lib_dirs.append(lib_dir)
+                if "lib" in layout:
+                    lib_dirs.append(os.path.join(d, "lib"))
 
-                pkg_dir = os.path.join(d, "lib/pkgconfig")
-                if (os.path.exists(pkg_dir) and os.path.isdir(pkg_dir)):
-                    pkg_dirs.append(pkg_dir)
+                if "lib/pkgconfig" in layout:
+                    pkg_dirs.append(os.path.join(d, "lib/pkgconfig"))
 
                 # Yes, I know, but some debian packages do ..
-                pkg_dir = os.path.join(d, "share/pkgconfig")
-                if (os.path.exists(pkg_dir) and os.path.isdir(pkg_dir)):
-                    pkg_dirs.append(pkg_dir)
+                if "share/pkgconfig" in layout:
+                    pkg_dirs.append(os.path.join(d, "share/pkgconfig"))
 
-                kernel_dir = os.path.join(d, "kerneldir")
-                if (os.path.exists(kernel_dir) and os.path.isdir(kernel_dir)):
-                    set_kernel_dir = kernel_dir
+                if "kerneldir" in layout:
+                    set_kernel_dir = os.path.join(d, "kerneldir")
 
-                ksource_dir = os.path.join(d, "kernelsource")
-                if (os.path.exists(ksource_dir) and os.path.isdir(ksource_dir)):
-                    set_ksource_dir = ksource_dir
+                if "kernelsource" in layout:
+                    set_ksource_dir = os.path.join(d, "kernelsource")
 
             store.set("MUDDLE_INCLUDE_DIRS",
                       " ".join(map(lambda x:utils.maybe_shell_quote(x, True),
@@ -692,26 +751,337 @@ class Builder(object):
                 self.db.clear_tag(r)
 
 
-    def _build_label_env(self, label, env_store):
+    def build_env_for(self, label, base_env=None):
         """
-        Amend the environment, ready for building a label.
-
-        'r' is the rule for how to build the label.
+        Return the environment to use when building a label.
 
-        'env_store' is the environment store holding (most of) the environment
-        we want to use.
+        This is 'base_env' (by default, os.environ) with the default
+        environment variables for the label (see set_default_variables())
+        and then the environments that apply to it (see setup_environment())
+        added.
 
-        It is the caller's responsibility to put the environment BACK when
-        finished with it...
+        The result is a utils.FrozenEnv, and neither 'base_env' nor
+        os.environ are changed.
         """
-        local_store = env_store.Store()
+        if base_env is None:
+            base_env = os.environ
+        env = dict(base_env)
 
         # Add the default environment variables for building this label
+        local_store = env_store.Store()
         self.set_default_variables(label, local_store)
-        local_store.apply(os.environ)
+        local_store.apply(env)
 
         # Add anything the rest of the system has put in.
-        self.setup_environment(label, os.environ)
+        self.setup_environment(label, env)
+        return utils.FrozenEnv(env)
+
+    def _obey_rule(self, rule):
+        """
+        Run the rule's action, in the environment for the rule's target.
+
+        The action's commands are run in that environment (see
+        utils.using_env()), and os.environ is left alone. Asserting the
+        target's tag is left to the caller.
+
+        The commands, and their output, are also written to the target's
+        log file (see db.log_file_name()), replacing whatever was logged
+        when it was last built. If self.quiet_commands is true, they are
+        only written there.
+        """
+        # The action may run other muddle processes, which need to see
+        # the tags we have set so far
+        self.db.flush_tags()
+
+        if rule.action:
+            log_file = self.db.log_file_name(rule.target)
+            with utils.using_env(self.build_env_for(rule.target)), \
+                 utils.logging_output(log_file, quiet=self.quiet_commands):
+                rule.action.build_label(self, rule.target)
+
+    def _start_rule_in_child(self, rule):
+        """
+        Fork a child process to obey 'rule', and return its process id.
+
+        The child runs the action, in the environment for the label being
+        built (as in the parent, os.environ is not changed), and exits with
+        status 0 for success or non-zero for failure. It does not assert any tags -
+        that is left to the parent, once it knows the child succeeded.
+        """
+        # Don't let the child inherit (and so repeat) any buffered output,
+        # or any unwritten tag changes
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.db.flush_tags()
+        pid = os.fork()
+        if pid:
+            return pid
+
+        retcode = 1
+        try:
+            try:
+                self._obey_rule(rule)
+                retcode = 0
+            except GiveUp as e:
+                print >> sys.stderr, 'Failure building %s\n%s'%(rule.target, e)
+                if e.retcode:
+                    retcode = e.retcode
+            except BaseException:
+                print >> sys.stderr, 'Failure building %s'%rule.target
+                traceback.print_exc()
+        finally:
+            try:
+                self.db.flush_tags()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(retcode)
+
+    def build_labels_in_parallel(self, labels, jobs, silent=False):
+        """
+        Build the given labels, obeying up to 'jobs' rules at the same time.
+
+        The rules needed to build all of the labels are gathered together
+        (as by 'build_label()'), and each rule is obeyed as soon as all the
+        rules it depends on have been obeyed.
+
+        Each action is run in its own child process, which sets up its own
+        environment for the label being built. The tag for a label is only
+        set (by us, in the parent) when its child has succeeded.
+
+        Rules for transient labels, and rules with no action, are obeyed
+        here rather than in a child, since their results must persist in
+        this process.
+
+        If any rule fails, no more rules are started, but we wait for those
+        that are already running before raising a GiveUp.
+        """
+        rule_list = []
+        seen = set()
+        for label in labels:
+            rules = depend.needed_to_build(self.ruleset, label,
+                                           useTags=True, useMatch=True)
+            if not rules:
+                print "There is no rule to build label %s"%label
+            for r in rules:
+                if id(r) not in seen:
+                    seen.add(id(r))
+                    rule_list.append(r)
+
+        if not rule_list:
+            return
+
+        prerequisites = depend.rule_list_prerequisites(rule_list)
+        waiting_for = []
+        needed_by = [ [] for r in rule_list ]
+        ready = []
+        for index, before in enumerate(prerequisites):
+            waiting_for.append(len(before))
+            for other in before:
+                needed_by[other].append(index)
+            if not before:
+                ready.append(index)
+        # Always choose the earliest ready rule, so that the order we build
+        # in stays as close as possible to the order a serial build would use
+        heapq.heapify(ready)
+
+        def finished(index):
+            for other in needed_by[index]:
+                waiting_for[other] -= 1
+                if waiting_for[other] == 0:
+                    heapq.heappush(ready, other)
+
+        running = {}
+        failed = []
+        while (ready and not failed) or running:
+            while ready and not failed and len(running) < jobs:
+                index = heapq.heappop(ready)
+                r = rule_list[index]
+                if self.db.is_tag(r.target):
+                    # Don't build stuff that's already built ..
+                    finished(index)
+                    continue
+
+                if not silent:
+                    print "> Building %s"%(r.target)
+
+                if r.action is None or r.target.transient:
+                    # Obeyed here, but there may be children running, so we
+                    # must not just give up if it fails
+                    try:
+                        self._obey_rule(r)
+                    except GiveUp as e:
+                        print >> sys.stderr, 'Failure building %s\n%s'%(r.target, e)
+                        failed.append(r.target)
+                        continue
+                    self._set_tag(r.target)
+                    finished(index)
+                else:
+                    running[self._start_rule_in_child(r)] = index
+
+            if not running:
+                continue
+
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            index = running.pop(pid, None)
+            if index is None:
+                # Not one of ours - presumably started by an action
+                continue
+            r = rule_list[index]
+            # The child may have changed other tags
+            self._refresh_tags()
+            if status == 0:
+                self._set_tag(r.target)
+                finished(index)
+            else:
+                failed.append(r.target)
+
+        if failed:
+            raise GiveUp('Failed to build %s'%label_list_to_string(failed,
+                                                                  join_with=', '))
+
+    def _start_function_in_child(self, function, item):
+        """
+        Fork a child process to call 'function(item)'.
+
+        Returns a tuple of (pid, output_file, result_file). The child writes
+        its stdout and stderr to 'output_file', and a pickled tuple of the
+        value returned and the GiveUp exception raised (either of which may
+        be None) to 'result_file'.
+        """
+        out_fd, out_path = tempfile.mkstemp(prefix='muddle-output-')
+        res_fd, res_path = tempfile.mkstemp(prefix='muddle-result-')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.db.flush_tags()
+        pid = os.fork()
+        if pid:
+            os.close(out_fd)
+            os.close(res_fd)
+            return pid, out_path, res_path
+
+        try:
+            os.dup2(out_fd, 1)
+            os.dup2(out_fd, 2)
+            value = exception = None
+            try:
+                value = function(item)
+            except GiveUp as e:
+                exception = e
+            except BaseException:
+                exception = MuddleBug('Failure processing %s\n%s'%(item,
+                                      traceback.format_exc()))
+            self.db.flush_tags()
+            if exception is not None:
+                # Not every GiveUp can be pickled, and some that can cannot
+                # be unpickled (ShellError, for instance, wants more
+                # arguments than it keeps), but its text will do
+                try:
+                    cPickle.loads(cPickle.dumps(exception, 2))
+                except Exception:
+                    exception = GiveUp(str(exception), exception.retcode)
+            try:
+                data = cPickle.dumps((value, exception), 2)
+            except Exception:
+                data = cPickle.dumps((None, exception), 2)
+            os.write(res_fd, data)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+    def _finish_function_in_child(self, item, status, out_path, res_path):
+        """
+        Collect the results of a child started by _start_function_in_child.
+
+        Returns a tuple of (output, value, exception).
+        """
+        try:
+            with open(out_path, 'rb') as fd:
+                output = fd.read()
+            with open(res_path, 'rb') as fd:
+                data = fd.read()
+        finally:
+            os.remove(out_path)
+            os.remove(res_path)
+
+        # The child may have changed tags
+        self._refresh_tags()
+
+        if status != 0 or not data:
+            return output, None, MuddleBug('Child process for %s failed, with '
+                                           'status %#x'%(item, status))
+        try:
+            value, exception = cPickle.loads(data)
+        except Exception as e:
+            return output, None, MuddleBug('Cannot read the result of the child'
+                                           ' process for %s: %s'%(item, e))
+        return output, value, exception
+
+    def run_in_children(self, items, function, jobs):
+        """
+        Call 'function(item)' for each of 'items', each in its own child process,
+        with up to 'jobs' of them running at the same time.
+
+        This is a generator. As each child finishes, it yields a tuple of:
+
+        * the item
+        * everything the child wrote to stdout and stderr
+        * the value that 'function' returned (which must be picklable)
+        * the GiveUp exception that 'function' raised, or None
+
+        Returning the output of each child as a whole means that it can be
+        reported in one piece, rather than interleaved with that of others.
+        Any other exception raised by 'function' is reported as a MuddleBug.
+
+        The children share our tags, which we refresh as each one finishes.
+        If the caller stops iterating early, no more children are started,
+        but we still wait for those that are running, and write out what
+        they said.
+        """
+        pending = list(items)
+        pending.reverse()
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < jobs:
+                    item = pending.pop()
+                    pid, out_path, res_path = self._start_function_in_child(function, item)
+                    running[pid] = (item, out_path, res_path)
+
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid not in running:
+                    # Not one of ours - presumably started by something else
+                    continue
+                item, out_path, res_path = running.pop(pid)
+                output, value, exception = self._finish_function_in_child(
+                        item, status, out_path, res_path)
+                yield item, output, value, exception
+        finally:
+            while running:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid not in running:
+                    continue
+                item, out_path, res_path = running.pop(pid)
+                output, value, exception = self._finish_function_in_child(
+                        item, status, out_path, res_path)
+                sys.stdout.write(output)
+                sys.stdout.flush()
 
     def build_label(self, label, silent=False):
         """
@@ -733,17 +1103,8 @@ class Builder(object):
                 if not silent:
                     print "> Building %s"%(r.target)
 
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
-
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
-
-                self.db.set_tag(r.target)
+                self._obey_rule(r)
+                self._set_tag(r.target)
 
     def build_label_with_options(self, label, useDepends = True, useTags = True, silent = False):
         """
@@ -770,17 +1131,8 @@ class Builder(object):
                 if (not silent):
                     print "> Building %s"%(r.target)
 
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
-
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
-
-                self.db.set_tag(r.target)
+                self._obey_rule(r)
+                self._set_tag(r.target)
 
     @property
     def build_name(self):
@@ -1450,6 +1802,7 @@ class Builder(object):
 
         for (k,v) in new_env.items():
             self.env[k] = v
+        self.environments_changed()
 
 
     def add_default_role(self, role):
@@ -1488,39 +1841,76 @@ class Builder(object):
 
         self.default_deployment_labels.append(label)
 
+    def environments_changed(self):
+        """
+        Forget what we remember about which environments apply to which
+        labels.
+
+        This is done for you by get_environment_for() and
+        unify_environments(), but must be called by anything else that
+        adds to (or removes from) self.env, or changes the domain of
+        the labels in it.
+        """
+        self._env_index = None
+        self._envs_for_label = {}
+
+    def _environment_index(self):
+        """
+        Return our index of self.env.
+
+        This is a dictionary mapping (type, name) to a list of the tuples
+        (position, label, environment) for the environment labels with that
+        type and name, plus a list of those tuples for the environment
+        labels with a wildcarded type or name. The position is that of the
+        label in self.env.items(), so that we can keep the order that has
+        always been used for environments that match equally well.
+        """
+        if self._env_index is None:
+            by_name = {}
+            wildcards = []
+            for position, (k, v) in enumerate(self.env.items()):
+                if k.type == '*' or k.name == '*':
+                    wildcards.append((position, k, v))
+                else:
+                    by_name.setdefault((k.type, k.name), []).append((position, k, v))
+            self._env_index = (by_name, wildcards)
+        return self._env_index
+
     def list_environments_for(self, label):
         """
         Return a list of environments that contribute to the environment for
         the given label.
 
         Returns a list of triples (match level, label, environment), in order.
-        """
-        to_apply = [ ]
 
-        for (k,v) in self.env.items():
-            m = k.match(label)
-            if (m is not None):
-                # We matched!
-                to_apply.append((m, k, v))
-
-        if len(to_apply) == 0:
-            # Nothing to do.
-            return [ ]
-
-        # Now sort in order of first component
-        def bespoke_cmp(a,b):
-            (p,q,r) = a
-            (x,y,z) = b
-
-            if (p<x):
-                return -1
-            elif (p>x):
-                return 1
+        The result for each label is remembered until our environments change
+        (see environments_changed()). Changing the content of an environment
+        does not matter, since we return the environments themselves.
+        """
+        to_apply = self._envs_for_label.get(label)
+        if to_apply is None:
+            by_name, wildcards = self._environment_index()
+            if label.type == '*' or label.name == '*':
+                candidates = []
+                for entries in by_name.values():
+                    candidates.extend(entries)
             else:
-                return 0
+                candidates = by_name.get((label.type, label.name), [])
+            candidates = candidates + wildcards
+
+            matches = []
+            for (position, k, v) in candidates:
+                m = k.match(label)
+                if (m is not None):
+                    # We matched!
+                    matches.append((m, position, k, v))
+
+            # Sort by match level, and then by position in self.env.items()
+            matches.sort()
+            to_apply = [(m, k, v) for (m, position, k, v) in matches]
+            self._envs_for_label[label] = to_apply
 
-        to_apply.sort(bespoke_cmp)
-        return to_apply
+        return list(to_apply)
 
 
     def get_environment_for(self, label):
@@ -1533,6 +1923,7 @@ class Builder(object):
         else:
             store = env_store.Store()
             self.env[label] = store
+            self.environments_changed()
             return store
 
 
@@ -2107,12 +2498,25 @@ def load_builder(root_path, muddle_binary, params=None, default_domain=None):
     * If given, 'default_domain' is the default domain name for this
       (sub) build tree. This is used by the "muddle unstamp" command,
       and the muddle_patch.py script.
+
+    If we are loading a top-level build (i.e., 'params' is not given), then
+    we remember the result in .muddle/cache, and use that instead of loading
+    the build description again, until any build description changes. See
+    muddled.builder_cache for details.
     """
 
     builder = Builder(root_path, muddle_binary, params, default_domain=default_domain)
-    can_load = builder._load_build_description()
-    if not can_load:
-        return None
+
+    # Subdomains are only ever loaded as part of loading their parent build,
+    # and are thus cached with it
+    use_cache = params is None and not builder_cache.cache_disabled()
+
+    if not (use_cache and builder_cache.load_builder(builder)):
+        can_load = builder._load_build_description()
+        if not can_load:
+            return None
+        if use_cache:
+            builder_cache.save_builder(builder)
 
     # Are we a release build?
     if builder.is_release_build():
@@ -2225,6 +2629,10 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
     except GiveUp:
         raise GiveUp('Domain name "%s" is not valid'%domain_name)
 
+    # Labels in the sub-build must not share instances with our own labels,
+    # since we are about to change their domain
+    depend.clear_label_cache()
+
     # So, we're wanting our sub-builds to go into the 'domains/' directory
     domain_root_path = os.path.join(root_path, 'domains', domain_name)
 
@@ -2321,6 +2729,11 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
         if rule.action and hasattr(rule.action, '_change_domain'):
             rule.action._change_domain(domain_name)
 
+    # The rule set indexes its targets by domain, so that needs redoing,
+    # as does what we remember about environments
+    ruleset._rebuild_index()
+    domain_builder.environments_changed()
+
     # Now mark the builder as a domain.
     domain_builder.mark_domain(domain_name)
 
@@ -2359,6 +2772,7 @@ def include_domain(builder, domain_name, domain_repo, domain_desc):
     # And its environments...
     for key, value in domain_builder.env.items():
         builder.env[key] = value
+    builder.environments_changed()
 
     # And handle the rest of the stuff we need to do.
     # Note that the _new_sub_domain() call should have handled labels
@@ -10,9 +10,11 @@ import subprocess
 
 import muddled.pkg as pkg
 import muddled.depend as depend
+import muddled.pkgs.dpkg_status as dpkg_status
+import muddled.utils as utils
 import os.path
 from muddled.utils import GiveUp, LabelTag, LabelType
-from muddled.utils import run2, Choice, get_os_version_name
+from muddled.utils import Choice, get_os_version_name
 from muddled.utils import split_debian_version, debian_version_is
 
 class AptAltBuilder(pkg.PackageBuilder):
@@ -44,45 +46,24 @@ class AptAltBuilder(pkg.PackageBuilder):
         self.pkgs_to_install = actual_packages
         
     def current_version(self, pkg):
-        retval, stdout = run2([ "dpkg-query", "-W", 
-                                "-f=${Status} ${Version}\\n", pkg["name"] ],
-                                    show_command=True)
-        if retval:
-            # Assume it's not installed
+        vsn_text = dpkg_status.installed_version(pkg["name"])
+        if vsn_text is None:
             return None
-
-        lines = stdout.splitlines()
-        if len(lines) == 0:
-            return None
-
-        words = lines[0].split()
-        if not (len(words) == 4 and words[2] == 'installed'):
-            return None
-        
-        vsn_text = words[3]
-        vsn = split_debian_version(words[3])
+        vsn = split_debian_version(vsn_text)
         return vsn
 
     def already_installed(self, pkg):
         """
         Decide if a package is installed and the right version
-        """
-        retval, stdout = run2([ "dpkg-query", "-W", "-f=${Status} ${Version}\\n", pkg["name"] ],
-                                    show_command=True)
-        if retval:
-            # Assume it's not installed
-            return False
 
-        lines = stdout.splitlines()
-        if len(lines) == 0:
+        We look it up in the dpkg status database (see dpkg_status.py),
+        rather than running "dpkg-query" for each package.
+        """
+        vsn_text = dpkg_status.installed_version(pkg["name"])
+        if vsn_text is None:
             return False
 
-        words = lines[0].split()
-        if not (len(words) == 4 and words[2] == 'installed'):
-            return False
-        
-        vsn_text = words[3]
-        vsn = split_debian_version(words[3])
+        vsn = split_debian_version(vsn_text)
         if ("exact-version" in pkg):
             r = (debian_version_is(vsn, split_debian_version(pkg['exact-version'])))
             if (r != 0):
@@ -130,7 +111,8 @@ class AptAltBuilder(pkg.PackageBuilder):
                     print ">> Processing %s"%q["name"]
                     print "   : Remove old packages.\n"
                     cmd_list = [ "sudo", "apt-get", "remove", q["name"] ]
-                    rv = subprocess.call(cmd_list)
+                    rv = subprocess.call(cmd_list, env=utils.current_env())
+                    dpkg_status.forget()
                     if (q["repo"] is not None):
                         if (has_additional_repo(builder, q["repo"])):
                             print "   : Already have repo %s"%q["repo"]
@@ -138,12 +120,12 @@ class AptAltBuilder(pkg.PackageBuilder):
                             print "   : Adding repository %s"%q["repo"]
                             cmd_list = [ "sudo", "add-apt-repository",
                                          q["repo"] ]
-                            rv = subprocess.call(cmd_list)
+                            rv = subprocess.call(cmd_list, env=utils.current_env())
                             if (rv != 0):
                                 raise GiveUp("Cannot add repo '%s'"%q["repo"])
                     print ">> Update package lists \n"
                     cmd_list = [ "sudo", "apt-get", "update" ]
-                    rv = subprocess.call(cmd_list)
+                    rv = subprocess.call(cmd_list, env=utils.current_env())
                     # Ignore failures - just means some lists couldn't
                     # be got.
                     to_install = q["name"]
@@ -152,7 +134,9 @@ class AptAltBuilder(pkg.PackageBuilder):
                     print ">> Installing %s"%to_install
                     cmd_list = [ "sudo", "apt-get", "install",
                                  "%s"%to_install ]
-                    rv = subprocess.call(cmd_list)
+                    rv = subprocess.call(cmd_list, env=utils.current_env())
+                    # What is installed has changed, so ask again
+                    dpkg_status.forget()
                     if (rv != 0):
                         raise GiveUp("Cannot install %s"%to_install)
                     # Now ..
@@ -7,9 +7,11 @@ import subprocess
 
 import muddled.pkg as pkg
 import muddled.depend as depend
+import muddled.pkgs.dpkg_status as dpkg_status
+import muddled.utils as utils
 
 from muddled.utils import GiveUp, LabelTag, LabelType
-from muddled.utils import run2, Choice, get_os_version_name
+from muddled.utils import Choice, get_os_version_name
 
 
 class AptGetBuilder(pkg.PackageBuilder):
@@ -83,34 +85,12 @@ class AptGetBuilder(pkg.PackageBuilder):
         """
         Decide if the quoted debian package is already installed.
 
-        We use dpkg-query::
-
-            $ dpkg-query -W -f=\${Status}\\n libreadline-dev
-            install ok installed
-
-        That third word means what it says (installed). Contrast with a package
-        that is either not recognised or has not been downloaded at all::
-
-            $ dpkg-query -W -f=\${Status}\\n a0d
-            dpkg-query: no packages found matching a0d
-
-        So we do some fairly simple processing of the output...
+        We look it up in the dpkg status database (see dpkg_status.py),
+        which is read once for all of our packages (and for any other
+        apt-get builders), rather than running "dpkg-query" for each
+        package.
         """
-        retval, stdout = run2([ "dpkg-query", "-W", "-f=\${Status}\\n'", pkg ],
-                                    show_command=False)
-        if retval:
-            # Assume it's not installed
-            return False
-
-        lines = stdout.splitlines()
-        if len(lines) == 0:
-            return False
-
-        words = lines[0].split()
-        if len(words) == 3 and words[2] == 'installed':
-            return True
-        else:
-            return False
+        return dpkg_status.is_installed(pkg)
 
 
     def build_label(self, builder, label):
@@ -129,7 +109,9 @@ class AptGetBuilder(pkg.PackageBuilder):
                 cmd_list = [ "sudo", "apt-get", "install" ]
                 cmd_list.extend(need_to_install)
                 print "> %s"%(" ".join(cmd_list))
-                rv = subprocess.call(cmd_list)
+                rv = subprocess.call(cmd_list, env=utils.current_env())
+                # Whatever happened, what is installed may have changed
+                dpkg_status.forget()
                 if rv != 0:
                     raise GiveUp("Couldn't install required packages")
 
@@ -10,8 +10,14 @@ binaries which actually work and it avoids having to build
 absolutely everything in your linux yourself.
 
 This package allows you to 'build' a package from a source file in
-a checkout which is a .deb. We run dpkg with enough force options
-to install it in the relevant install directory.
+a checkout which is a .deb. We extract its files (see muddled.debfile)
+into the relevant install directory (or, for a "dev" package, into the
+object directory).
+
+Each extraction is remembered, with a hash of the .deb file, in the
+package's object directory, so that if the .deb has not changed (and the
+files we extracted are still there), building the package again does not
+extract it again.
 
 You still need to provide any relevant instruction files
 (we'll register <filename>.instructions.xml for you automatically
@@ -22,6 +28,7 @@ it's always empty and stored in the object directory).
 """
 
 import muddled.db as db
+import muddled.debfile as debfile
 import muddled.pkg as pkg
 import muddled.rewrite as rewrite
 import muddled.utils as utils
@@ -29,10 +36,97 @@ from muddled.depend import Label
 from muddled.pkg import PackageBuilder
 from muddled.withdir import Directory
 
+import hashlib
 import os
 import stat
 
+# Where, in a package's object directory, we remember what we've extracted
+EXTRACTED_DIR = '.deb-extracted'
+
+def _extraction_record(deb_path, places, link_root, record_dir):
+    """
+    Return the name of the file that remembers extracting 'deb_path' to
+    'places' (with 'link_root').
+    """
+    key = hashlib.sha1(repr((os.path.abspath(deb_path), places,
+                             link_root))).hexdigest()
+    return os.path.join(record_dir, '%s-%s'%(os.path.basename(deb_path), key))
+
+def _already_extracted(deb_path, record_file):
+    """
+    Is 'record_file' a record of extracting 'deb_path' as it is now, with
+    everything we extracted still there?
+
+    The record is the SHA1 hash, size and modification time of the .deb,
+    followed by the paths we extracted, one per line. We only calculate the
+    hash again if the size or modification time have changed, and if only
+    they have, we update the record.
+    """
+    try:
+        with open(record_file) as fd:
+            lines = fd.read().splitlines()
+    except IOError:
+        return False
+    if not lines:
+        return False
+    try:
+        old_hash, old_size, old_mtime = lines[0].split()
+        old_size = int(old_size)
+        old_mtime = float(old_mtime)
+    except ValueError:
+        return False
+    st = os.stat(deb_path)
+    if (st.st_size, st.st_mtime) != (old_size, old_mtime):
+        if debfile.file_hash(deb_path) != old_hash:
+            return False
+        lines[0] = '%s %d %r'%(old_hash, st.st_size, st.st_mtime)
+        _write_record(record_file, lines)
+    for path in lines[1:]:
+        if not os.path.lexists(path):
+            return False
+    return True
+
+def _write_record(record_file, lines):
+    utils.ensure_dir(os.path.dirname(record_file), verbose=False)
+    temp_file = '%s.new'%record_file
+    with open(temp_file, 'w') as fd:
+        for line in lines:
+            fd.write('%s\n'%line)
+    os.rename(temp_file, record_file)
+
+def extract_deb(deb_path, places, record_dir, link_root=None):
+    """
+    Extract the files from 'deb_path' into 'places', unless that has already
+    been done for the same .deb.
+
+    'places' and 'link_root' are as for debfile.extract(). What we extract
+    is remembered in 'record_dir', which should be in the package's object
+    directory, so that cleaning the package forgets it.
+    """
+    record_file = _extraction_record(deb_path, places, link_root, record_dir)
+    if _already_extracted(deb_path, record_file):
+        print "> %s is already extracted"%deb_path
+        return
+
+    print "> Extracting %s"%deb_path
+    # Forget what we had, in case we fail part way through
+    if os.path.exists(record_file):
+        os.remove(record_file)
+    st = os.stat(deb_path)
+    file_hash = debfile.file_hash(deb_path)
+    written = debfile.extract(deb_path, places, link_root)
+    _write_record(record_file, ['%s %d %r'%(file_hash, st.st_size, st.st_mtime)]
+                               + written)
+
 def rewrite_links(inv, label):
+    """
+    Rewrite the symbolic links in the object directory for 'label', so that
+    absolute links are relative to the object directory, and relative links
+    become absolute.
+
+    extract_into_obj() now does this as it extracts each link, so this is
+    only needed for links made in some other way.
+    """
     obj_dir = inv.package_obj_path(label)
 
     # Now, we walk obj_dir. For every symlink we find to '/' something,
@@ -81,41 +175,35 @@ def rewrite_links(inv, label):
 
 
 def extract_into_obj(inv, co_name, label, pkg_file):
+    """
+    Extract 'pkg_file', from checkout 'co_name', into the object directory
+    for 'label'.
+
+    Everything is extracted into obj/, and the files in include/, lib/,
+    usr/include/, usr/lib/ and usr/share/ are also extracted into the
+    include/, lib/ and share/ directories, where other packages will look
+    for them. Symbolic links are rewritten as described in rewrite_links().
+    """
     tmp = Label(utils.LabelType.Checkout, co_name, domain=label.domain)
     co_dir = inv.checkout_path(tmp)
     obj_dir = inv.package_obj_path(label)
-    dpkg_cmd = ["dpkg-deb", "-X",
-                os.path.join(co_dir, pkg_file),
-                os.path.join(obj_dir, "obj")]
-    utils.run0(dpkg_cmd)
-
-    # Now install any include or lib files ..
-    installed_into = os.path.join(obj_dir, "obj")
-    inc_dir = os.path.join(obj_dir, "include")
-    lib_dir = os.path.join(obj_dir, "lib")
-    lib_dir = os.path.join(obj_dir, "share")
-
-    utils.ensure_dir(inc_dir)
-    utils.ensure_dir(lib_dir)
-
-    # Copy everything in usr/include ..
-    for i in (("include", "include"), ("lib", "lib"),
-              ("usr/include", "include"), ("usr/lib", "lib"),
-              ("usr/share", "share")):
-        (src,dst) = i
-        src_path = os.path.join(installed_into, src)
-        dst_path= os.path.join(obj_dir, dst)
-
-        if (os.path.exists(src_path) and os.path.isdir(src_path)):
-            utils.copy_without(src_path,
-                               dst_path,
-                               without = None,
-                               object_exactly = True)
+
+    for name in ("obj", "include", "lib", "share"):
+        utils.ensure_dir(os.path.join(obj_dir, name), verbose=False)
+
+    places = [("", os.path.join(obj_dir, "obj"))]
+    for (src, dst) in (("include", "include"), ("lib", "lib"),
+                       ("usr/include", "include"), ("usr/lib", "lib"),
+                       ("usr/share", "share")):
+        places.append((src, os.path.join(obj_dir, dst)))
+
+    extract_deb(os.path.join(co_dir, pkg_file), places,
+                os.path.join(obj_dir, EXTRACTED_DIR), link_root=obj_dir)
 
 
 class DebDevAction(PackageBuilder):
     """
-    Use dpkg to extract debian archives into obj/include and obj/lib
+    Extract debian archives into obj/include and obj/lib
     directories so we can use them to build other packages.
     """
     def __init__(self, name, role, co, pkg_name, pkg_file,
@@ -164,15 +252,12 @@ class DebDevAction(PackageBuilder):
         elif (tag == utils.LabelTag.Installed):
             # Extract into /obj
             inv = builder
+            # (which also rewrites all the absolute links to be relative to
+            # the object directory)
             extract_into_obj(inv, self.co_name, label, self.pkg_file)
             if (self.nonDevPkgFile is not None):
                 extract_into_obj(inv, self.nonDevCoName, label, self.nonDevPkgFile)
 
-            # Now we rewrite all the absolute links to be relative to the install
-            # directory.
-            rewrite_links(inv, label)
-
-
         elif (tag == utils.LabelTag.PostInstalled):
             if self.post_install_makefile is not None:
                 inv = builder
@@ -199,7 +284,7 @@ class DebDevAction(PackageBuilder):
 
 class DebAction(PackageBuilder):
     """
-    Use dpkg to extract debian archives from the given
+    Extract debian archives from the given
     checkout into the install directory.
     """
 
@@ -265,10 +350,10 @@ class DebAction(PackageBuilder):
             tmp = Label(utils.LabelType.Checkout, self.co_name, domain=label.domain)
             co_dir = inv.checkout_path(tmp)
 
-            # Using dpkg doesn't work here for many reasons.
-            dpkg_cmd = ["dpkg-deb", "-X", os.path.join(co_dir, self.pkg_file),
-                        inst_dir]
-            utils.run0(dpkg_cmd)
+            # Using dpkg doesn't work here for many reasons, so we just
+            # extract the files, as "dpkg-deb -X" would
+            extract_deb(os.path.join(co_dir, self.pkg_file), [("", inst_dir)],
+                        os.path.join(inv.package_obj_path(label), EXTRACTED_DIR))
 
             # Pick up any instructions that got left behind
             instr_file = self.instr_name
@@ -0,0 +1,210 @@
+"""
+What Debian packages are installed on this machine, according to dpkg.
+
+The apt-get builders (see aptget.py and aptalt.py) need to know, for each
+of the packages they look after, whether it is installed, and at what
+version. Asking "dpkg-query" about each package in turn means starting a
+new process for each one, every time the builder's label is built, which
+adds up for a role that needs more than a few packages.
+
+Instead, we read the dpkg status database (normally /var/lib/dpkg/status)
+once, the first time anyone asks, and answer all questions from that. If
+the database cannot be read, we ask "dpkg-query" about all packages at
+once, instead.
+
+Anything that installs or removes packages (for instance, by running
+"apt-get install") should call forget() afterwards, so that we read the
+database again the next time we are asked.
+"""
+
+import muddled.utils as utils
+
+# Where dpkg keeps its record of the packages it knows about
+STATUS_FILE = '/var/lib/dpkg/status'
+
+# The index, once we have read it
+_the_index = None
+
+class DpkgStatus(object):
+    """
+    The status and version of each package known to dpkg.
+
+    Packages are looked up by name, or by "<name>:<architecture>". A plain
+    name finds an installed package of that name for any architecture, if
+    there is one.
+    """
+
+    def __init__(self):
+        # Package name -> (status, version)
+        self.packages = {}
+
+    def add(self, name, arch, status, version):
+        """
+        Remember what dpkg says about package 'name' for architecture 'arch'.
+        """
+        entry = (status, version)
+        if arch:
+            self.packages['%s:%s'%(name, arch)] = entry
+        old = self.packages.get(name)
+        if old is None or (not _is_installed(old[0]) and _is_installed(status)):
+            self.packages[name] = entry
+
+    def status(self, name):
+        """
+        Return the dpkg status of package 'name' (for instance, "install ok
+        installed"), or None if dpkg does not know about it.
+        """
+        entry = self.packages.get(name)
+        return entry[0] if entry else None
+
+    def is_installed(self, name):
+        """
+        Is package 'name' installed?
+        """
+        return _is_installed(self.status(name))
+
+    def version(self, name):
+        """
+        Return the version of package 'name', as a string, or None if it is
+        not installed.
+        """
+        entry = self.packages.get(name)
+        if entry and _is_installed(entry[0]):
+            return entry[1]
+        return None
+
+    def __len__(self):
+        return len(self.packages)
+
+def _is_installed(status):
+    """
+    Does dpkg status 'status' mean the package is installed?
+
+    The status is "<wanted> <error> <state>", and we only care about the
+    last of those.
+
+    >>> _is_installed('install ok installed')
+    True
+    >>> _is_installed('deinstall ok config-files')
+    False
+    >>> _is_installed(None)
+    False
+    """
+    if not status:
+        return False
+    words = status.split()
+    return len(words) == 3 and words[2] == 'installed'
+
+def parse_status_file(fd):
+    """
+    Read a dpkg status database from the open file 'fd', and return a
+    DpkgStatus describing it.
+
+    The database is a sequence of paragraphs, one for each package,
+    separated by blank lines. Each paragraph is a sequence of "<field>:
+    <value>" lines, where lines that start with whitespace continue the
+    previous value. We only care about a few of the fields.
+
+    >>> from StringIO import StringIO
+    >>> index = parse_status_file(StringIO('''\\
+    ... Package: libc6
+    ... Status: install ok installed
+    ... Architecture: amd64
+    ... Version: 2.19-0ubuntu6
+    ... Description: GNU C Library: Shared libraries
+    ...  Contains the standard libraries.
+    ...
+    ... Package: bison
+    ... Status: deinstall ok config-files
+    ... Version: 2:3.0.2.dfsg-2
+    ... '''))
+    >>> index.is_installed('libc6'), index.version('libc6:amd64')
+    (True, '2.19-0ubuntu6')
+    >>> index.is_installed('bison'), index.version('bison'), index.status('bison')
+    (False, None, 'deinstall ok config-files')
+    >>> index.is_installed('flex')
+    False
+    """
+    index = DpkgStatus()
+    fields = {}
+    for line in fd:
+        if line[:1] in (' ', '\t'):
+            continue
+        line = line.rstrip('\n')
+        if not line.strip():
+            if fields:
+                _add_paragraph(index, fields)
+                fields = {}
+            continue
+        name, sep, value = line.partition(':')
+        if sep and name in ('Package', 'Status', 'Version', 'Architecture'):
+            fields[name] = value.strip()
+    if fields:
+        _add_paragraph(index, fields)
+    return index
+
+def _add_paragraph(index, fields):
+    if 'Package' in fields:
+        index.add(fields['Package'], fields.get('Architecture'),
+                  fields.get('Status'), fields.get('Version'))
+
+def _ask_dpkg_query():
+    """
+    Ask dpkg-query about all the packages it knows, and return a DpkgStatus.
+    """
+    retcode, text = utils.run2(['dpkg-query', '-W',
+                                '-f=${Package}\t${Architecture}\t'
+                                '${Status}\t${Version}\n'],
+                               show_command=False)
+    index = DpkgStatus()
+    if retcode:
+        # Assume nothing is installed
+        return index
+    for line in text.splitlines():
+        parts = line.split('\t')
+        if len(parts) == 4:
+            index.add(*parts)
+    return index
+
+def get_index(status_file=None):
+    """
+    Return the DpkgStatus for this machine, reading it if necessary.
+
+    If 'status_file' is given, read that instead of STATUS_FILE (the
+    result is not remembered).
+    """
+    global _the_index
+    if status_file:
+        with open(status_file) as fd:
+            return parse_status_file(fd)
+    if _the_index is None:
+        try:
+            with open(STATUS_FILE) as fd:
+                _the_index = parse_status_file(fd)
+        except IOError:
+            _the_index = _ask_dpkg_query()
+    return _the_index
+
+def forget():
+    """
+    Forget what we know, so that the next get_index() reads it again.
+
+    Call this after installing or removing packages.
+    """
+    global _the_index
+    _the_index = None
+
+def is_installed(name):
+    """
+    Is Debian package 'name' installed on this machine?
+    """
+    return get_index().is_installed(name)
+
+def installed_version(name):
+    """
+    Return the installed version of Debian package 'name', as a string, or
+    None if it is not installed.
+    """
+    return get_index().version(name)
+
+# End file.
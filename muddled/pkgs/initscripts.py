@@ -50,7 +50,7 @@ class InitScriptBuilder(pkg.PackageBuilder):
             utils.ensure_dir(tgt_dir)
             tgt_file = os.path.join(tgt_dir, self.script_name)
             print "> Writing %s .. "%(tgt_file)
-            subst.subst_file(src_file, tgt_file, None, os.environ)
+            subst.subst_file(src_file, tgt_file, None, utils.current_env())
             os.chmod(tgt_file, 0755)
 
             # Write the setvars script
@@ -82,22 +82,25 @@ class MakeBuilder(PackageBuilder):
         utils.ensure_dir(builder.package_obj_path(co_label))
         utils.ensure_dir(builder.package_install_path(co_label))
 
-    def _amend_env(self, co_path):
-        """Amend the environment before building a label
+    def _amend_env(self, co_path, env):
+        """Return the environment for building a label, amended from 'env'
         """
         # XXX Experimentally set MUDDLE_SRC for the "make" here, where we need it
-        os.environ["MUDDLE_SRC"] = co_path
+        changes = {"MUDDLE_SRC": co_path}
+        removals = []
         # XXX
 
         # We really do want PKG_CONFIG_LIBDIR here - it prevents pkg-config
         # from finding system-installed packages.
         if (self.usesAutoconf):
-            #print "> setting PKG_CONFIG_LIBDIR to %s"%(os.environ['MUDDLE_PKGCONFIG_DIRS_AS_PATH'])
-            os.environ['PKG_CONFIG_LIBDIR'] = os.environ['MUDDLE_PKGCONFIG_DIRS_AS_PATH']
-        elif(os.environ.has_key('PKG_CONFIG_LIBDIR')):
+            #print "> setting PKG_CONFIG_LIBDIR to %s"%(env['MUDDLE_PKGCONFIG_DIRS_AS_PATH'])
+            changes['PKG_CONFIG_LIBDIR'] = env['MUDDLE_PKGCONFIG_DIRS_AS_PATH']
+        elif('PKG_CONFIG_LIBDIR' in env):
             # Make sure that pkg-config uses default if we're not setting it.
             #print "> removing PKG_CONFIG_LIBDIR from environment"
-            del os.environ['PKG_CONFIG_LIBDIR']
+            removals.append('PKG_CONFIG_LIBDIR')
+
+        return utils.FrozenEnv(env).amended(changes, removals)
 
     def _make_command(self, builder, makefile_name):
         return ['make', '-f', makefile_name]
@@ -116,8 +119,8 @@ class MakeBuilder(PackageBuilder):
         # XXX try...
         tmp = Label(utils.LabelType.Checkout, self.co, domain=label.domain)
         co_path =  builder.db.get_checkout_path(tmp)
-        with Directory(co_path):
-            self._amend_env(co_path)
+        env = self._amend_env(co_path, utils.current_env())
+        with utils.using_env(env), Directory(co_path):
 
             makefile_name = deduce_makefile_name(self.makefile_name,
                                                  self.per_role_makefiles,
@@ -0,0 +1,356 @@
+"""
+A server that answers "muddle query" commands for a build tree.
+
+Muddle Makefiles often ask muddle about the build, as (for instance)
+"$(shell $(MUDDLE) query objdir package:fred{x86})". Each of those runs
+muddle again, which means starting Python, importing all of muddle, and
+loading the build description (or its cache, see builder_cache.py) again,
+and a build may do this many times for each package.
+
+"muddle query-server start" starts a server process for the build tree,
+which keeps the Builder it has already loaded, and listens on the unix
+domain socket .muddle/query.sock. Whenever muddle is asked to run a "query"
+command, it first tries to connect to that socket (see muddled/__main__.py,
+which does this without importing the rest of muddle), and if it can, it
+sends the command to the server, and prints out the answer. If there is no
+server (or it does not answer), muddle runs the command itself, as normal.
+
+For each query, the server checks whether the build description (or the
+.muddle files that say where it is) has changed, in the same way as the
+builder cache, and if so loads it again. It then forks a child process to
+answer the query, so that nothing the query does (changing directory or
+environment, or remembering things in the Builder) can affect any other
+query, and so that it can answer several queries at the same time.
+
+The server stops when asked to ("muddle query-server stop"), when its
+socket is removed, or when it has not been asked anything for IDLE_TIMEOUT
+seconds.
+
+Each request, and each reply, is a dictionary, sent as a 4 byte length
+followed by the dictionary as marshalled by the 'marshal' module. A request
+to run a command is::
+
+    {'args': <command words>, 'cwd': <directory>, 'env': <environment>}
+
+and its reply is::
+
+    {'retcode': <return code>, 'output': <output of the command>}
+
+A request may instead be {'status': True} or {'stop': True}, whose reply is
+the same, with a report for its 'output'.
+
+Setting the environment variable MUDDLE_NO_QUERY_SERVER (to anything) stops
+muddle asking the server.
+"""
+
+import errno
+import marshal
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from StringIO import StringIO
+
+import muddled.builder_cache as builder_cache
+
+from muddled.utils import GiveUp, MuddleBug, ShellError
+
+# The server's socket, relative to the root of the build tree. This must
+# agree with muddled/__main__.py
+SOCKET_NAME = os.path.join('.muddle', 'query.sock')
+
+# How long the server waits for a request before it gives up, in seconds
+IDLE_TIMEOUT = 2*60*60
+
+# How often the server checks that its socket is still there, in seconds
+POLL_INTERVAL = 60
+
+def socket_path(root_path):
+    return os.path.join(root_path, SOCKET_NAME)
+
+def _short_path(path):
+    """
+    Return a name for 'path' that is as short as possible.
+
+    Unix domain socket names are limited to about 100 characters, so we
+    use the path relative to the current directory if that is shorter.
+    """
+    relative = os.path.relpath(path)
+    if len(relative) < len(path):
+        return relative
+    return path
+
+def send_message(sock, message):
+    data = marshal.dumps(message)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _receive_exactly(sock, length):
+    parts = []
+    while length:
+        data = sock.recv(min(length, 65536))
+        if not data:
+            raise EOFError('Connection closed')
+        parts.append(data)
+        length -= len(data)
+    return ''.join(parts)
+
+def receive_message(sock):
+    length, = struct.unpack('!I', _receive_exactly(sock, 4))
+    return marshal.loads(_receive_exactly(sock, length))
+
+def ask_server(root_path, request, timeout=None):
+    """
+    Send 'request' to the query server for 'root_path', and return its reply.
+
+    Returns None if there is no server (or it does not answer).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(_short_path(socket_path(root_path)))
+        send_message(sock, request)
+        return receive_message(sock)
+    except (socket.error, EOFError, ValueError, struct.error):
+        return None
+    finally:
+        sock.close()
+
+class QueryServer(object):
+    """
+    Answers "muddle query" commands for a build tree, using a Builder that
+    it keeps loaded.
+    """
+
+    def __init__(self, builder, muddle_binary):
+        self.root_path = builder.db.root_path
+        self.muddle_binary = muddle_binary
+        self.started = time.time()
+        self.answered = 0
+        self.loads = 1
+        self._set_builder(builder)
+
+    def _set_builder(self, builder):
+        self.builder = builder
+        self.build_desc_dirs = builder_cache.build_description_dirs(builder)
+        self.key = self._cache_key()
+
+    def _cache_key(self):
+        return builder_cache.cache_key(self.root_path, None,
+                                       self.build_desc_dirs)
+
+    def reload_if_changed(self):
+        """
+        Load the build description again, if it has changed.
+        """
+        if self.builder is not None and self._cache_key() == self.key:
+            return
+        # We import this here because it imports muddled.commands, which
+        # imports us
+        import muddled.cmdline as cmdline
+        self.builder = None
+        self._set_builder(cmdline.find_and_load(self.root_path,
+                                                self.muddle_binary))
+        self.loads += 1
+
+    def status(self):
+        return ('Query server for %s\n'
+                '  process %d, started %s\n'
+                '  answered %d quer%s, loaded the build description %d time%s'%(
+                    self.root_path, os.getpid(),
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(self.started)),
+                    self.answered, 'y' if self.answered == 1 else 'ies',
+                    self.loads, '' if self.loads == 1 else 's'))
+
+    def answer(self, request):
+        """
+        Run the command in 'request', and return its reply.
+
+        This is done in a child process, which may change anything it likes.
+        """
+        import muddled.cmdline as cmdline
+        output = StringIO()
+        sys.stdout = sys.stderr = output
+        retcode = 0
+        try:
+            try:
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['env'])
+                self.builder.db.refresh_tags()
+                cmdline.cmdline(request['args'], self.muddle_binary,
+                                builder=self.builder)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    retcode = e.code
+                elif e.code is not None:
+                    print e.code
+                    retcode = 1
+            except (MuddleBug, ShellError) as e:
+                # As muddled/__main__.py would report them
+                print
+                print '%s'%e
+                traceback.print_exc()
+                retcode = e.retcode
+            except GiveUp as e:
+                print
+                text = str(e)
+                if text:
+                    print text
+                retcode = e.retcode
+            except Exception:
+                traceback.print_exc()
+                retcode = 1
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        return {'retcode':retcode, 'output':output.getvalue()}
+
+    def _handle(self, conn):
+        """
+        Handle the request on 'conn'. Returns False if we should stop.
+        """
+        try:
+            request = receive_message(conn)
+        except (socket.error, EOFError, ValueError, struct.error):
+            return True
+        if request.get('stop'):
+            # Remove our socket first, so no-one can think we're still here
+            os.remove(socket_path(self.root_path))
+            send_message(conn, {'retcode':0, 'output':'Stopped query server'
+                                                     ' for %s\n'%self.root_path})
+            return False
+        if request.get('status'):
+            send_message(conn, {'retcode':0, 'output':self.status() + '\n'})
+            return True
+
+        try:
+            self.reload_if_changed()
+        except Exception as e:
+            send_message(conn, {'retcode':1, 'output':'Query server failed to'
+                                ' load the build description\n%s\n'%e})
+            return True
+
+        self.answered += 1
+        pid = os.fork()
+        if pid == 0:
+            retcode = 1
+            try:
+                self.listener.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                send_message(conn, self.answer(request))
+                retcode = 0
+            finally:
+                os._exit(retcode)
+        return True
+
+    def serve(self, listener):
+        """
+        Answer requests on socket 'listener' until we are told to stop, or
+        have nothing to do.
+        """
+        self.listener = listener
+        path = socket_path(self.root_path)
+        our_socket = os.stat(path)
+        # Our children answer the requests, and we don't care how they exit
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        listener.settimeout(POLL_INTERVAL)
+        last_request = time.time()
+        try:
+            while True:
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        return
+                    if (st.st_ino, st.st_dev) != (our_socket.st_ino,
+                                                  our_socket.st_dev):
+                        # Someone else has started a server
+                        return
+                    if time.time() - last_request > IDLE_TIMEOUT:
+                        os.remove(path)
+                        return
+                    continue
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                last_request = time.time()
+                try:
+                    conn.settimeout(None)
+                    if not self._handle(conn):
+                        return
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+
+def server_status(root_path):
+    """
+    Return the status report from the query server for 'root_path', or None
+    if there is no server.
+    """
+    reply = ask_server(root_path, {'status':True}, timeout=10)
+    if reply is None:
+        return None
+    return reply['output']
+
+def stop_server(root_path):
+    """
+    Stop the query server for 'root_path'.
+
+    Returns False if there was no server to stop.
+    """
+    return ask_server(root_path, {'stop':True}, timeout=10) is not None
+
+def start_server(builder, muddle_binary):
+    """
+    Start a query server for the build tree of 'builder'.
+
+    The server is a separate process, which carries on after we return.
+    Raises GiveUp if there is already a server for the build tree.
+    """
+    root_path = builder.db.root_path
+    path = socket_path(root_path)
+    if server_status(root_path) is not None:
+        raise GiveUp('There is already a query server for %s'%root_path)
+    if os.path.exists(path):
+        # Left behind by a server that did not stop properly
+        os.remove(path)
+
+    # Create the socket now, so that any problem is reported, and so that
+    # the server can be asked things as soon as we return
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        listener.bind(_short_path(path))
+    except socket.error as e:
+        listener.close()
+        raise GiveUp('Unable to create query server socket %s\n%s'%(path, e))
+    finally:
+        os.umask(old_umask)
+    listener.listen(32)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        listener.close()
+        return pid
+
+    try:
+        # Detach ourselves from our parent's session and terminal
+        os.setsid()
+        os.chdir(root_path)
+        with open(os.devnull, 'r+') as null:
+            for fd in (0, 1, 2):
+                os.dup2(null.fileno(), fd)
+        QueryServer(builder, muddle_binary).serve(listener)
+    finally:
+        os._exit(0)
@@ -18,11 +18,12 @@ import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import traceback
 import xml.dom
 import xml.dom.minidom
-from collections import MutableMapping, Mapping, namedtuple
+from collections import MutableMapping, Mapping, namedtuple, deque
 from fnmatch import fnmatchcase
 from ConfigParser import RawConfigParser
 from StringIO import StringIO
@@ -118,8 +119,9 @@ deployment_tags = {
                 # For deployments. These must be independent of each other and
                 # transient or deployment will get awfully confused.
                 # instructionsapplied is used to separate deployment and
-                # instruction application - they need to run in different
-                # address spaces so that application can be privileged.
+                # instruction application. Deployments now apply instructions
+                # themselves (handing them to a privileged helper if need be),
+                # but building this label still applies them on its own.
                 'Deployed' : "deployed",
                 'InstructionsApplied' : "instructionsapplied",
                   }
@@ -572,6 +574,199 @@ def current_machine_name():
 # -----------------------------------------------------------------------------
 BUFSIZE=1024
 
+class FrozenEnv(dict):
+    """
+    An environment (a dictionary of environment variables) that cannot be
+    changed.
+
+    Muddle makes one of these for each label it builds (see
+    Builder.build_env_for()), rather than changing os.environ, and uses it
+    (via using_env()) when running commands for that label. Use amended()
+    to make a new environment with some changes.
+
+        >>> env = FrozenEnv({'A':'1', 'B':'2'})
+        >>> env['A'] = '3'
+        Traceback (most recent call last):
+        ...
+        TypeError: A FrozenEnv cannot be changed
+        >>> sorted(env.amended({'A':'3'}, ['B']).items())
+        [('A', '3')]
+        >>> sorted(env.items())
+        [('A', '1'), ('B', '2')]
+    """
+
+    def _cannot_change(self, *args, **kwargs):
+        raise TypeError('A FrozenEnv cannot be changed')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = \
+            _cannot_change
+
+    def __reduce__(self):
+        return (FrozenEnv, (dict(self),))
+
+    def amended(self, changes, removals=()):
+        """
+        Return a new FrozenEnv with the (name, value) pairs in dictionary
+        'changes' set, and the names in 'removals' removed.
+        """
+        env = dict(self)
+        env.update(changes)
+        for name in removals:
+            if name in env:
+                del env[name]
+        return FrozenEnv(env)
+
+# The environment set by using_env() for this thread, if any
+_thread_env = threading.local()
+
+class using_env(object):
+    """
+    Run commands in the given environment, in this thread.
+
+    It is intended for use with 'with', as in::
+
+        with using_env(builder.build_env_for(label)):
+            run0(['make'])
+
+    Within the 'with' clause, the run0(), run1(), run2(), run3(), shell()
+    and get_cmd_data() functions will use the given environment (unless
+    they are given one explicitly), rather than os.environ. See also
+    build_env() and current_env().
+    """
+
+    def __init__(self, env):
+        self.env = env
+
+    def __enter__(self):
+        self.old_env = getattr(_thread_env, 'env', None)
+        _thread_env.env = self.env
+        return self.env
+
+    def __exit__(self, etype, value, tb):
+        _thread_env.env = self.old_env
+        return False
+
+def build_env():
+    """
+    Return the environment set by using_env() for this thread, or None.
+    """
+    return getattr(_thread_env, 'env', None)
+
+def current_env():
+    """
+    Return the environment to use for running commands in this thread.
+
+    This is the environment set by using_env(), if any, and otherwise
+    os.environ.
+    """
+    env = getattr(_thread_env, 'env', None)
+    if env is None:
+        return os.environ
+    return env
+
+# How much of the end of its output run0() keeps for a command, to report
+# if the command fails. The rest is only shown (or written to the log, if
+# there is one) as the command runs.
+OUTPUT_TAIL_SIZE = 16*1024
+
+# The logging_output() in force for this thread, if any
+_thread_log = threading.local()
+
+class logging_output(object):
+    """
+    Also write the commands run in this thread, and their output, to a file.
+
+    It is intended for use with 'with', as in::
+
+        with logging_output(builder.db.log_file_name(label), quiet=True):
+            run0(['make'])
+
+    Within the 'with' clause, the run0(), run1(), run2() and run3() functions
+    write "> <command>" and all of the command's output to the file 'path',
+    as the command runs. The file (and its directory) is created if
+    necessary, and starts out empty.
+
+    If 'quiet' is true, then those commands, and their output, are only
+    written to the file, and are not shown, whatever their 'show_command'
+    and 'show_output' arguments say. If a command run with run0() fails,
+    the end of its output is still reported in the ShellError.
+
+    shell() can't capture the output of its command (it is run in the
+    terminal, so that commands like "git clone" can show their progress),
+    so just the command is written to the file.
+    """
+
+    def __init__(self, path, quiet=False):
+        self.path = path
+        self.quiet = quiet
+        self.file = None
+
+    def __enter__(self):
+        ensure_dir(os.path.dirname(self.path), verbose=False)
+        self.file = open(self.path, 'w')
+        self.old_log = getattr(_thread_log, 'log', None)
+        _thread_log.log = self
+        return self
+
+    def __exit__(self, etype, value, tb):
+        _thread_log.log = self.old_log
+        self.file.close()
+        return False
+
+    def write(self, text):
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+def command_log():
+    """
+    Return the logging_output() in force for this thread, or None.
+    """
+    return getattr(_thread_log, 'log', None)
+
+class _OutputBuffer(object):
+    """
+    Keep the output of a command, or, if 'limit' is given, (at least) the
+    last 'limit' bytes of it.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.parts = deque()
+        self.length = 0
+        self.dropped = False
+
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.limit is not None:
+            while len(self.parts) > 1 and \
+                  self.length - len(self.parts[0]) >= self.limit:
+                self.length -= len(self.parts.popleft())
+                self.dropped = True
+
+    def text(self):
+        return ''.join(self.parts)
+
+def _command_started(thing, show_command):
+    """
+    Report that we are about to run 'thing', and return how we should
+    treat its output, as (show_output, log).
+
+    'show_output' is false if we are logging quietly. 'log' is the
+    logging_output() in force, or None.
+    """
+    log = command_log()
+    quiet = log is not None and log.quiet
+    if show_command and not quiet:
+        sys.stdout.write('> %s\n'%thing)
+        sys.stdout.flush()
+    if log is not None:
+        log.write('> %s\n'%thing)
+        log.flush()
+    return not quiet, log
+
 class ShellError(GiveUp):
     def __init__(self, cmd, retcode, output=None):
         self.cmd = cmd
@@ -631,12 +826,14 @@ def shell(thing, env=None, show_command=True):
     between) to give the command line to run.
 
     If 'env' is given, then it is the environment to use when running 'thing',
-    otherwise 'os.environ' is used.
+    otherwise that returned by current_env() is used.
 
     If 'show_command' is true, then "> <thing>" will be printed out
     before running the command.
 
-    The output of the command will always be printed out as it runs.
+    The output of the command will always be printed out as it runs. If
+    logging_output() is in force, the command (but not its output) is also
+    written to its log.
 
     If the command returns a non-zero return code, then a ShellError will
     be raised, containing the returncode, the command string and any output
@@ -658,10 +855,15 @@ def shell(thing, env=None, show_command=True):
         thing = _stringify_cmd(thing)
     if show_command:
         sys.stdout.write('> %s\n'%thing)
+        sys.stdout.flush()
+    log = command_log()
+    if log is not None:
+        log.write('> %s\n'%thing)
+        log.flush()
     if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
+        env = current_env()
     try:
-        subprocess.check_call(thing, shell=True)
+        subprocess.check_call(thing, shell=True, env=env)
     except subprocess.CalledProcessError as e:
         # Unfortunately, e.output will actually be None, since it is only
         # populated for check_output.
@@ -676,7 +878,7 @@ def get_cmd_data(thing, env=None, show_command=False):
     using 'str()' (e.g., if a Label instance is given).
 
     If 'env' is given, then it is the environment to use when running 'thing',
-    otherwise 'os.environ' is used.
+    otherwise that returned by current_env() is used.
 
     Note that the output of the command is not shown whilst the command is
     running.
@@ -689,7 +891,7 @@ def get_cmd_data(thing, env=None, show_command=False):
     if show_command:
         sys.stdout.write('> %s\n'%_stringify_cmd(thing))
     if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
+        env = current_env()
     try:
         return subprocess.check_output(thing, env=env)
     except subprocess.CalledProcessError as e:
@@ -704,7 +906,7 @@ def run0(thing, env=None, show_command=True, show_output=True):
     Internally, a string will be converted into a sequence before it is used.
 
     If 'env' is given, then it is the environment to use when running 'thing',
-    otherwise 'os.environ' is used.
+    otherwise that returned by current_env() is used.
 
     If 'show_command' is true, then "> <thing>" will be printed out before
     running the command.
@@ -714,10 +916,15 @@ def run0(thing, env=None, show_command=True, show_output=True):
     default.
 
     If the command returns a non-zero return code, then a ShellError will
-    be raised, containing the returncode, the command string and any output
-    that occurred.
+    be raised, containing the returncode, the command string and the end of
+    the output that occurred (the last OUTPUT_TAIL_SIZE bytes or so). Since
+    the output is not returned, no more than that is kept in memory.
+
+    Within logging_output(), the command and all of its output are also
+    written to the log (see there).
     """
-    rc, output = run2(thing, env=env, show_command=show_command, show_output=show_output)
+    rc, output = run2(thing, env=env, show_command=show_command,
+                      show_output=show_output, keep_output=False)
     if rc != 0:
         raise ShellError(cmd=_stringify_cmd(thing), retcode=rc, output=output)
 
@@ -732,7 +939,7 @@ def run1(thing, env=None, show_command=True, show_output=False):
     using 'str()' (e.g., if a Label instance is given).
 
     If 'env' is given, then it is the environment to use when running 'thing',
-    otherwise 'os.environ' is used.
+    otherwise that returned by current_env() is used.
 
     If 'show_command' is true, then "> <thing>" will be printed out before
     running the command.
@@ -752,7 +959,8 @@ def run1(thing, env=None, show_command=True, show_output=False):
     else:
         raise ShellError(cmd=_stringify_cmd(thing), retcode=rc, output=output)
 
-def run2(thing, env=None, show_command=True, show_output=False):
+def run2(thing, env=None, show_command=True, show_output=False,
+         keep_output=True):
     """Run the command 'thing', returning the return code and output.
 
     (Run and return 2 values)
@@ -762,6 +970,9 @@ def run2(thing, env=None, show_command=True, show_output=False):
     Any non-string items in a 'thing' sequence will be converted to strings
     using 'str()' (e.g., if a Label instance is given).
 
+    If 'env' is given, then it is the environment to use when running 'thing',
+    otherwise that returned by current_env() is used.
+
     If 'show_command' is true, then "> <thing>" will be printed out before
     running the command.
 
@@ -771,29 +982,45 @@ def run2(thing, env=None, show_command=True, show_output=False):
     The output of the command (stdout and stderr) goes to the normal stdout
     whilst the command is running.
 
+    Within logging_output(), the command and all of its output are also
+    written to the log, and if the log is quiet, neither is shown.
+
+    If 'keep_output' is false, then only the end of the output (the last
+    OUTPUT_TAIL_SIZE bytes or so) is kept, rather than all of it. This
+    is intended for callers that only want the output if the command fails.
+
     The command return code and output are returned as a tuple:
 
         (retcode, output)
     """
     thing = _rationalise_cmd(thing)
-    if show_command:
-        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
-        sys.stdout.flush()
+    show_it, log = _command_started(_stringify_cmd(thing), show_command)
+    show_output = show_output and show_it
     if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
-    text = []
+        env = current_env()
+    text = _OutputBuffer(None if keep_output else OUTPUT_TAIL_SIZE)
     proc = subprocess.Popen(thing, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     for data in proc.stdout:
         if show_output:
             sys.stdout.write(data)
             sys.stdout.flush()
+        if log is not None:
+            log.write(data)
         text.append(data)
     proc.wait()
     sys.stdout.flush()
-    text = ''.join(text)
-    return proc.returncode, text
+    if log is not None:
+        log.flush()
+    output = text.text()
+    if text.dropped:
+        if log is None:
+            output = '...\n%s'%output
+        else:
+            output = '...(all of the output is in %s)\n%s'%(log.path, output)
+    return proc.returncode, output
 
-def run3(thing, env=None, show_command=True, show_output=False):
+def run3(thing, env=None, show_command=True, show_output=False,
+         keep_output=True):
     """Run the command 'thing', returning the return code, stdout and stderr.
 
     (Run and return 3 values)
@@ -804,7 +1031,7 @@ def run3(thing, env=None, show_command=True, show_output=False):
     using 'str()' (e.g., if a Label instance is given).
 
     If 'env' is given, then it is the environment to use when running 'thing',
-    otherwise 'os.environ' is used.
+    otherwise that returned by current_env() is used.
 
     If 'show_command' is true, then "> <thing>" will be printed out before
     running the command.
@@ -815,17 +1042,25 @@ def run3(thing, env=None, show_command=True, show_output=False):
     The output of the command is shown whilst the command is running; its
     stdout goes to the normal stdout, and its stderr to stderr.
 
+    Within logging_output(), the command and all of its output (stdout and
+    stderr, as it arrives) are also written to the log, and if the log is
+    quiet, neither is shown.
+
+    If 'keep_output' is false, then only the end of stdout and of stderr
+    (the last OUTPUT_TAIL_SIZE bytes or so of each) is kept.
+
     The command return code, stdout and stderr are returned as a tuple:
 
         (retcode, stdout, stderr)
     """
     thing = _rationalise_cmd(thing)
-    if show_command:
-        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
+    show_it, log = _command_started(_stringify_cmd(thing), show_command)
+    show_output = show_output and show_it
     if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
-    all_stdout_text = []
-    all_stderr_text = []
+        env = current_env()
+    limit = None if keep_output else OUTPUT_TAIL_SIZE
+    all_stdout_text = _OutputBuffer(limit)
+    all_stderr_text = _OutputBuffer(limit)
     proc = subprocess.Popen(thing, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     # We use select here because poll is less portable (although at the moment
@@ -852,6 +1087,8 @@ def run3(thing, env=None, show_command=True, show_output=False):
             else:
                 if show_output:
                     sys.stdout.write(stdout_text)
+                if log is not None:
+                    log.write(stdout_text)
                 all_stdout_text.append(stdout_text)
         if proc.stderr in rlist:
             # Comment as above
@@ -861,13 +1098,15 @@ def run3(thing, env=None, show_command=True, show_output=False):
             else:
                 if show_output:
                     sys.stderr.write(stderr_text)
+                if log is not None:
+                    log.write(stderr_text)
                 all_stderr_text.append(stderr_text)
     # Make sure proc.returncode gets set
     proc.wait()
+    if log is not None:
+        log.flush()
 
-    all_stdout_text = ''.join(all_stdout_text)
-    all_stderr_text = ''.join(all_stderr_text)
-    return proc.returncode, all_stdout_text, all_stderr_text
+    return proc.returncode, all_stdout_text.text(), all_stderr_text.text()
 
 # =============================================================================
 
@@ -88,6 +88,14 @@ TODO: The following needs rewriting after work for issue 225
   indicated by the build description. It tries to detect if this is necessary
   first.
 
+* git mirror
+
+  If a mirror directory is set up (see git_mirror.py and "muddle help
+  git-mirror"), then ``muddle checkout`` clones with ``git clone --reference
+  <mirror> --dissociate``, and ``muddle pull`` and ``muddle merge`` update
+  the mirror and then fetch from it, rather than straight from the remote
+  repository.
+
 Available git specific options are:
 
 * shallow_checkout: If True, then only clone to a depth of 1 (i.e., pass
@@ -107,6 +115,7 @@ import os
 import re
 
 import muddled.utils as utils
+from muddled.vcs import git_mirror
 from muddled.version_control import register_vcs, VersionControlSystem
 from muddled.withdir import Directory
 from muddled.utils import GiveUp
@@ -141,6 +150,71 @@ def expand_revision(revision):
         raise GiveUp('Revision "%s" is either non-existant or ambiguous'%revision)
     return out.strip()
 
+def _read_ref(git_dirs, ref):
+    """Return the SHA1 that 'ref' (e.g., "refs/heads/master") names, or None.
+
+    Looks for the loose ref, and then in packed-refs, in each of 'git_dirs'.
+    """
+    for git_dir in git_dirs:
+        try:
+            with open(os.path.join(git_dir, ref)) as fd:
+                return fd.read().strip()
+        except IOError:
+            pass
+        try:
+            with open(os.path.join(git_dir, 'packed-refs')) as fd:
+                for line in fd:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+        except IOError:
+            pass
+    return None
+
+def read_head(co_dir='.'):
+    """Find HEAD, and the current branch, of the checkout in 'co_dir'.
+
+    This reads the files in its .git directory, rather than running git, so
+    it is quick, but it only understands the simple cases.
+
+    Returns a tuple (revision, branch), where 'revision' is the SHA1 of HEAD
+    and 'branch' is None if HEAD is detached, or None if we could not tell
+    (in which case ask git instead).
+    """
+    git_dir = os.path.join(co_dir, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            # A linked worktree (or submodule), where .git says where the
+            # real git directory is
+            with open(git_dir) as fd:
+                text = fd.read().strip()
+            if not text.startswith('gitdir: '):
+                return None
+            git_dir = os.path.join(co_dir, text[8:])
+        git_dirs = [git_dir]
+        if os.path.exists(os.path.join(git_dir, 'commondir')):
+            # Most refs for a worktree are kept in the main git directory
+            with open(os.path.join(git_dir, 'commondir')) as fd:
+                git_dirs.append(os.path.join(git_dir, fd.read().strip()))
+        with open(os.path.join(git_dir, 'HEAD')) as fd:
+            head = fd.read().strip()
+    except IOError:
+        return None
+
+    if not head.startswith('ref: '):
+        # A detached HEAD
+        return (head, None) if re.match('[0-9a-f]{40}$', head) else None
+    ref = head[5:]
+    if not ref.startswith('refs/heads/'):
+        return None
+    revision = _read_ref(git_dirs, ref)
+    if revision is None or not re.match('[0-9a-f]{40}$', revision):
+        # Perhaps a branch with no commits yet, or a symbolic ref
+        return None
+    return revision, ref[11:]
+
 class Git(VersionControlSystem):
     """
     Provide version control operations for Git
@@ -187,6 +261,10 @@ class Git(VersionControlSystem):
 
         if options.get('shallow_checkout'):
             args += ["--depth", "1"]
+        else:
+            mirror = git_mirror.get_mirror(repo.url, verbose=verbose)
+            if mirror:
+                args += ["--reference", mirror, "--dissociate"]
 
         utils.shell(["git", "clone"] + args + [repo.url, str(co_leaf)],
                    show_command=verbose)
@@ -203,19 +281,23 @@ class Git(VersionControlSystem):
                     # XXX it is meant to be
                     utils.shell(["git", "checkout", repo.revision])
 
-    def _is_it_safe(self):
+    def _is_it_safe(self, text=None):
         """
         No dentists here...
 
         Raise an exception if there are (uncommitted) local changes or
         untracked files...
+
+        If 'text' is given, it is the local changes, as already reported by
+        "git status --porcelain" (or _git_status_v2()).
         """
-        retcode, text= utils.run2("git status --porcelain", show_command=False)
-        if retcode == 129:
-            print "Warning: Your git does not support --porcelain; you should upgrade it."
-            retcode, text = utils.run2("git status", show_command=False)
-            if text.find("working directory clean") >= 0:
-                text = ''
+        if text is None:
+            retcode, text= utils.run2("git status --porcelain", show_command=False)
+            if retcode == 129:
+                print "Warning: Your git does not support --porcelain; you should upgrade it."
+                retcode, text = utils.run2("git status", show_command=False)
+                if text.find("working directory clean") >= 0:
+                    text = ''
 
         if text:
             raise GiveUp("There are uncommitted changes/untracked files\n"
@@ -235,7 +317,25 @@ class Git(VersionControlSystem):
         """
         Will be called in the actual checkout's directory.
         """
-        starting_revision = self._git_rev_parse_HEAD()
+        if not upstream:
+            # If we're not given an upstream repository name, assume we're
+            # dealing with an "ordinary" pull, from our origin
+            upstream = 'origin'
+
+        if repo.branch is None:
+            branch = 'master'
+        else:
+            branch = repo.branch
+        remote = 'remotes/%s/%s'%(upstream, branch)
+
+        # Find out where we are (and whether it is safe to go anywhere else)
+        # with one subprocess, rather than one for each question. This is
+        # None if our git is too old to tell us that way.
+        preflight = self._pull_preflight(upstream, remote)
+        if preflight and preflight['oid']:
+            starting_revision = preflight['oid']
+        else:
+            starting_revision = self._git_rev_parse_HEAD()
 
         if merge:
             cmd = 'merge'
@@ -272,32 +372,41 @@ class Git(VersionControlSystem):
                 "checkout past the specified revision."%(repo.revision[:8], cmd))
 
         # Refuse to do anything if there are any local changes or untracked files.
-        self._is_it_safe()
+        if preflight:
+            self._is_it_safe(preflight['changes'])
+        else:
+            self._is_it_safe()
 
         # Are we on the correct branch?
-        this_branch = self.get_current_branch()
-        if repo.branch is None:
-            if this_branch != 'master':
-                self.goto_branch('master')
-        elif repo.branch != this_branch:
-            self.goto_branch(repo.branch)
-
-        if not upstream:
-            # If we're not given an upstream repository name, assume we're
-            # dealing with an "ordinary" pull, from our origin
-            upstream = 'origin'
-
-        self._setup_remote(upstream, repo, verbose=verbose)
+        if preflight:
+            this_branch = preflight['head']
+        else:
+            this_branch = self.get_current_branch()
+        changed_branch = (branch != this_branch)
+        if changed_branch:
+            self.goto_branch(branch)
+
+        if preflight:
+            self._setup_remote(upstream, repo, verbose=verbose,
+                               config=preflight['remote_config'])
+        else:
+            self._setup_remote(upstream, repo, verbose=verbose)
 
         # Retrieve changes from the remote repository to the local repository
         # We want to get the output from this so we can put it into any exception,
         # for instance if we try to fetch a branch that does not exist.
         # This *does* mean there's a slight delay before the user sees the output,
         # though
-        cmd = "git fetch %s"%upstream
+        mirror = git_mirror.get_mirror(repo.url, update=True, verbose=verbose)
+        if mirror:
+            # Fetch what our mirror just fetched, as if from the remote
+            cmd = ["git", "fetch", mirror,
+                   "+refs/heads/*:refs/remotes/%s/*"%upstream]
+        else:
+            cmd = ["git", "fetch", upstream]
         rv, out = utils.run2(cmd, show_command=verbose)
         if rv:
-            raise GiveUp('Error %d running "%s"\n%s'%(rv, cmd, out))
+            raise GiveUp('Error %d running "%s"\n%s'%(rv, ' '.join(cmd), out))
         else:
             # The older version of this code just used utils.run_cmd(), which
             # runs the command in a sub-shell, and thus its output is always
@@ -305,11 +414,6 @@ class Git(VersionControlSystem):
             # at least, we'll stay compatible with that.
             print out.rstrip()
 
-        if repo.branch is None:
-            remote = 'remotes/%s/master'%(upstream)
-        else:
-            remote = 'remotes/%s/%s'%(upstream,repo.branch)
-
         if repo.revision:
             # If the build description specifies a particular revision, all we
             # can really do is go to that revision (we did the fetch anyway in
@@ -321,6 +425,11 @@ class Git(VersionControlSystem):
             # description we're obeying
             print '++ Just changing to the revision explicitly requested for this checkout'
             utils.shell(["git", "checkout", repo.revision])
+        elif preflight and not changed_branch and \
+             self._nothing_to_merge(preflight, upstream, branch):
+            # The fetch brought nothing new, so there is nothing to merge,
+            # and we are still where we started
+            return False
         elif merge:
             # Just merge what we fetched into the current working tree
             utils.shell(["git", "merge", remote], show_command=verbose)
@@ -332,7 +441,9 @@ class Git(VersionControlSystem):
             # of where the remote head points to be updated.
             # (See git-pull(1) and git-fetch(1): "without storing the remote
             # branch anywhere locally".)
-            if (git_supports_ff_only()):
+            # (If "git status --porcelain=v2" worked, our git is new enough
+            # for --ff-only, without needing to ask it)
+            if preflight or git_supports_ff_only():
                 utils.shell(["git", "merge", "--ff-only", remote], show_command=verbose)
             else:
                 utils.shell(["git", "merge", "--ff", remote], show_command=verbose)
@@ -421,12 +532,170 @@ class Git(VersionControlSystem):
 
         utils.shell(["git", "push", upstream, effective_branch], show_command=verbose)
 
+    def _git_status_v2(self):
+        """
+        Ask "git status --porcelain=v2 --branch" about the current checkout.
+
+        That one command tells us the branch we're on, its upstream and how
+        far ahead of and behind it we are, and what local changes there are.
+
+        Returns None if our git is too old to understand it, or otherwise a
+        dictionary with keys:
+
+        * 'oid' - the SHA1 of HEAD, or None if there are no commits yet
+        * 'head' - the name of the current branch, or None if HEAD is detached
+        * 'upstream' - the name of its upstream branch, or None if it has none
+        * 'ahead' and 'behind' - the number of commits we are ahead of and
+          behind the upstream branch, or None if there is no upstream
+        * 'changes' - the local changes, in the format that the original
+          "git status --porcelain" uses (so, as a string, one change per line)
+        """
+        retcode, text = utils.run2("git status --porcelain=v2 --branch",
+                                   show_command=False)
+        if retcode:
+            return None
+        return self._parse_status_v2(text)
+
+    def _parse_status_v2(self, text):
+        """
+        Turn the output of "git status --porcelain=v2 --branch" into the
+        dictionary that _git_status_v2() returns.
+        """
+        status = {'oid':None, 'head':None, 'upstream':None,
+                  'ahead':None, 'behind':None}
+        changes = []
+        for line in text.splitlines():
+            if line.startswith('# '):
+                parts = line.split()
+                if parts[1] == 'branch.oid' and parts[2] != '(initial)':
+                    status['oid'] = parts[2]
+                elif parts[1] == 'branch.head' and parts[2] != '(detached)':
+                    status['head'] = parts[2]
+                elif parts[1] == 'branch.upstream':
+                    status['upstream'] = parts[2]
+                elif parts[1] == 'branch.ab':
+                    status['ahead'] = int(parts[2][1:])
+                    status['behind'] = int(parts[3][1:])
+            elif line.startswith('1 '):
+                parts = line.split(' ', 8)
+                changes.append('%s %s'%(parts[1].replace('.', ' '), parts[8]))
+            elif line.startswith('2 '):
+                parts = line.split(' ', 9)
+                path, orig_path = parts[9].split('\t', 1)
+                changes.append('%s %s -> %s'%(parts[1].replace('.', ' '),
+                                              orig_path, path))
+            elif line.startswith('u '):
+                parts = line.split(' ', 10)
+                changes.append('%s %s'%(parts[1], parts[10]))
+            elif line.startswith('? '):
+                changes.append('?? %s'%line[2:])
+        status['changes'] = '\n'.join(changes)
+        return status
+
+    # Run by _pull_preflight(). It stops at once if "git status" fails, and
+    # otherwise separates the answers to its questions with lines that
+    # "git status --porcelain=v2" itself never produces. Each marker has an
+    # empty line before it, so that it is always on a line of its own.
+    _PREFLIGHT_SCRIPT = ('git status --porcelain=v2 --branch || exit 1\n'
+                         'echo; echo "# muddle.remote"\n'
+                         'git config --get-regexp "^remote\\.$1\\."\n'
+                         'echo; echo "# muddle.fetched"\n'
+                         'git rev-parse -q --verify "$2^{commit}"\n'
+                         'exit 0\n')
+
+    def _pull_preflight(self, upstream, remote):
+        """
+        Find out what _pull_or_merge() needs to know before it fetches.
+
+        Will be called in the actual checkout's directory.
+
+        A pull of a large build does this for every checkout, so we ask all
+        of our questions in one subprocess (a shell running each git command
+        in turn), rather than starting a subprocess for each.
+
+        Returns None if our git is too old to understand "git status
+        --porcelain=v2", or otherwise the dictionary that _git_status_v2()
+        returns, with extra keys:
+
+        * 'remote_config' - the settings for remote 'upstream', as output by
+          "git config --get-regexp" (so empty if there are none)
+        * 'remote_oid' - the SHA1 of 'remote' (e.g., "remotes/origin/master")
+          before we fetch, or None if it does not exist yet
+        """
+        retcode, text = utils.run2(["sh", "-c", self._PREFLIGHT_SCRIPT, "sh",
+                                    upstream, remote], show_command=False)
+        if retcode:
+            return None
+        # Any of the commands may output nothing at all (for instance, there
+        # is no configuration for a remote we have not used before), so we
+        # look for our markers line by line
+        sections = {'status':[], 'remote':[], 'fetched':[]}
+        lines = sections['status']
+        for line in text.splitlines():
+            if line in ('# muddle.remote', '# muddle.fetched'):
+                lines = sections[line[len('# muddle.'):]]
+            elif line:
+                lines.append(line)
+        if not sections['status']:
+            # Either git status failed to say anything useful, or our
+            # git is too old to understand our questions
+            return None
+        status = self._parse_status_v2('\n'.join(sections['status']))
+        status['remote_config'] = '\n'.join(sections['remote'])
+        fetched = ''.join(sections['fetched']).strip()
+        status['remote_oid'] = fetched if fetched else None
+        return status
+
+    def _fetched_revision(self, branch):
+        """
+        Return the SHA1 that the last "git fetch" found for 'branch', or None
+        if we can't tell.
+
+        Will be called in the actual checkout's directory.
+
+        This reads .git/FETCH_HEAD, rather than starting another git.
+        """
+        try:
+            with open(os.path.join('.git', 'FETCH_HEAD')) as fd:
+                lines = fd.readlines()
+        except IOError:
+            return None
+        for line in lines:
+            # <sha1> TAB [not-for-merge] TAB branch '<branch>' of <repository>
+            parts = line.split('\t')
+            if len(parts) == 3 and parts[2].startswith("branch '%s' of "%branch):
+                return parts[0]
+        return None
+
+    def _nothing_to_merge(self, preflight, upstream, branch):
+        """
+        Did our fetch bring nothing that a merge would need to do anything
+        about?
+
+        'preflight' is what _pull_preflight() told us before the fetch.
+        """
+        fetched = self._fetched_revision(branch)
+        if fetched is None:
+            return False
+        if fetched == preflight['oid']:
+            # We're already exactly where the remote branch is
+            return True
+        # Otherwise, if the remote branch did not move, and we already have
+        # everything on it, there is still nothing to do
+        return (fetched == preflight['remote_oid'] and
+                preflight['upstream'] == '%s/%s'%(upstream, branch) and
+                preflight['behind'] == 0)
+
     def status(self, repo, options, quick=False):
         """
         Will be called in the actual checkout's directory.
 
         Return status text or None if there is no interesting status.
         """
+        status = self._git_status_v2()
+        if status is not None:
+            return self._status_from_v2(status, quick)
+
         retcode, text = utils.run2("git status --porcelain", show_command=False)
         if retcode == 129:
             print "Warning: Your git does not support --porcelain; you should upgrade it."
@@ -465,21 +734,8 @@ class Git(VersionControlSystem):
 
         if quick:
             branch_name = utils.get_cmd_data("git rev-parse --abbrev-ref HEAD")
-            text = utils.get_cmd_data("git show-ref origin/%s"%branch_name)
-            ref, what = text.split()
-            if ref != local_head_ref:
-                return '\n'.join(
-                    ('After checking local HEAD against our local record of the remote HEAD',
-                     '# The local repository does not match the remote:',
-                     '#',
-                     '#  HEAD   is %s'%head_name,
-                     '#  Local  is %s'%local_head_ref,
-                     '#  last known origin/%s is %s'%(branch_name, ref),
-                     '#',
-                     '# You probably need to push or pull.',
-                     '# Use "muddle status" without "-quick" to get a better idea'))
-            else:
-                return None
+            return self._compare_with_last_known(branch_name, head_name,
+                                                 local_head_ref)
 
         # So look up the remote equivalents...
         retcode, text = utils.run2("git ls-remote", show_command=False)
@@ -513,17 +769,129 @@ class Git(VersionControlSystem):
 
         return None
 
-    def _setup_remote(self, remote_name, remote_repo, verbose=True):
+    def _status_from_v2(self, status, quick=False):
+        """
+        The rest of status(), given what _git_status_v2() told us.
+        """
+        text = status['changes']
+        if status['head'] is None:
+            note = '\n# Note that this checkout has a detached HEAD'
+            if text:
+                text = '%s\n#%s'%(text, note)
+            else:
+                text = note
+
+        if text:
+            return text
+
+        head_name = 'refs/heads/%s'%status['head']
+        local_head_ref = status['oid']
+
+        if quick:
+            branch_name = status['head']
+            if status['upstream'] == 'origin/%s'%branch_name:
+                # We already know how we compare with it
+                if status['ahead'] == 0 and status['behind'] == 0:
+                    return None
+                return '\n'.join(
+                    ('After checking local HEAD against our local record of the remote HEAD',
+                     '# The local repository does not match the remote:',
+                     '#',
+                     '#  HEAD   is %s'%head_name,
+                     '#  Local  is %s'%local_head_ref,
+                     '#  Local  is %d commit%s ahead of, and %d behind,'
+                     ' last known origin/%s'%(status['ahead'],
+                                              '' if status['ahead'] == 1 else 's',
+                                              status['behind'], branch_name),
+                     '#',
+                     '# You probably need to push or pull.',
+                     '# Use "muddle status" without "-quick" to get a better idea'))
+
+            if status['upstream'] is None:
+                # A local branch that has (presumably) never been pushed
+                return self._no_origin_branch(branch_name)
+            return self._compare_with_last_known(branch_name, head_name,
+                                                 local_head_ref)
+
+        # So look up the remote equivalent...
+        retcode, text = utils.run2(["git", "ls-remote", "origin", head_name],
+                                   show_command=False)
+        lines = text.split('\n')
+        if retcode:
+            newlines = []
+            newlines.append('Whilst trying to check local HEAD against remote HEAD')
+            for line in lines:
+                newlines.append('# %s'%line)
+            return '\n'.join(newlines)
+
+        for line in lines:
+            if '\t' not in line:
+                continue
+            ref, what = line.split('\t')
+            if what == head_name and ref != local_head_ref:
+                return '\n'.join(('After checking local HEAD against remote HEAD',
+                                  '# The local repository does not match the remote:',
+                                  '#',
+                                  '#  HEAD   is %s'%head_name,
+                                  '#  Local  is %s'%local_head_ref,
+                                  '#  Remote is %s'%ref,
+                                  '#',
+                                  '# You probably need to pull with "muddle pull".'))
+        return None
+
+    def _no_origin_branch(self, branch_name):
+        return '\n'.join(
+            ('After checking local HEAD against our local record of the remote HEAD',
+             '# There is no origin/%s to compare with'%branch_name,
+             '#',
+             '# You probably need to push it.'))
+
+    def _compare_with_last_known(self, branch_name, head_name, local_head_ref):
+        """
+        The "-quick" part of status(): compare our HEAD with our local record
+        of the remote branch of the same name, without asking the remote.
+        """
+        retcode, text = utils.run2("git show-ref origin/%s"%branch_name,
+                                   show_command=False)
+        refs = {}
+        for line in text.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+        ref = refs.get('refs/remotes/origin/%s'%branch_name)
+        if retcode or ref is None:
+            return self._no_origin_branch(branch_name)
+        if ref != local_head_ref:
+            return '\n'.join(
+                ('After checking local HEAD against our local record of the remote HEAD',
+                 '# The local repository does not match the remote:',
+                 '#',
+                 '#  HEAD   is %s'%head_name,
+                 '#  Local  is %s'%local_head_ref,
+                 '#  last known origin/%s is %s'%(branch_name, ref),
+                 '#',
+                 '# You probably need to push or pull.',
+                 '# Use "muddle status" without "-quick" to get a better idea'))
+        return None
+
+    def _setup_remote(self, remote_name, remote_repo, verbose=True, config=None):
         """
         Re-associate the local repository with a remote.
 
         Makes some attempt to only do this if necessary. Of course, that may
         actually be slower than just always doing it...
+
+        If 'config' is given, it is the output of "git config --get-regexp"
+        for the remote, which the caller has already asked for.
         """
         need_to_set_url = False
         # Are there actually any values already stored for this remote?
-        retcode, out = utils.run2("git config --get-regexp remote.%s.*"%remote_name,
-                                  show_command=False)
+        if config is None:
+            retcode, out = utils.run2("git config --get-regexp remote.%s.*"%remote_name,
+                                      show_command=False)
+        else:
+            out = config
+            retcode = 0 if config.strip() else 1
         if retcode == 0:    # there were
             # Were the URLs OK?
             for line in out.split('\n'):
@@ -813,6 +1181,15 @@ class Git(VersionControlSystem):
                                                 before, verbose)
         return revision
 
+    def quick_revision_and_branch(self):
+        """
+        Return the revision id of HEAD and the current branch, without
+        running git, or None if we can't.
+
+        Will be called in the actual checkout's directory.
+        """
+        return read_head()
+
     def allows_relative_in_repo(self):
         """TODO: Check that this is correct!
         """
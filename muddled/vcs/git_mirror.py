@@ -0,0 +1,291 @@
+"""
+A local mirror of the git repositories that checkouts come from.
+
+Making a new build tree normally means cloning every checkout from its
+remote repository, over the network, even if the same repositories were
+cloned into another build tree only a few minutes ago. A mirror directory
+keeps a bare copy of each remote repository (as made by "git clone
+--mirror"), which can be shared between build trees, and by several muddle
+processes at once.
+
+The mirror directory for a build tree is given by the file .muddle/GitMirror
+(see "muddle git-mirror set"), or, if there is no such file, by the
+environment variable MUDDLE_GIT_MIRROR. If neither is set, no mirror is used.
+
+Each remote repository is mirrored in a subdirectory of the mirror directory
+named after its URL (see mirror_path()).
+
+* When a checkout is cloned, its mirror is made if it does not already
+  exist, and then the clone is done with "git clone --reference <mirror>
+  --dissociate", so that only objects not already in the mirror are fetched
+  from the remote repository. The new checkout does not depend on the mirror
+  afterwards, so mirrors may be deleted at any time.
+
+* When a checkout is pulled (or merged), its mirror is brought up to date
+  from the remote repository (only once for each muddle command), and then
+  the checkout fetches from the mirror.
+
+Shallow checkouts do not use the mirror.
+
+If anything goes wrong with a mirror, we say so, and carry on without it, so
+a broken mirror cannot stop anyone getting their work done. "muddle
+git-mirror repair" can then be used to mend it.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import time
+
+import muddled.utils as utils
+
+# The file in .muddle that names a build tree's mirror directory
+MIRROR_FILE = 'GitMirror'
+
+# The environment variable that names the mirror directory otherwise
+MIRROR_ENV = 'MUDDLE_GIT_MIRROR'
+
+# Mirrors that we have created or updated during this muddle command
+_up_to_date = set()
+
+def mirror_dir_file(root_path):
+    return os.path.join(root_path, '.muddle', MIRROR_FILE)
+
+def get_mirror_dir(root_path=None):
+    """
+    Return the mirror directory for a build tree, or None if there is none.
+
+    If 'root_path' is None, we use the build tree containing the current
+    directory (if any).
+    """
+    if root_path is None:
+        root_path, domain = utils.find_root_and_domain(os.getcwd())
+    if root_path:
+        try:
+            with open(mirror_dir_file(root_path)) as fd:
+                text = fd.read().strip()
+            if text:
+                return os.path.expanduser(text)
+        except IOError:
+            pass
+    text = os.environ.get(MIRROR_ENV)
+    if text:
+        return os.path.expanduser(text)
+    return None
+
+def set_mirror_dir(root_path, mirror_dir):
+    """
+    Set the mirror directory for the build tree at 'root_path'.
+
+    If 'mirror_dir' is None, remove the build tree's own setting (so the
+    environment variable will be used, if it is set).
+    """
+    filename = mirror_dir_file(root_path)
+    if mirror_dir is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+    else:
+        with open(filename, 'w') as fd:
+            fd.write('%s\n'%os.path.abspath(os.path.expanduser(mirror_dir)))
+
+def mirror_path(mirror_dir, url):
+    """
+    Return the path of the mirror of 'url' within 'mirror_dir'.
+
+    The name is made from the last part of the URL (so people can tell
+    which mirror is which), and a hash of the whole URL (so different
+    repositories with the same name do not collide).
+
+    >>> mirror_path('/mirrors', 'ssh://git@example.com/project/kernel.git')
+    '/mirrors/kernel-45938340d991.git'
+    >>> mirror_path('/mirrors', 'file:///srv/git/kernel/')
+    '/mirrors/kernel-427bf4474334.git'
+    """
+    name = url.rstrip('/').split('/')[-1]
+    if name.endswith('.git'):
+        name = name[:-4]
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name).lstrip('.')
+    return os.path.join(mirror_dir, '%s-%s.git'%(name,
+                        hashlib.sha1(url).hexdigest()[:12]))
+
+class _locked(object):
+    """
+    Hold a lock on a mirror, so that only one process changes it at a time.
+
+    With 'wait' false, raises IOError (with errno EWOULDBLOCK) if someone
+    else already has the lock.
+    """
+
+    def __init__(self, path, wait=True):
+        self.lock_path = '%s.lock'%path
+        self.wait = wait
+
+    def __enter__(self):
+        utils.ensure_dir(os.path.dirname(self.lock_path), verbose=False)
+        self.fd = open(self.lock_path, 'a')
+        try:
+            if self.wait:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except:
+            self.fd.close()
+            raise
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.fd.close()
+        return False
+
+def _git(path, args, verbose):
+    return utils.run2(['git', '--git-dir=%s'%path] + args,
+                      show_command=verbose)
+
+def _make_mirror(path, url, verbose):
+    """
+    Make the mirror of 'url' at 'path', which should not exist yet.
+
+    We must already have the mirror locked. Returns True if it worked.
+    """
+    new_path = '%s.new'%path
+    if os.path.exists(new_path):
+        # Left over from an earlier attempt that was interrupted
+        shutil.rmtree(new_path)
+    retcode, text = utils.run2(['git', 'clone', '--mirror', '--quiet', url,
+                                new_path], show_command=verbose)
+    if retcode:
+        print 'Unable to make git mirror of %s:\n%s'%(url,
+                utils.indent(text.rstrip(), '    '))
+        if os.path.exists(new_path):
+            shutil.rmtree(new_path)
+        return False
+    os.rename(new_path, path)
+    return True
+
+def get_mirror(url, update=False, verbose=True):
+    """
+    Return the path of the mirror of 'url', making it if necessary.
+
+    If 'update' is true, the mirror is brought up to date from 'url', unless
+    that has already been done during this muddle command.
+
+    Returns None if there is no mirror directory, or if we could not make or
+    update the mirror (in which case we say so).
+    """
+    mirror_dir = get_mirror_dir()
+    if not mirror_dir:
+        return None
+    path = mirror_path(mirror_dir, url)
+    try:
+        with _locked(path):
+            if not os.path.isdir(path):
+                if not _make_mirror(path, url, verbose):
+                    return None
+                _up_to_date.add(path)
+            elif update and path not in _up_to_date:
+                retcode, text = _git(path, ['fetch', '--prune', '--quiet',
+                                            'origin'], verbose)
+                if retcode:
+                    print 'Unable to update git mirror %s:\n%s'%(path,
+                            utils.indent(text.rstrip(), '    '))
+                    return None
+                _up_to_date.add(path)
+            # Remember when it was last used, for "muddle git-mirror prune"
+            os.utime(path, None)
+    except (IOError, OSError) as e:
+        print 'Unable to use git mirror %s: %s'%(path, e)
+        return None
+    return path
+
+def list_mirrors(mirror_dir):
+    """
+    Return a list of the mirrors in 'mirror_dir', sorted by name.
+
+    Each item is (path, url, last_used), where 'url' is the URL of the
+    repository mirrored (or None if we can't tell), and 'last_used' is
+    when the mirror was last used, in seconds since the epoch.
+    """
+    if not os.path.isdir(mirror_dir):
+        return []
+    mirrors = []
+    for name in sorted(os.listdir(mirror_dir)):
+        path = os.path.join(mirror_dir, name)
+        if not name.endswith('.git') or not os.path.isdir(path):
+            continue
+        retcode, text = _git(path, ['config', 'remote.origin.url'], False)
+        url = text.strip() if retcode == 0 else None
+        mirrors.append((path, url, os.stat(path).st_mtime))
+    return mirrors
+
+def prune_mirrors(mirror_dir, days, verbose=True):
+    """
+    Delete the mirrors in 'mirror_dir' that have not been used for 'days'
+    days. Mirrors that are in use (locked) are left alone, as are the lock
+    files themselves, since someone else may be waiting on them.
+
+    Returns the paths of the mirrors deleted.
+    """
+    too_old = time.time() - days*24*60*60
+    deleted = []
+    for path, url, last_used in list_mirrors(mirror_dir):
+        if last_used >= too_old:
+            continue
+        try:
+            with _locked(path, wait=False):
+                if verbose:
+                    print 'Deleting %s'%path
+                shutil.rmtree(path)
+                deleted.append(path)
+        except IOError as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+    return deleted
+
+def repair_mirrors(mirror_dir, verbose=True):
+    """
+    Check the mirrors in 'mirror_dir', and mend any that are broken.
+
+    Lock files left behind by interrupted git commands are removed, and
+    any mirror that "git fsck" does not like is made again from scratch.
+    Half-made mirrors, and mirrors whose URL we can't tell, are deleted.
+
+    Returns a list of (path, what was done) for each mirror we changed.
+    """
+    repaired = []
+    if not os.path.isdir(mirror_dir):
+        return repaired
+    for name in sorted(os.listdir(mirror_dir)):
+        path = os.path.join(mirror_dir, name)
+        if name.endswith('.git.new') and os.path.isdir(path):
+            with _locked(path[:-4]):
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                    repaired.append((path, 'deleted unfinished mirror'))
+            continue
+        if not name.endswith('.git') or not os.path.isdir(path):
+            continue
+        with _locked(path):
+            # Whilst we hold our lock, no git command should be using the
+            # mirror, so any git lock files are left over
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.endswith('.lock'):
+                        os.remove(os.path.join(dirpath, filename))
+                        repaired.append((path, 'removed %s'%os.path.relpath(
+                                         os.path.join(dirpath, filename), path)))
+            retcode, text = _git(path, ['fsck', '--connectivity-only',
+                                        '--no-progress'], False)
+            if retcode == 0:
+                continue
+            retcode, text = _git(path, ['config', 'remote.origin.url'], False)
+            url = text.strip() if retcode == 0 else None
+            shutil.rmtree(path)
+            if url and _make_mirror(path, url, verbose):
+                _up_to_date.add(path)
+                repaired.append((path, 'made again from %s'%url))
+            else:
+                repaired.append((path, 'deleted broken mirror'))
+    return repaired
@@ -120,6 +120,21 @@ class VersionControlSystem(object):
         """
         raise GiveUp("VCS '%s' cannot calculate a checkout revision"%self.long_name)
 
+    def quick_revision_and_branch(self):
+        """
+        Return a tuple (revision, branch) for the checkout, worked out as
+        quickly as possible, without the checks that revision_to_checkout()
+        makes (for instance, for local changes), and without contacting any
+        remote server.
+
+        Will be called in the actual checkout's directory.
+
+        'branch' is None if the checkout is not on a branch (or if the VCS
+        does not support branching). Returns None if this cannot be done
+        quickly for this checkout, which is the default.
+        """
+        return None
+
     def supports_branching(self):
         """
         Does this VCS support "lightweight" branching like git?
@@ -636,6 +651,16 @@ class VersionControlHandler(object):
             return self.vcs.revision_to_checkout(repo, co_leaf, options,
                                                  force, before, verbose)
 
+    def quick_revision_and_branch(self, builder, co_label):
+        """
+        Return a tuple (revision, branch) for the checkout, as quickly as
+        possible, or None if the VCS can't do that.
+
+        See VersionControlSystem.quick_revision_and_branch() for details.
+        """
+        with Directory(builder.db.get_checkout_path(co_label), show_pushd=False):
+            return self.vcs.quick_revision_and_branch()
+
     def get_current_branch(self, builder, co_label, verbose=False, show_pushd=False):
         """
         Return the name of the current branch.
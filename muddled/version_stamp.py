@@ -581,7 +581,63 @@ class VersionStamp(object):
                                 truncate(str(item), columns=truncate)))
 
     @staticmethod
-    def _from_builder(stamp, builder, force=False, just_use_head=False, before=None, quiet=False):
+    def _checkout_details(builder, label, vcs_handler, force=False,
+                          just_use_head=False, before=None, quick=False,
+                          quiet=False):
+        """Work out what a stamp needs to say about the checkout 'label'.
+
+        Returns a tuple (co_dir, co_leaf, repo, options), or raises GiveUp.
+        """
+        if not quiet:
+            print "Processing %s checkout '%s'"%(vcs_handler.short_name,
+                                         '(%s)%s'%(label.domain,label.name)
+                                                   if label.domain
+                                                   else label.name)
+        # If asked to be quick, read what we can straight from the checkout
+        quick_answer = None
+        if quick and not just_use_head:
+            quick_answer = vcs_handler.quick_revision_and_branch(builder, label)
+
+        # We always want to specify the revision in the stamp file
+        if just_use_head:
+            if not quiet:
+                print 'Forcing head'
+            rev = "HEAD"
+        elif quick_answer:
+            rev = quick_answer[0]
+        else:
+            rev = vcs_handler.revision_to_checkout(builder, label, force=force,
+                                                   before=before, verbose=True)
+
+        # We may also want to specify the branch
+        branch = None
+        repo = builder.db.get_checkout_repo(label)
+        if vcs_handler.vcs.supports_branching():
+            if quick_answer:
+                current_branch = quick_answer[1]
+            else:
+                current_branch = vcs_handler.get_current_branch(builder, label)
+            # If the Repository doesn't ask for a particular branch,
+            # then we normally assume it means "master".
+            orig_branch = repo.branch
+            if orig_branch is None:
+                orig_branch = 'master'
+
+            if current_branch != orig_branch:
+                branch = current_branch
+
+        if branch:
+            repo = repo.copy_with_changed_branch(branch, rev)
+        else:
+            repo = repo.copy_with_changed_revision(rev)
+
+        co_dir, co_leaf = builder.db.get_checkout_dir_and_leaf(label)
+        options = builder.db.get_checkout_vcs_options(label)
+        return co_dir, co_leaf, repo, options
+
+    @staticmethod
+    def _from_builder(stamp, builder, force=False, just_use_head=False,
+                      before=None, quiet=False, jobs=1, quick=False):
         """The internal mechanisms of the 'from_builder' static method.
         """
         stamp.repository = builder.db.RootRepository_pathfile.get()
@@ -609,9 +665,37 @@ class VersionStamp(object):
             print 'found %d'%len(checkout_rules)
 
         checkout_rules.sort()
+
+        # Asking the VCS about each checkout may be slow (it may even need to
+        # contact a remote server), so if we're allowed, we ask about several
+        # at once. We still report on them in order, as each is reached, so
+        # the output (and the problems found) do not depend on which child
+        # finished first.
+        results = {}
+        if jobs > 1:
+            handlers = {}
+            for rule in checkout_rules:
+                if hasattr(rule.action, 'vcs'):
+                    handlers[rule.target] = rule.action.vcs
+
+            def details(label):
+                return VersionStamp._checkout_details(builder, label,
+                                                      handlers[label], force,
+                                                      just_use_head, before,
+                                                      quick, quiet)
+
+            if not quiet:
+                print 'Using up to %d jobs'%jobs
+            children = builder.run_in_children(sorted(handlers), details, jobs)
+            try:
+                for label, output, value, exception in children:
+                    results[label] = (output, value, exception)
+            finally:
+                children.close()
+
         for rule in checkout_rules:
+            label = rule.target
             try:
-                label = rule.target
                 try:
                     vcs_handler = rule.action.vcs
                 except AttributeError:
@@ -619,48 +703,23 @@ class VersionStamp(object):
                     if not quiet:
                         print stamp.problems[-1]
                     continue
-                if not quiet:
-                    print "Processing %s checkout '%s'"%(vcs_handler.short_name,
-                                                 '(%s)%s'%(label.domain,label.name)
-                                                           if label.domain
-                                                           else label.name)
                 if label.domain:
                     domain_name = label.domain
                     domain_repo, domain_desc = builder.db.get_subdomain_info(domain_name)
                     stamp.domains[domain_name] = (domain_repo, domain_desc)
 
-                # We always want to specify the revision in the stamp file
-                if just_use_head:
-                    if not quiet:
-                        print 'Forcing head'
-                    rev = "HEAD"
+                if label in results:
+                    output, value, exception = results[label]
+                    sys.stdout.write(output)
+                    if exception:
+                        raise exception
+                    co_dir, co_leaf, repo, options = value
                 else:
-                    rev = vcs_handler.revision_to_checkout(builder, label, force=force,
-                                                           before=before, verbose=True)
-
-                # We may also want to specify the branch
-                branch = None
-                repo = builder.db.get_checkout_repo(label)
-                if vcs_handler.vcs.supports_branching():
-                    current_branch = vcs_handler.get_current_branch(builder, label)
-                    # If the Repository doesn't ask for a particular branch,
-                    # then we normally assume it means "master".
-                    orig_branch = repo.branch
-                    if orig_branch is None:
-                        orig_branch = 'master'
-
-                    if current_branch != orig_branch:
-                        branch = current_branch
-
-                if branch:
-                    repo = repo.copy_with_changed_branch(branch, rev)
-                else:
-                    repo = repo.copy_with_changed_revision(rev)
+                    co_dir, co_leaf, repo, options = VersionStamp._checkout_details(
+                            builder, label, vcs_handler, force, just_use_head,
+                            before, quick, quiet)
 
-                co_dir, co_leaf = builder.db.get_checkout_dir_and_leaf(label)
                 stamp.checkouts[label] = (co_dir, co_leaf, repo)
-
-                options = builder.db.get_checkout_vcs_options(label)
                 if options:
                     stamp.options[label] = options
             except GiveUp as exc:
@@ -689,7 +748,8 @@ class VersionStamp(object):
                 stamp.problems.append('Unable to work out revision ids for all the checkouts')
 
     @staticmethod
-    def from_builder(builder, force=False, just_use_head=False, before=None, quiet=False):
+    def from_builder(builder, force=False, just_use_head=False, before=None,
+                     quiet=False, jobs=1, quick=False):
         """Construct a VersionStamp from a muddle build description.
 
         'builder' is the muddle Builder for our build description.
@@ -721,6 +781,17 @@ class VersionStamp(object):
         If 'quiet' is True, then we will not print information about what
         we are doing, and we will not print out problems as they are found.
 
+        If 'jobs' is more than 1, then up to that many checkouts are asked
+        about at the same time, each in its own child process. The result
+        (and what is printed out) is the same as when they are asked about
+        one at a time.
+
+        If 'quick' is True, then for those VCSs that can do so (currently
+        just git), the revision id and branch of each checkout are read
+        directly from its VCS metadata, without running the VCS at all. This
+        means that the checkout is not checked for (for instance) local
+        changes. 'quick' is ignored if 'before' is given.
+
         Returns a tuple of:
 
             * the new VersionStamp instance
@@ -734,7 +805,9 @@ class VersionStamp(object):
                                    force=force,
                                    just_use_head=just_use_head,
                                    before=before,
-                                   quiet=quiet)
+                                   quiet=quiet,
+                                   jobs=jobs,
+                                   quick=quick and not before)
 
         return stamp, stamp.problems
 
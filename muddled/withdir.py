@@ -10,7 +10,8 @@ import sys
 import shutil
 import tempfile
 
-from muddled.utils import normalise_dir, GiveUp
+from muddled.utils import normalise_dir, GiveUp, FrozenEnv, build_env, \
+        using_env
 
 class Directory(object):
     """A class to facilitate pushd/popd behaviour
@@ -44,7 +45,8 @@ class Directory(object):
     that is being "cd"ed into. This emulates the behaviour of "cd" in bash.
     Checking the value of PWD is often used to find out what directory the
     user thinks they are in, especially in the presence of soft links in
-    directory trees.
+    directory trees. If we are building a label (so commands are run in
+    the environment given to utils.using_env()), PWD is also set in that.
     """
     def __init__(self, where, stay_on_error=False, show_pushd=True,
                  show_popd=False, set_PWD=True):
@@ -68,6 +70,15 @@ class Directory(object):
                 self.old_PWD = None
             os.environ['PWD'] = self.where
 
+            env = build_env()
+            if env is None:
+                self.using_env = None
+            else:
+                env = dict(env)
+                env['PWD'] = self.where
+                self.using_env = using_env(FrozenEnv(env))
+                self.using_env.__enter__()
+
         if show_pushd:
             sys.stdout.write('++ pushd to %s\n'%self.where)
 
@@ -80,6 +91,8 @@ class Directory(object):
         os.chdir(self.start)
 
         if self.set_PWD:
+            if self.using_env is not None:
+                self.using_env.__exit__(None, None, None)
             if self.got_old_PWD:
                 os.environ['PWD'] = self.old_PWD
             else:
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+"""Benchmark applying chmod and chown instructions in a collect deployment
+
+    $ ./bench_collect_instructions.py [<files> [<instructions>]]
+
+Makes a directory tree of about <files> files (default 10000) in a temporary
+directory: a few hundred in bin/, and the rest in directories under
+lib/modules.
+
+We then apply about <instructions> instructions to it (default 200), as a
+collect deployment would - chmod and chown of individual files and of whole
+directory trees - timing each sort of thing. The chown instructions give
+the files to the current user and group, so we do not need to be root.
+"""
+
+import grp
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.deployments.collect import CollectApplyChmod, CollectApplyChown
+from muddled.filespec import FileSpec
+from muddled.instr import ChangeModeInstruction, ChangeUserInstruction
+
+FILES_PER_DIR = 100
+
+def make_tree(root, num_files):
+    num_bin = min(500, num_files // 10)
+    os.makedirs(os.path.join(root, 'bin'))
+    for n in range(num_bin):
+        open(os.path.join(root, 'bin', 'prog%d'%n), 'w').close()
+
+    num_dirs = max(1, (num_files - num_bin) // FILES_PER_DIR)
+    for n in range(num_dirs):
+        dirname = os.path.join(root, 'lib', 'modules', 'dir%d'%n)
+        os.makedirs(dirname)
+        for m in range(FILES_PER_DIR):
+            open(os.path.join(dirname, 'module%d.ko'%m), 'w').close()
+    return num_bin, num_dirs
+
+def time_it(what, count, fn, *args):
+    # Each instruction reports what it did, which we don't want to see here
+    real_stdout = sys.stdout
+    class Quiet(object):
+        def write(self, text):
+            pass
+    start = time.time()
+    sys.stdout = Quiet()
+    try:
+        for n in range(count):
+            fn(n, *args)
+    finally:
+        sys.stdout = real_stdout
+    elapsed = time.time() - start
+    print '%-32s %5d %8.3fs %8.3fms each'%(what, count, elapsed,
+                                         1000*elapsed/max(1, count))
+
+def main(args):
+    num_files = 10000
+    num_instructions = 200
+    if args:
+        if len(args) > 2 or not all(x.isdigit() for x in args):
+            print __doc__
+            return
+        num_files = int(args[0])
+        if len(args) == 2:
+            num_instructions = int(args[1])
+
+    root = tempfile.mkdtemp(prefix='bench-collect-')
+    try:
+        start = time.time()
+        num_bin, num_dirs = make_tree(root, num_files)
+        print 'Made %d files in %.3fs'%(num_bin + num_dirs*FILES_PER_DIR,
+                                        time.time() - start)
+        print
+
+        chmod = CollectApplyChmod()
+        chown = CollectApplyChown()
+        user = pwd.getpwuid(os.getuid()).pw_name
+        group = grp.getgrgid(os.getgid()).gr_name
+        quarter = num_instructions // 4
+
+        def chmod_file(n):
+            spec = FileSpec('/bin', 'prog%d'%(n % num_bin))
+            chmod.apply(None, ChangeModeInstruction(spec, '0755', 'chmod'),
+                        'x86', root)
+
+        def chown_file(n):
+            spec = FileSpec('/bin', 'prog%d'%(n % num_bin))
+            chown.apply(None, ChangeUserInstruction(spec, user, group, 'chown'),
+                        'x86', root)
+
+        def chmod_tree(n):
+            spec = FileSpec('/lib/modules', 'dir%d'%(n % num_dirs), allUnder=True)
+            chmod.apply(None, ChangeModeInstruction(spec, '0600', 'chmod'),
+                        'x86', root)
+
+        def chown_tree(n):
+            spec = FileSpec('/lib/modules', 'dir%d'%(n % num_dirs), allUnder=True)
+            chown.apply(None, ChangeUserInstruction(spec, user, group, 'chown'),
+                        'x86', root)
+
+        print '%-32s %5s %9s'%('', 'count', 'time')
+        time_it('chmod a file in bin', quarter, chmod_file)
+        time_it('chown a file in bin', quarter, chown_file)
+        time_it('chmod a module directory tree', quarter // 4, chmod_tree)
+        time_it('chown a module directory tree', quarter // 4, chown_tree)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
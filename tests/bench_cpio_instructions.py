@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+"""Benchmark applying deployment instructions to a large CPIO hierarchy
+
+    $ ./bench_cpio_instructions.py [<files> [<instructions>]]
+
+Builds a synthetic cpiofile.Hierarchy of about <files> files (default 50000),
+in memory, as two halves which are then merged. It looks rather like a root
+filesystem: lots of files in /lib/modules, a few hundred in /bin, and an
+empty /dev.
+
+We then apply about <instructions> instructions to it (default 400), as a
+CPIO deployment would - chmod and chown of individual files and of whole
+directory trees, and mknod of device nodes - and erase some directories and
+files (as deb.deb_prune() does), timing each sort of thing.
+"""
+
+import sys
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+import muddled.cpiofile as cpiofile
+from muddled.deployments.cpio import CIApplyChmod, CIApplyChown, CIApplyMknod
+from muddled.filespec import FileSpec
+from muddled.instr import ChangeModeInstruction, ChangeUserInstruction, \
+        MakeDeviceInstruction
+from muddled.utils import GiveUp
+
+FILES_PER_DIR = 100
+
+def new_file(name, mode=0644):
+    f = cpiofile.File()
+    f.name = name
+    f.mode = mode
+    return f
+
+def new_dir(name):
+    return cpiofile.file_for_dir(name)
+
+def make_hierarchy(num_files, which):
+    """
+    Make half of our synthetic hierarchy - 'which' is 0 or 1.
+    """
+    h = cpiofile.Hierarchy({}, {})
+    root = new_dir('/')
+    h.map['/'] = root
+    h.roots['/'] = root
+    for name in ('/bin', '/lib', '/lib/modules', '/dev'):
+        h.put_target_file(name, new_dir(name))
+
+    num_bin = min(500, num_files // 10)
+    for n in range(which, num_bin, 2):
+        h.put_target_file('/bin/prog%d'%n, new_file('/bin/prog%d'%n, 0755))
+
+    num_modules = num_files - num_bin
+    for n in range(which, num_modules // FILES_PER_DIR, 2):
+        dirname = '/lib/modules/dir%d'%n
+        h.put_target_file(dirname, new_dir(dirname))
+        for m in range(FILES_PER_DIR):
+            name = '%s/module%d.ko'%(dirname, m)
+            h.put_target_file(name, new_file(name))
+    return h, num_bin, num_modules // FILES_PER_DIR
+
+def time_it(what, count, fn, *args):
+    start = time.time()
+    for n in range(count):
+        fn(n, *args)
+    elapsed = time.time() - start
+    print '%-32s %5d %8.3fs %8.3fms each'%(what, count, elapsed,
+                                         1000*elapsed/max(1, count))
+
+def main(args):
+    num_files = 50000
+    num_instructions = 400
+    if args:
+        if len(args) > 2 or not all(x.isdigit() for x in args):
+            print __doc__
+            return
+        num_files = int(args[0])
+        if len(args) == 2:
+            num_instructions = int(args[1])
+
+    start = time.time()
+    h, num_bin, num_dirs = make_hierarchy(num_files, 0)
+    other, num_bin, num_dirs = make_hierarchy(num_files, 1)
+    print 'Made two hierarchies of %d and %d files in %.3fs'%(len(h.map),
+            len(other.map), time.time() - start)
+
+    start = time.time()
+    h.merge(other)
+    print 'Merged them, giving %d files, in %.3fs'%(len(h.map),
+                                                    time.time() - start)
+    h.normalise()
+    if len(h.roots) != 1:
+        raise GiveUp('Expected one root, not %d'%len(h.roots))
+    print
+
+    chmod = CIApplyChmod()
+    chown = CIApplyChown()
+    mknod = CIApplyMknod()
+    quarter = num_instructions // 4
+
+    def chmod_file(n):
+        spec = FileSpec('/bin', 'prog%d'%(n % num_bin))
+        chmod.apply(None, ChangeModeInstruction(spec, '4755', 'chmod'),
+                    'x86', '/', h)
+
+    def chown_file(n):
+        spec = FileSpec('/bin', 'prog%d'%(n % num_bin))
+        chown.apply(None, ChangeUserInstruction(spec, '0', '0', 'chown'),
+                    'x86', '/', h)
+
+    def chmod_tree(n):
+        spec = FileSpec('/lib/modules', 'dir%d'%(n % num_dirs), allUnder=True)
+        chmod.apply(None, ChangeModeInstruction(spec, '0600', 'chmod'),
+                    'x86', '/', h)
+
+    def make_device(n):
+        instr = MakeDeviceInstruction()
+        instr.file_name = 'dev/tty%d'%n
+        instr.uid = '0'
+        instr.gid = '0'
+        instr.type = 'char'
+        instr.major = '4'
+        instr.minor = str(n)
+        instr.mode = '0600'
+        mknod.apply(None, instr, 'x86', '/', h)
+
+    def erase_file(n):
+        h.erase_target('/bin/prog%d'%n)
+
+    def erase_dir(n):
+        h.erase_target('/lib/modules/dir%d'%(num_dirs - n - 1))
+
+    # The mknod instruction is rather chatty
+    real_stdout = sys.stdout
+    class Quiet(object):
+        def write(self, text):
+            pass
+    def quietly(n, fn):
+        sys.stdout = Quiet()
+        try:
+            fn(n)
+        finally:
+            sys.stdout = real_stdout
+
+    print '%-32s %5s %9s'%('', 'count', 'time')
+    time_it('chmod a file in /bin', quarter, lambda n: chmod_file(n))
+    time_it('chown a file in /bin', quarter, lambda n: chown_file(n))
+    time_it('chmod a module directory tree', quarter // 4, lambda n: chmod_tree(n))
+    time_it('mknod in /dev', quarter, lambda n: quietly(n, make_device))
+    time_it('erase a file from /bin', min(quarter, num_bin), lambda n: erase_file(n))
+    time_it('erase a module directory', min(quarter // 4, num_dirs),
+            lambda n: erase_dir(n))
+
+    print
+    print 'Leaving %d files'%len(h.map)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
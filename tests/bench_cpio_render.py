@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+"""Benchmark cpiofile.Archive.render() against the old "read it all" version
+
+    $ ./bench_cpio_render.py [-keep] [<megabytes> [<directory>]]
+
+Builds a synthetic directory tree of about <megabytes> MB (default 1024),
+made of a few big files (like firmware blobs) and lots of small ones (like
+kernel modules), in a new temporary directory (within <directory>, if it is
+given), which is deleted afterwards unless -keep is given.
+
+We first check that the old and new renderers produce identical archives
+for a small part of the tree, and then time each of them rendering the whole
+tree, reporting throughput and peak RSS. Each render is done in a separate
+child process, so that the peak RSS of one does not hide that of the other.
+The archives are written to /dev/null, so we measure the renderers, not the
+disc. Lastly, we time the new renderer writing through a gzip pipe, as the
+CPIO deployment does.
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+import muddled.cpiofile as cpiofile
+from muddled.utils import GiveUp
+
+MB = 1024 * 1024
+
+def old_render(archive, to_file):
+    """
+    Archive.render() as it was before it was rewritten (without the logging).
+    """
+    f_out = open(to_file, "wb")
+
+    file_list = list(archive.files)
+    file_list.append(cpiofile.file_from_data("TRAILER!!!", ""))
+
+    for f in file_list:
+        if (f.orig_file is not None):
+            orig_stat = os.lstat(f.orig_file)
+
+            if (stat.S_ISREG(orig_stat.st_mode)):
+                f_in = open(f.orig_file, "rb")
+                file_data = f_in.read()
+                f_in.close()
+            elif (stat.S_ISLNK(orig_stat.st_mode)):
+                file_data = os.readlink(f.orig_file)
+            else:
+                file_data = None
+        else:
+            file_data = f.data
+
+        if (file_data is None):
+            data_size = 0
+        else:
+            data_size = len(file_data)
+
+        name_size = len(f.name) + 1
+
+        hdr_array = [ ]
+        hdr_array.append("070701")
+        hdr_array.append("%08X"%f.ino)
+        hdr_array.append("%08X"%f.mode)
+        hdr_array.append("%08X"%f.uid)
+        hdr_array.append("%08X"%f.gid)
+        hdr_array.append("%08X"%f.nlink)
+        hdr_array.append("%08X"%f.mtime)
+        hdr_array.append("%08X"%data_size)
+        hdr_array.append("%08X"%os.major(f.dev))
+        hdr_array.append("%08X"%os.minor(f.dev))
+        hdr_array.append("%08X"%os.major(f.rdev))
+        hdr_array.append("%08X"%os.minor(f.rdev))
+        hdr_array.append("%08X"%name_size)
+        hdr_array.append("%08x"%0)
+
+        f_out.write("".join(hdr_array))
+        f_out.write(f.name)
+        f_out.write("\0")
+
+        pos = f_out.tell()
+        if (pos%4):
+            for i in range(0, 4-(pos%4)):
+                f_out.write("\0")
+
+        if (file_data is not None):
+            f_out.write(file_data)
+
+        pos = f_out.tell()
+        if (pos%4):
+            for i in range(0, 4-(pos%4)):
+                f_out.write("\0")
+
+        file_data = None
+
+    f_out.close()
+
+def new_render(archive, to_file):
+    archive.render(to_file)
+
+def new_render_gzip(archive, to_file):
+    with open(to_file, "wb") as f_out:
+        proc = subprocess.Popen(["gzip", "-c"], stdin=subprocess.PIPE,
+                                stdout=f_out)
+        try:
+            archive.render(proc.stdin)
+        finally:
+            proc.stdin.close()
+            proc.wait()
+
+def make_tree(where, megabytes):
+    """
+    Make a synthetic tree of about 'megabytes' MB in 'where'.
+
+    A quarter of it goes in four big files, the rest in 64KB files spread
+    over a hundred or so directories.
+    """
+    block = os.urandom(MB)
+    small = block[:64*1024]
+
+    os.makedirs(os.path.join(where, 'lib', 'firmware'))
+    big_size = max(1, megabytes // 16)
+    for n in range(4):
+        with open(os.path.join(where, 'lib', 'firmware', 'blob%d.bin'%n), 'wb') as fd:
+            for m in range(big_size):
+                fd.write(block)
+
+    num_small = (megabytes - 4*big_size) * 16
+    for n in range(max(0, num_small)):
+        dirname = os.path.join(where, 'lib', 'modules', 'dir%03d'%(n % 128))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'module%d.ko'%n), 'wb') as fd:
+            fd.write(small)
+        if n % 16 == 0:
+            os.symlink('module%d.ko'%n, os.path.join(dirname, 'link%d.ko'%n))
+
+def make_archive(where):
+    hierarchy = cpiofile.hierarchy_from_fs(where, '/')
+    archive = cpiofile.Archive()
+    for root in hierarchy.roots.values():
+        cpiofile.trace_files(archive.files, root)
+    return archive
+
+def read_archive(path):
+    """
+    Read the archive at 'path', masking the modification time of its trailer.
+
+    (The trailer is always given the current time, so the old and new
+    renderers may not agree on that.)
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    trailer = data.rindex('070701')
+    mtime = trailer + 6 + 5*8
+    return data[:mtime] + 'XXXXXXXX' + data[mtime+8:]
+
+def in_child(fn, *args):
+    """
+    Run fn(*args) in a child process.
+
+    Returns the time it took, and the peak RSS of the child in KB.
+    """
+    sys.stdout.flush()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        retcode = 1
+        try:
+            fn(*args)
+            retcode = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(retcode)
+    pid, status, usage = os.wait4(pid, 0)
+    elapsed = time.time() - start
+    if status:
+        raise GiveUp('Child process failed, status %#x'%status)
+    return elapsed, usage.ru_maxrss
+
+def do_nothing():
+    pass
+
+def main(args):
+    keep = False
+    if args and args[0] == '-keep':
+        keep = True
+        args = args[1:]
+    megabytes = 1024
+    where = None
+    if args:
+        if len(args) > 2 or not args[0].isdigit():
+            print __doc__
+            return
+        megabytes = int(args[0])
+        if len(args) == 2:
+            where = args[1]
+
+    where = tempfile.mkdtemp(prefix='bench_cpio_', dir=where)
+    tree = os.path.join(where, 'tree')
+    try:
+        print 'Making a %d MB tree in %s'%(megabytes, tree)
+        make_tree(tree, megabytes)
+        archive = make_archive(tree)
+        total = sum(os.lstat(f.orig_file).st_size for f in archive.files
+                    if f.orig_file is not None)
+        print 'There are %d files, %.1f MB of data'%(len(archive.files),
+                                                     float(total)/MB)
+
+        # Check the renderers agree, on a few hundred of the small files
+        check = cpiofile.Archive()
+        check.files = [f for f in archive.files if 'firmware' not in f.name][:500]
+        old_file = os.path.join(where, 'old.cpio')
+        new_file = os.path.join(where, 'new.cpio')
+        old_render(check, old_file)
+        new_render(check, new_file)
+        if read_archive(old_file) != read_archive(new_file):
+            raise GiveUp('Old and new renderers produced different archives')
+        os.remove(old_file)
+        os.remove(new_file)
+        print 'Old and new renderers agree'
+
+        base_time, base_rss = in_child(do_nothing)
+        print
+        print 'Baseline peak RSS %8d KB'%base_rss
+        print
+        print '                    time    MB/s    peak RSS'
+        for name, fn, to_file in (('old renderer', old_render, os.devnull),
+                                  ('new renderer', new_render, os.devnull),
+                                  ('new, via gzip', new_render_gzip,
+                                   os.path.join(where, 'new.cpio.gz'))):
+            elapsed, rss = in_child(fn, archive, to_file)
+            print '%-14s %8.2fs %7.1f %8d KB'%(name, elapsed,
+                                               float(total)/MB/elapsed, rss)
+    finally:
+        if not keep:
+            shutil.rmtree(where)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+"""Micro-benchmarks for looking things up in a depend.RuleSet
+
+    $ ./bench_depend.py [<packages> [<domains>]]
+
+Builds a synthetic rule set, with <packages> packages (default 1000) in
+each of <domains> domains (default 4, counting the top-level domain). Each
+package has a checkout and the usual package lifecycle, and depends on a
+couple of the packages before it.
+
+We then time the different sorts of look-up that muddle does, comparing
+RuleSet's index with trying every target in turn (which is what RuleSet used
+to do). Finally, we time adding rules one at a time while also looking
+things up, as loading a build description does.
+"""
+
+import random
+import sys
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.depend import Label, Rule, RuleSet
+from muddled.utils import GiveUp, LabelType, LabelTag
+
+PACKAGE_TAGS = (LabelTag.PreConfig, LabelTag.Configured, LabelTag.Built,
+                LabelTag.Installed, LabelTag.PostInstalled)
+
+def package_rules(n, domain):
+    """
+    Return the rules for package 'n' in 'domain', and its final label.
+    """
+    rules = []
+    co_label = Label(LabelType.Checkout, 'co%d'%n, None, LabelTag.CheckedOut,
+                     domain=domain)
+    rules.append(Rule(co_label, None))
+    needs = random.sample(range(n), min(2, n))
+    last = co_label
+    for tag in PACKAGE_TAGS:
+        label = Label(LabelType.Package, 'pkg%d'%n, 'x86', tag, domain=domain)
+        rule = Rule(label, None)
+        rule.add(last)
+        if tag == LabelTag.PreConfig:
+            for other in needs:
+                rule.add(Label(LabelType.Package, 'pkg%d'%other, 'x86',
+                               LabelTag.PostInstalled, domain=domain))
+        rules.append(rule)
+        last = label
+    return rules
+
+def domain_names(num_domains):
+    return [None] + ['domain%d'%n for n in range(1, num_domains)]
+
+def make_ruleset(num_packages, num_domains):
+    random.seed(42)
+    ruleset = RuleSet()
+    for domain in domain_names(num_domains):
+        for n in range(num_packages):
+            for rule in package_rules(n, domain):
+                ruleset.add(rule)
+    return ruleset
+
+def scan_rules_for_target(ruleset, label):
+    """
+    What RuleSet.rules_for_target(label, useMatch=True) used to do.
+    """
+    return set(v for (k, v) in ruleset.map.items() if label.just_match(k))
+
+def scan_targets_match(ruleset, label):
+    """
+    What RuleSet.targets_match(label, useMatch=True) used to do.
+    """
+    return set(k for k in ruleset.map.keys() if k.match(label) is not None)
+
+def scan_rules_without_tag(ruleset, label):
+    """
+    What RuleSet.rules_for_target(label, useMatch=False, useTags=False)
+    used to do.
+    """
+    return set(v for (k, v) in ruleset.map.items() if k.match_without_tag(label))
+
+def time_it(fn, labels):
+    start = time.time()
+    results = [fn(label) for label in labels]
+    return time.time() - start, results
+
+def compare(what, labels, indexed, scan):
+    """
+    Time looking up 'labels' with our index and by scanning, and check
+    they agree.
+    """
+    indexed_time, indexed_results = time_it(indexed, labels)
+    scan_time, scan_results = time_it(scan, labels)
+    if indexed_results != scan_results:
+        raise GiveUp('Index and scan disagree for %s'%what)
+    print '%-36s %5d %9.3fms %9.3fms %7.1fx'%(what, len(labels),
+            1000*indexed_time/len(labels), 1000*scan_time/len(labels),
+            scan_time/max(indexed_time, 1e-6))
+
+def main(args):
+    num_packages = 1000
+    num_domains = 4
+    if args:
+        if len(args) > 2 or not all(x.isdigit() for x in args):
+            print __doc__
+            return
+        num_packages = int(args[0])
+        if len(args) == 2:
+            num_domains = max(1, int(args[1]))
+
+    start = time.time()
+    ruleset = make_ruleset(num_packages, num_domains)
+    print 'Rule set has %d rules, in %d domains, made in %.3fs'%(len(ruleset.map),
+            num_domains, time.time() - start)
+    print
+
+    random.seed(99)
+    domains = domain_names(num_domains)
+    def some_labels(type, name, role, tag, count=100):
+        labels = []
+        for x in range(count):
+            n = random.randrange(num_packages)
+            labels.append(Label(type, name%n if '%' in name else name, role,
+                                tag, domain=random.choice(domains)))
+        return labels
+
+    exact = some_labels(LabelType.Package, 'pkg%d', 'x86', LabelTag.Built)
+    any_tag = some_labels(LabelType.Package, 'pkg%d', 'x86', '*')
+    any_name = some_labels(LabelType.Package, '*', 'x86', LabelTag.Built, 10)
+    any_domain = [l.copy_with_domain('*') for l in any_tag]
+    any_type = some_labels('*', 'co%d', '*', '*')
+
+    print '%-36s %5s %11s %11s %8s'%('', 'count', 'index', 'scan', 'speedup')
+    for what, labels in (('rules_for_target, exact', exact),
+                         ('rules_for_target, any tag', any_tag),
+                         ('rules_for_target, any name', any_name),
+                         ('rules_for_target, any domain and tag', any_domain)):
+        compare(what, labels, ruleset.rules_for_target,
+                lambda l: scan_rules_for_target(ruleset, l))
+
+    for what, labels in (('targets_match, any tag', any_tag),
+                         ('targets_match, any type and tag', any_type)):
+        compare(what, labels, ruleset.targets_match,
+                lambda l: scan_targets_match(ruleset, l))
+
+    compare('rules_for_target, without tag', exact,
+            lambda l: ruleset.rules_for_target(l, useTags=False, useMatch=False),
+            lambda l: scan_rules_without_tag(ruleset, l))
+
+    # Loading a build description adds rules, asking questions as it goes
+    print
+    random.seed(42)
+    ruleset = RuleSet()
+    start = time.time()
+    for n in range(num_packages):
+        for rule in package_rules(n, None):
+            ruleset.add(rule)
+        ruleset.rules_for_target(Label(LabelType.Package, 'pkg%d'%n, '*', '*'))
+    elapsed = time.time() - start
+    print 'Add %d packages, with a wildcard look-up after each, in %.3fs'%(
+            num_packages, elapsed)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+"""Benchmark the memory and time taken by labels in a large multi-domain build
+
+    $ ./bench_labels.py [--no-intern] [<domains> [<packages>]]
+
+Makes a synthetic build with <domains> sub-domains (default 40), each of
+which has <packages> packages (default 200), each with its own checkout,
+and depending on a couple of the packages before it. Each sub-domain's rules
+are made with the normal functions from muddled.pkg, and then moved into its
+domain and merged into the top-level rule set, as including a sub-domain
+does. All the sub-domains use the same package names, so there are lots of
+labels that differ only by domain.
+
+We then report how many label instances there are (and how much memory they
+take), and time retagging every rule target (keeping the results), and
+looking up every rule target in a dictionary.
+
+With --no-intern, the cache of interned labels is made as small as possible,
+for comparison.
+"""
+
+import gc
+import random
+import resource
+import sys
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+import muddled.depend as depend
+from muddled.depend import Label, Rule, RuleSet
+from muddled.pkg import add_package_rules, package_depends_on_checkout, \
+        package_depends_on_packages
+from muddled.utils import LabelType, LabelTag
+
+def make_domain(num_packages):
+    """
+    Return the rule set for a synthetic sub-domain.
+    """
+    depend.clear_label_cache()
+    ruleset = RuleSet()
+    for n in range(num_packages):
+        name = 'pkg%d'%n
+        ruleset.add(Rule(Label(LabelType.Checkout, 'co%d'%n, None,
+                               LabelTag.CheckedOut), None))
+        add_package_rules(ruleset, name, 'x86', None)
+        package_depends_on_checkout(ruleset, name, 'x86', 'co%d'%n)
+        if n > 1:
+            needs = random.sample(range(n), 2)
+            package_depends_on_packages(ruleset, name, 'x86',
+                                        LabelTag.PreConfig,
+                                        ['pkg%d'%x for x in needs])
+    return ruleset
+
+def move_to_domain(ruleset, domain_name):
+    """
+    Move all the labels in 'ruleset' into domain 'domain_name'.
+
+    This does what mechanics._new_sub_domain() does, for a rule set.
+    """
+    labels = []
+    for rule in ruleset.map.values():
+        labels.append(rule.target)
+        labels.extend(rule.deps)
+    for l in labels:
+        l._mark_unswept()
+    for l in labels:
+        l._change_domain(domain_name)
+
+def count_labels():
+    """
+    Return the number of Label instances, and how much memory they use.
+    """
+    gc.collect()
+    labels = [x for x in gc.get_objects() if isinstance(x, Label)]
+    return len(labels), sum(sys.getsizeof(x) for x in labels)
+
+def time_it(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def main(args):
+    num_domains = 40
+    num_packages = 200
+    if args and args[0] == '--no-intern':
+        depend.INTERNED_LABELS_LIMIT = 0
+        args = args[1:]
+    if args:
+        if len(args) > 2 or not all(x.isdigit() for x in args):
+            print __doc__
+            return
+        num_domains = int(args[0])
+        if len(args) == 2:
+            num_packages = int(args[1])
+
+    random.seed(42)
+    start = time.time()
+    top = RuleSet()
+    for n in range(num_domains):
+        ruleset = make_domain(num_packages)
+        move_to_domain(ruleset, 'domain%d'%n)
+        top.merge(ruleset)
+    load_time = time.time() - start
+
+    refs = sum(1 + len(rule.deps) for rule in top.map.values())
+    instances, size = count_labels()
+    print 'Made %d rules in %d domains in %.3fs'%(len(top.map), num_domains,
+                                                 load_time)
+    print '  %d references to %d label instances, using %d KB'%(refs,
+            instances, size // 1024)
+    print '  maximum resident set size %d KB'%resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+
+    # Lots of things retag labels (for instance, to ask about a package as
+    # a whole, rather than one step in building it), and keep the results
+    targets = top.map.keys()
+    elapsed, retagged = time_it(lambda: [[l.copy_with_tag(tag) for l in targets]
+                                         for tag in ('*', LabelTag.Built)])
+    instances, size = count_labels()
+    print
+    print 'Retag %d labels twice          %8.3fs'%(len(targets), elapsed)
+    print '  giving %d label instances, using %d KB'%(instances, size // 1024)
+
+    # Rules are looked up by label a great deal, and these labels collide
+    # (by hash) with those of the same name in every other domain. Look up
+    # every rule by its target (the same instance) and by an equal label
+    # (made by parsing it)
+    parsed = [Label.from_string(str(l)) for l in targets]
+    print
+    for what, labels in (('same label', targets), ('equal label', parsed)):
+        elapsed, found = time_it(lambda: [top.map[l] for l in labels])
+        print 'Look up %d rules by %-12s %8.3fs'%(len(found), what, elapsed)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+"""Benchmark depend.needed_to_build() against the old "repeated sweep" planner
+
+    $ ./bench_needed_to_build.py [<packages> [<layers>]]
+
+Builds a synthetic rule set, with <packages> packages (default 1600) each
+with a checkout and the usual package lifecycle, which comes to about 10000
+rules. The packages are arranged in <layers> layers (default 16), with each
+package depending on a couple of packages in the layer before.
+
+We then time how long the old and new planners take to work out what is
+needed to build every package, and check that they agree.
+"""
+
+import random
+import sys
+import time
+import traceback
+
+from support_for_tests import get_parent_dir
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.depend import Label, Rule, RuleSet, needed_to_build, \
+        label_set_to_string
+from muddled.utils import GiveUp, MuddleBug, LabelType, LabelTag
+
+PACKAGE_TAGS = (LabelTag.PreConfig, LabelTag.Configured, LabelTag.Built,
+                LabelTag.Installed, LabelTag.PostInstalled)
+
+def old_needed_to_build(ruleset, target, useTags = True, useMatch = False):
+    """
+    The needed_to_build() algorithm as it was before it was rewritten.
+    """
+    rule_list = [ ]
+    rule_target_set = set()
+
+    targets = set()
+    targets.update(ruleset.targets_match(target, useMatch=useMatch))
+
+    done_something = True
+    while done_something:
+        done_something = False
+
+        targets = targets - rule_target_set
+        if len(targets) == 0:
+            return rule_list
+
+        new_targets = set()
+        for tgt in targets:
+            rules = ruleset.rules_for_target(tgt, useTags)
+            if rules is None:
+                raise MuddleBug("No rule found for target %s"%tgt)
+
+            can_build_target = True
+
+            if len(rules) == 0:
+                raise MuddleBug("Rule list is empty for target %s"%tgt)
+
+            for rule in rules:
+                for dep in rule.deps:
+                    if dep not in rule_target_set:
+                        if dep not in new_targets and dep not in targets:
+                            new_targets.add(dep)
+                            done_something = True
+                        can_build_target = False
+
+            if can_build_target:
+                for rule in rules:
+                    rule_list.append(rule)
+                rule_target_set.add(tgt)
+                done_something = True
+            else:
+                new_targets.add(tgt)
+
+        targets = new_targets
+
+    targets = list(targets)
+    targets.sort()
+    raise GiveUp("Dependency graph is circular or incomplete. \n" +
+                 "building = %s\n"%target +
+                 "targets = %s \n"%label_set_to_string(targets,
+                                                       start_with='[\n    ',
+                                                       end_with='\n]',
+                                                       join_with='\n    '))
+
+def make_ruleset(num_packages, num_layers):
+    """
+    Return a synthetic ruleset, and the final label of each package.
+    """
+    random.seed(42)
+    ruleset = RuleSet()
+    finals = []
+    per_layer = max(1, num_packages // num_layers)
+    for n in range(num_packages):
+        co_label = Label(LabelType.Checkout, 'co%d'%n, None, LabelTag.CheckedOut)
+        ruleset.add(Rule(co_label, None))
+
+        layer = n // per_layer
+        if layer > 0:
+            previous = finals[(layer-1)*per_layer:layer*per_layer]
+            needs = random.sample(previous, min(2, len(previous)))
+        else:
+            needs = []
+
+        last = co_label
+        for tag in PACKAGE_TAGS:
+            label = Label(LabelType.Package, 'pkg%d'%n, 'x86', tag)
+            rule = Rule(label, None)
+            rule.add(last)
+            if tag == LabelTag.PreConfig:
+                for other in needs:
+                    rule.add(other)
+            ruleset.add(rule)
+            last = label
+        finals.append(last)
+    return ruleset, finals
+
+def check_order(rule_list):
+    """
+    Check each rule comes after the rules for its dependencies.
+    """
+    seen = set()
+    for rule in rule_list:
+        for dep in rule.deps:
+            if dep not in seen:
+                raise GiveUp('Rule %s comes before its dependency %s'%(rule, dep))
+        seen.add(rule.target)
+
+def time_it(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def main(args):
+    num_packages = 1600
+    num_layers = 16
+    if args:
+        if len(args) > 2 or not all(x.isdigit() for x in args):
+            print __doc__
+            return
+        num_packages = int(args[0])
+        if len(args) == 2:
+            num_layers = int(args[1])
+
+    ruleset, finals = make_ruleset(num_packages, num_layers)
+    print 'Rule set has %d rules, in %d layers'%(len(ruleset.map), num_layers)
+
+    # Aim for the last package, which needs a good part of the tree,
+    # and then for everything (as 'muddle build _all' would)
+    target = finals[-1]
+    everything = Label(LabelType.Package, '*', 'x86', LabelTag.PostInstalled)
+
+    for what, useMatch in ((target, False), (everything, True)):
+        print
+        print 'Needed to build %s'%what
+        old_time, old_rules = time_it(old_needed_to_build, ruleset, what,
+                                      True, useMatch)
+        new_time, new_rules = time_it(needed_to_build, ruleset, what,
+                                      True, useMatch)
+        again_time, again_rules = time_it(needed_to_build, ruleset, what,
+                                          True, useMatch)
+
+        if sorted(old_rules) != sorted(new_rules) or new_rules != again_rules:
+            raise GiveUp('Old and new planners do not agree')
+        check_order(new_rules)
+
+        print '  %d rules'%len(new_rules)
+        print '  old planner    %8.3fs'%old_time
+        print '  new planner    %8.3fs'%new_time
+        print '  new (memoised) %8.3fs'%again_time
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -3,11 +3,19 @@
 Tests the rest of muddled.
 """
 
+import errno
 import os
+import pickle
+import tarfile
+import shutil
+import stat
 import sys
 import subprocess
+import time
+import tempfile
 import traceback
 
+from StringIO import StringIO
 from support_for_tests import get_parent_dir
 
 try:
@@ -26,6 +34,12 @@ import muddled.filespec as filespec
 import muddled.pkg as pkg
 import muddled.subst as subst
 import muddled.cpiofile as cpiofile
+import muddled.db as db
+import muddled.debfile as debfile
+import muddled.pkgs.deb as deb
+import muddled.pkgs.aptalt as aptalt
+import muddled.pkgs.aptget as aptget
+import muddled.pkgs.dpkg_status as dpkg_status
 
 from muddled.depend import Label
 
@@ -56,6 +70,342 @@ def cpio_unit_test():
     assert out[:len(text)] == text
     # Ignoring any extra lines about number of blocks...
 
+def read_newc(data):
+    """
+    Return a list of (name, ino, nlink, data) for each entry in a newc archive.
+    """
+    entries = []
+    pos = 0
+    while True:
+        assert data[pos:pos+6] == '070701'
+        fields = [int(data[pos+6+8*n:pos+14+8*n], 16) for n in range(13)]
+        ino, nlink, size, name_size = fields[0], fields[4], fields[6], fields[11]
+        pos += 110
+        name = data[pos:pos+name_size-1]
+        pos += name_size
+        pos += -pos % 4
+        entries.append((name, ino, nlink, data[pos:pos+size]))
+        pos += size
+        pos += -pos % 4
+        if name == 'TRAILER!!!':
+            return entries
+
+def cpio_hard_link_unit_test():
+    """
+    Check that hard linked (and identical) files are only stored once.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpd, 'src')
+        os.mkdir(src)
+        with open(os.path.join(src, 'busybox'), 'w') as fd:
+            fd.write('x'*1000)
+        os.link(os.path.join(src, 'busybox'), os.path.join(src, 'ls'))
+        os.link(os.path.join(src, 'busybox'), os.path.join(src, 'cat'))
+        with open(os.path.join(src, 'copy'), 'w') as fd:
+            fd.write('x'*1000)
+        with open(os.path.join(src, 'other'), 'w') as fd:
+            fd.write('y'*1000)
+
+        def render(hard_links):
+            h = cpiofile.hierarchy_from_fs(src, '/')
+            tmpf = os.path.join(tmpd, 'test.cpio')
+            saved = h.render(tmpf, False, hard_links)
+            with open(tmpf) as fd:
+                entries = read_newc(fd.read())
+            return saved, dict((e[0], e[1:]) for e in entries)
+
+        saved, entries = render(None)
+        assert saved == 0
+        assert entries['/ls'][2] == 'x'*1000
+        assert entries['/cat'][2] == 'x'*1000
+
+        saved, entries = render('inode')
+        assert saved == 2000
+        linked = [entries[name] for name in ('/busybox', '/ls', '/cat')]
+        # They all share an inode, and the data comes with the first only
+        assert len(set(e[0] for e in linked)) == 1
+        assert [e[1] for e in linked] == [3, 3, 3]
+        assert sorted(e[2] for e in linked) == ['', '', 'x'*1000]
+        assert entries['/copy'][1:] == (1, 'x'*1000)
+        assert entries['/other'][1:] == (1, 'y'*1000)
+
+        saved, entries = render('content')
+        assert saved == 3000
+        linked = [entries[name] for name in ('/busybox', '/ls', '/cat', '/copy')]
+        assert len(set(e[0] for e in linked)) == 1
+        assert [e[1] for e in linked] == [4, 4, 4, 4]
+        assert entries['/other'][1:] == (1, 'y'*1000)
+    finally:
+        shutil.rmtree(tmpd)
+
+def cpio_hard_link_modes_unit_test():
+    """
+    Check that copies of one file with different modes are not linked together.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpd, 'src')
+        os.mkdir(src)
+        with open(os.path.join(src, 'busybox'), 'w') as fd:
+            fd.write('x'*1000)
+        for name in ('ls', 'sh', 'vi'):
+            os.link(os.path.join(src, 'busybox'), os.path.join(src, name))
+
+        h = cpiofile.hierarchy_from_fs(src, '/')
+        # As if deployment had chmod'ed two of them differently
+        for name in ('/sh', '/vi'):
+            h.map[name].mode = stat.S_IFREG | 0700
+        tmpf = os.path.join(tmpd, 'test.cpio')
+        saved = h.render(tmpf, False, 'inode')
+        with open(tmpf) as fd:
+            entries = dict((e[0], e[1:]) for e in read_newc(fd.read()))
+
+        assert saved == 2000
+        first = [entries[name] for name in ('/busybox', '/ls')]
+        second = [entries[name] for name in ('/sh', '/vi')]
+        # Two sets of two links, each with its own inode and its own data
+        assert len(set(e[0] for e in first)) == 1
+        assert len(set(e[0] for e in second)) == 1
+        assert first[0][0] != second[0][0]
+        assert [e[1] for e in first + second] == [2, 2, 2, 2]
+        assert sorted(e[2] for e in first) == ['', 'x'*1000]
+        assert sorted(e[2] for e in second) == ['', 'x'*1000]
+        # And no other entry uses the inode we made up
+        inodes = [e[0] for (name, e) in entries.items()
+                  if name not in ('/sh', '/vi')]
+        assert second[0][0] not in inodes
+    finally:
+        shutil.rmtree(tmpd)
+
+def cpio_hierarchy_unit_test():
+    """
+    Check merging hierarchies, erasing from them, and listing them.
+    """
+    def hierarchy(names):
+        h = cpiofile.Hierarchy({}, {})
+        root = cpiofile.file_for_dir('/')
+        h.map['/'] = root
+        h.roots['/'] = root
+        for name in names:
+            if name.endswith('/'):
+                f = cpiofile.file_for_dir(name[:-1])
+            else:
+                f = cpiofile.file_from_data(name, name)
+            h.put_target_file(f.name, f)
+        return h
+
+    def names(f):
+        return [c.name for c in f.children]
+
+    h1 = hierarchy(['/bin/', '/bin/sh', '/bin/ls', '/etc/', '/etc/passwd'])
+    h2 = hierarchy(['/bin/', '/bin/cat', '/bin/sh', '/lib/', '/lib/libc.so'])
+    new_sh = h2.map['/bin/sh']
+    h1.merge(h2)
+    assert h1.roots.keys() == ['/']
+    # Existing files keep their order, and new ones come after them
+    assert names(h1.map['/']) == ['/bin', '/etc', '/lib']
+    assert names(h1.map['/bin']) == ['/bin/sh', '/bin/ls', '/bin/cat']
+    # Files from the merged hierarchy replace those already there
+    assert h1.map['/bin'] is h2.map['/bin']
+    assert h1.map['/bin'].children.get('/bin/sh') is new_sh
+    assert h1.map['/bin/sh'] is new_sh
+
+    dp = cpiofile.CpioFileDataProvider(h1)
+    assert dp.list_files_under('/bin') == ['sh', 'ls', 'cat']
+    assert dp.list_files_under('/', True) == ['bin', 'bin/sh', 'bin/ls',
+                                              'bin/cat', 'etc', 'etc/passwd',
+                                              'lib', 'lib/libc.so']
+
+    h1.erase_target('/bin/ls')
+    h1.erase_target('/lib')
+    assert names(h1.map['/']) == ['/bin', '/etc']
+    assert names(h1.map['/bin']) == ['/bin/sh', '/bin/cat']
+    assert '/bin/ls' not in h1.map
+    assert '/lib' not in h1.map
+    assert '/lib/libc.so' not in h1.map
+
+    # Putting a file back puts it at the end
+    h1.put_target_file('/bin/ls', cpiofile.file_from_data('/bin/ls', 'ls'))
+    assert names(h1.map['/bin']) == ['/bin/sh', '/bin/cat', '/bin/ls']
+
+def make_deb(deb_path, compression):
+    """
+    Write a small .deb to 'deb_path', with its data.tar compressed as
+    'compression' ('', 'gz' or 'xz').
+    """
+    data = StringIO()
+    tar = tarfile.open(fileobj=data, mode='w')
+    def add(name, type=tarfile.REGTYPE, text='', mode=0644, linkname=''):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode
+        info.mtime = 1234567890
+        info.linkname = linkname
+        info.size = len(text)
+        tar.addfile(info, StringIO(text))
+    add('./', tarfile.DIRTYPE, mode=0755)
+    add('./usr/', tarfile.DIRTYPE, mode=0755)
+    add('./usr/include/', tarfile.DIRTYPE, mode=0755)
+    add('./usr/include/fred.h', text='#define FRED 1\n')
+    add('./usr/lib/', tarfile.DIRTYPE, mode=0755)
+    add('./usr/lib/libfred.so.1', text='not really a library\n', mode=0755)
+    add('./usr/lib/libfred.so', tarfile.SYMTYPE, linkname='libfred.so.1')
+    add('./usr/lib/libjim.so', tarfile.SYMTYPE, linkname='/lib/libjim.so.2')
+    add('./usr/lib/libfred.so.1.0', tarfile.LNKTYPE, linkname='./usr/lib/libfred.so.1')
+    add('./usr/bin/', tarfile.DIRTYPE, mode=0755)
+    add('./usr/bin/fred', text='#! /bin/sh\n', mode=0755)
+    tar.close()
+    data = data.getvalue()
+    if compression == 'gz':
+        data = subprocess.Popen(['gzip', '-c'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE).communicate(data)[0]
+    elif compression == 'xz':
+        data = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE).communicate(data)[0]
+    members = [('debian-binary', '2.0\n'),
+               ('control.tar', ''),
+               ('data.tar%s'%('.%s'%compression if compression else ''), data)]
+    with open(deb_path, 'wb') as fd:
+        fd.write(debfile.AR_MAGIC)
+        for name, content in members:
+            fd.write('%-16s%-12d%-6d%-6d%-8s%-10d`\n'%(name + '/', 1234567890,
+                                                       0, 0, '100644', len(content)))
+            fd.write(content)
+            if len(content) & 1:
+                fd.write('\n')
+
+def deb_unit_test():
+    """
+    Check extracting .deb files natively, and not extracting them again.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        for compression in ('', 'gz', 'xz'):
+            deb_path = os.path.join(tmpd, 'fred-%s.deb'%compression)
+            make_deb(deb_path, compression)
+
+            # As "dpkg-deb -X" would do it
+            inst_dir = os.path.join(tmpd, 'install-%s'%compression)
+            written = debfile.extract(deb_path, [('', inst_dir)])
+            assert os.path.join(inst_dir, 'usr/bin/fred') in written
+            with open(os.path.join(inst_dir, 'usr/include/fred.h')) as fd:
+                assert fd.read() == '#define FRED 1\n'
+            assert os.readlink(os.path.join(inst_dir, 'usr/lib/libjim.so')) == \
+                    '/lib/libjim.so.2'
+            st = os.stat(os.path.join(inst_dir, 'usr/lib/libfred.so.1.0'))
+            assert st.st_nlink == 2 and st.st_mode & 0777 == 0755
+            assert st.st_mtime == 1234567890
+
+            # As a "dev" package wants it, with links rewritten as we go
+            obj_dir = os.path.join(tmpd, 'obj-%s'%compression)
+            places = [('', os.path.join(obj_dir, 'obj')),
+                      ('usr/include', os.path.join(obj_dir, 'include')),
+                      ('usr/lib', os.path.join(obj_dir, 'lib'))]
+            debfile.extract(deb_path, places, link_root=obj_dir)
+            for name in ('obj/usr/include/fred.h', 'include/fred.h',
+                         'lib/libfred.so.1', 'lib/libfred.so.1.0'):
+                assert os.path.isfile(os.path.join(obj_dir, name)), name
+            assert not os.path.exists(os.path.join(obj_dir, 'bin'))
+            assert os.readlink(os.path.join(obj_dir, 'lib/libjim.so')) == \
+                    os.path.join(obj_dir, 'lib/libjim.so.2')
+            assert os.readlink(os.path.join(obj_dir, 'lib/libfred.so')) == \
+                    os.path.join(obj_dir, 'lib/libfred.so.1')
+            assert os.readlink(os.path.join(obj_dir, 'obj/usr/lib/libfred.so')) == \
+                    os.path.join(obj_dir, 'obj/usr/lib/libfred.so.1')
+
+        # Extracting again is remembered, until the .deb or what we
+        # extracted changes
+        deb_path = os.path.join(tmpd, 'fred-gz.deb')
+        inst_dir = os.path.join(tmpd, 'cached')
+        record_dir = os.path.join(tmpd, 'record')
+        def extracted():
+            out = StringIO()
+            sys.stdout = out
+            try:
+                deb.extract_deb(deb_path, [('', inst_dir)], record_dir)
+            finally:
+                sys.stdout = sys.__stdout__
+            return 'already' not in out.getvalue()
+        assert extracted()
+        assert not extracted()
+        os.utime(deb_path, None)        # the same content, so still the same
+        assert not extracted()
+        os.remove(os.path.join(inst_dir, 'usr/bin/fred'))
+        assert extracted()
+        make_deb(deb_path, '')
+        assert extracted()
+        assert not extracted()
+    finally:
+        shutil.rmtree(tmpd)
+
+DPKG_STATUS = """\
+Package: gperf
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Version: 3.0.4-1
+Description: Perfect hash function generator
+ gperf is a program that generates perfect hash functions.
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 2.19-0ubuntu6
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 2.19-0ubuntu6
+
+Package: bison
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 3.0.2-2
+"""
+
+def dpkg_status_unit_test():
+    """
+    Check the apt builders answer from a dpkg status file, read only once.
+    """
+    tmpd = tempfile.mkdtemp()
+    old_status_file = dpkg_status.STATUS_FILE
+    try:
+        status_file = os.path.join(tmpd, 'status')
+        with open(status_file, 'w') as fd:
+            fd.write(DPKG_STATUS)
+        dpkg_status.STATUS_FILE = status_file
+        dpkg_status.forget()
+
+        get = aptget.AptGetBuilder('host', 'tools', [], os_version='ubuntu 14')
+        assert get.already_installed('gperf')
+        assert get.already_installed('libc6')
+        assert get.already_installed('libc6:i386')
+        assert not get.already_installed('bison')
+        assert not get.already_installed('flex')
+
+        alt = aptalt.AptAltBuilder('host', 'tools', [], os_version='ubuntu 14')
+        assert alt.already_installed({'name':'gperf', 'min-version':'3.0.1'})
+        assert not alt.already_installed({'name':'gperf', 'exact-version':'3.0.3-1'})
+        assert not alt.already_installed({'name':'bison'})
+        assert alt.current_version({'name':'bison'}) is None
+        assert alt.current_version({'name':'gperf'})['issue'] == 1
+
+        # The file is only read once...
+        with open(status_file, 'w') as fd:
+            fd.write(DPKG_STATUS.replace('deinstall ok config-files',
+                                         'install ok installed'))
+        assert not get.already_installed('bison')
+        # ...until something (such as apt-get) has changed what is installed
+        dpkg_status.forget()
+        assert get.already_installed('bison')
+    finally:
+        dpkg_status.STATUS_FILE = old_status_file
+        dpkg_status.forget()
+        shutil.rmtree(tmpd)
+
 def env_store_unit_test():
     """
     Test some bits of the environment store mechanism.
@@ -143,6 +493,218 @@ def filespec_unit_test():
     assert "/a/b" in results
 
 
+def deploy_instructions_unit_test():
+    """
+    Check applying chmod and chown instructions to real files.
+    """
+    from muddled.deployments.collect import CollectApplyChmod, \
+            CollectApplyChown
+    import muddled.deployments.collect as collect
+    import muddled.deployments.apply_plan as apply_plan
+    from muddled.instr import ChangeModeInstruction, ChangeUserInstruction
+    tmpd = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(tmpd, 'bin', 'sub'))
+        for name in ('bin/prog1', 'bin/prog2', 'bin/sub/prog3', 'outside'):
+            with open(os.path.join(tmpd, name), 'w') as fd:
+                fd.write(name)
+            os.chmod(os.path.join(tmpd, name), 0644)
+        os.symlink('../outside', os.path.join(tmpd, 'bin', 'link'))
+
+        def mode_of(name):
+            return os.lstat(os.path.join(tmpd, name)).st_mode & 07777
+
+        spec = filespec.FileSpec('/bin', '.*', allUnder=True)
+        CollectApplyChmod().apply(None, ChangeModeInstruction(spec, '0750', 'chmod'),
+                                  'x86', tmpd)
+        assert mode_of('bin/prog1') == 0750
+        assert mode_of('bin/sub/prog3') == 0750
+        assert mode_of('bin/sub') == 0750
+        # We do not follow symbolic links
+        assert mode_of('outside') == 0644
+
+        # Symbolic modes are handed on to chmod
+        spec = filespec.FileSpec('/bin', 'prog.*')
+        CollectApplyChmod().apply(None, ChangeModeInstruction(spec, 'o+r', 'chmod'),
+                                  'x86', tmpd)
+        assert mode_of('bin/prog1') == 0754
+        assert mode_of('bin/prog2') == 0754
+        assert mode_of('bin/sub/prog3') == 0750
+
+        # We can always chown to ourselves - the link itself is changed
+        spec = filespec.FileSpec('/bin', 'link')
+        instr = ChangeUserInstruction(spec, str(os.getuid()), str(os.getgid()),
+                                      'chown')
+        CollectApplyChown().apply(None, instr, 'x86', tmpd)
+        # And preparing to chown removes the files concerned
+        CollectApplyChown().prepare(None, instr, 'x86', tmpd)
+        assert not os.path.lexists(os.path.join(tmpd, 'bin', 'link'))
+        assert os.path.exists(os.path.join(tmpd, 'outside'))
+
+        # Instructions can also be planned, and the plan applied by a helper
+        spec = filespec.FileSpec('/bin', 'prog.*')
+        plan = CollectApplyChmod().plan(None, ChangeModeInstruction(spec, '0700', 'chmod'),
+                                        'x86', tmpd)
+        plan += CollectApplyChmod().plan(None, ChangeModeInstruction(spec, 'g+r', 'chmod'),
+                                         'x86', tmpd)
+        plan += CollectApplyChown().plan(None, instr, 'x86', tmpd)
+        assert plan[0][:2] == ['chmod', 0700]
+        assert sorted(plan[0][2]) == [os.path.join(tmpd, 'bin', 'prog1'),
+                                      os.path.join(tmpd, 'bin', 'prog2')]
+        plan_file = os.path.join(tmpd, 'plan.json')
+        with open(plan_file, 'w') as fd:
+            apply_plan.write_plan(plan, fd)
+        subprocess.check_call([sys.executable,
+                               os.path.splitext(apply_plan.__file__)[0] + '.py',
+                               plan_file])
+        assert mode_of('bin/prog1') == 0740
+        assert mode_of('bin/prog2') == 0740
+        assert mode_of('bin/sub/prog3') == 0750
+
+        # An instruction that cannot plan itself is applied in its turn,
+        # between the planned operations before and after it
+        seen = []
+        class Unplanned(collect.InstructionImplementor):
+            def apply(self, builder, instr, role, path):
+                seen.append(mode_of('bin/prog1'))
+                os.chmod(os.path.join(path, 'bin', 'prog1'), 0644)
+        spec = filespec.FileSpec('/bin', 'prog1')
+        plan = CollectApplyChmod().plan(None, ChangeModeInstruction(spec, '0700', 'chmod'),
+                                        'x86', tmpd)
+        plan += Unplanned().plan(None, None, 'x86', tmpd)
+        plan += CollectApplyChmod().plan(None, ChangeModeInstruction(spec, 'g+w', 'chmod'),
+                                         'x86', tmpd)
+        assert seen == []
+        real_apply = collect._apply_operations
+        if os.geteuid() != 0:
+            # Rather than using sudo
+            collect._apply_operations = lambda ops: apply_plan.apply_plan(ops)
+        try:
+            collect.apply_with_privilege(plan)
+        finally:
+            collect._apply_operations = real_apply
+        assert seen == [0700]
+        assert mode_of('bin/prog1') == 0664
+    finally:
+        shutil.rmtree(tmpd)
+
+def default_variables_unit_test():
+    """
+    Check the include and library directories a package is told about.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmpd, '.muddle'))
+        with open(os.path.join(tmpd, '.muddle', 'Description'), 'w') as fd:
+            fd.write('builds/01.py\n')
+        builder = mechanics.Builder(tmpd, 'muddle')
+
+        def add_package(name, needs=None):
+            last = Label.from_string('checkout:%s/checked_out'%name)
+            builder.ruleset.add(depend.Rule(last, None))
+            for tag in ('preconfig', 'configured', 'built', 'installed',
+                        'postinstalled'):
+                rule = depend.Rule(Label.from_string('package:%s{x86}/%s'%(name, tag)),
+                                   None)
+                rule.add(last)
+                if needs and tag == 'preconfig':
+                    rule.add(needs)
+                builder.ruleset.add(rule)
+                last = rule.target
+            return last
+
+        lib = add_package('lib')
+        add_package('app', lib)
+        app = Label.from_string('package:app{x86}/built')
+        lib_obj = builder.package_obj_path(lib)
+
+        def env_for(label):
+            store = env_store.Store()
+            builder.set_default_variables(label, store)
+            env = {}
+            store.apply(env)
+            return env
+
+        assert builder.get_dependent_package_dirs(app) == set([lib_obj])
+        assert env_for(app)['MUDDLE_INCLUDE_DIRS'] == ''
+
+        # What we found is remembered until 'lib' is installed again
+        os.makedirs(os.path.join(lib_obj, 'include'))
+        os.makedirs(os.path.join(lib_obj, 'lib', 'pkgconfig'))
+        assert env_for(app)['MUDDLE_INCLUDE_DIRS'] == ''
+        builder._set_tag(lib)
+        env = env_for(app)
+        assert env['MUDDLE_INCLUDE_DIRS'] == os.path.join(lib_obj, 'include')
+        assert env['MUDDLE_LIB_DIRS'] == os.path.join(lib_obj, 'lib')
+        assert env['MUDDLE_PKGCONFIG_DIRS'] == os.path.join(lib_obj, 'lib', 'pkgconfig')
+
+        # And the dependencies are remembered until the rules change
+        other = add_package('other')
+        builder.ruleset.rule_for_target(app).add(other)
+        assert builder.get_dependent_package_dirs(app) == \
+                set([lib_obj, builder.package_obj_path(other)])
+    finally:
+        shutil.rmtree(tmpd)
+
+def environments_for_unit_test():
+    """
+    Check which environments apply to a label, and in what order.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmpd, '.muddle'))
+        with open(os.path.join(tmpd, '.muddle', 'Description'), 'w') as fd:
+            fd.write('builds/01.py\n')
+        builder = mechanics.Builder(tmpd, 'muddle')
+
+        def set_env(text, value):
+            env = builder.get_environment_for(Label.from_string(text))
+            env.set('WHICH', value)
+
+        def envs_for(text):
+            return [(lvl, str(label)) for (lvl, label, env) in
+                    builder.list_environments_for(Label.from_string(text))]
+
+        def which(text):
+            env = {}
+            builder.setup_environment(Label.from_string(text), env)
+            return env.get('WHICH')
+
+        set_env('package:*{*}/*', 'everything')
+        set_env('package:fred{x86}/*', 'fred')
+        set_env('package:jim{x86}/*', 'jim')
+        # The most specific environment comes last, and so wins
+        assert envs_for('package:fred{x86}/built') == [
+                (-3, 'package:*{*}/*'), (-1, 'package:fred{x86}/*')]
+        assert which('package:fred{x86}/built') == 'fred'
+        assert envs_for('package:fred{arm}/built') == [(-3, 'package:*{*}/*')]
+
+        # Adding an environment, or changing one, is noticed
+        set_env('package:*{x86}/*', 'x86')
+        assert envs_for('package:fred{x86}/built') == [
+                (-3, 'package:*{*}/*'), (-2, 'package:*{x86}/*'),
+                (-1, 'package:fred{x86}/*')]
+        set_env('package:*{*}/*', 'all')
+        assert which('package:bob{arm}/built') == 'all'
+
+        # As is changing self.env directly, if we're told about it
+        del builder.env[Label.from_string('package:*{*}/*')]
+        builder.environments_changed()
+        assert which('package:bob{arm}/built') is None
+        assert which('package:bob{x86}/built') == 'x86'
+
+        # The environment for building a label is made without changing
+        # os.environ, and is what commands are run with
+        env = builder.build_env_for(Label.from_string('package:bob{x86}/built'))
+        assert env['WHICH'] == 'x86'
+        assert env['MUDDLE_LABEL'] == 'package:bob{x86}/built'
+        assert 'MUDDLE_LABEL' not in os.environ
+        with utils.using_env(env):
+            assert utils.get_cmd_data(['sh', '-c', 'echo $MUDDLE_NAME']) == 'bob\n'
+        assert envs_for('checkout:fred/checked_out') == []
+    finally:
+        shutil.rmtree(tmpd)
+
 def depend_unit_test():
     """
     Some fairly simple tests for the dependency solver.
@@ -206,6 +768,22 @@ def depend_unit_test():
 
     la4 = l1.copy_with_tag('*')
 
+    # Copies are interned, but only share an instance if they are equal,
+    # including their domain and flags
+    assert l1.copy_with_tag('*') is la4
+    assert l1.copy_with_tag('*', transient=True) is not la4
+    assert la4.copy_with_domain('sub') is not la4
+    assert la4.copy_with_domain('sub') is la4.copy_with_domain('sub')
+    assert la4.copy_with_domain('sub') != la4
+    assert l1.copy_with_role('role_2') == Label(l1.type, l1.name, 'role_2', l1.tag)
+    assert hash(l1.copy_with_role('role_2')) == hash(Label(l1.type, l1.name, 'role_2', l1.tag))
+    try:
+        l1.colour = 'red'
+    except AttributeError:
+        pass
+    else:
+        assert False, 'Labels should not have a __dict__'
+
     assert l1.match(l1) == 0
     assert l2.match(l1) is None
     assert la1.match(l1) == -1
@@ -243,6 +821,223 @@ package:pkg_1{role_1}/preconfig <-NoAction-- [ checkout:co_1{role_1}/pulled ]
     r2_required_by = depend.required_by(rs, l2)
     assert depend.rule_list_to_string(r2_required_by) == "[ checkout:co_1{role_1}/pulled, deployment:dep_1{role_2}/built, package:pkg_1{role_1}/preconfig,  ]"
 
+    # The reverse dependency index must notice dependencies added to a rule
+    # after it was put into the ruleset, and rules created on demand
+    l5 = Label(utils.LabelType.Package, "pkg_2", "role_1", utils.LabelTag.Built)
+    r5 = rs.rule_for_target(l5, createIfNotPresent=True)
+    assert rs.rules_which_depend_on(l4, useTags=True, useMatch=False) == set()
+    r5.add(l4)
+    assert rs.rules_which_depend_on(l4, useTags=True, useMatch=False) == set([r5])
+    assert rs.rules_which_depend_on(l4.copy_with_tag('*'), useMatch=True) == set([r5])
+    assert rs.rules_which_depend_on(l4.copy_with_tag('*'), useTags=False,
+                                    useMatch=False) == set([r5])
+
+    # Wildcarded dependencies should be found by matching
+    l6 = Label(utils.LabelType.Deployment, "dep_2", None, utils.LabelTag.Built)
+    r6 = depend.Rule(l6, pkg.NoAction())
+    r6.add(Label(utils.LabelType.Checkout, "*", "role_1", utils.LabelTag.Pulled))
+    rs.add(r6)
+    assert rs.rules_which_depend_on(l2, useMatch=True) == set([r3, r4, r6])
+    assert rs.rules_which_depend_on(la2, useMatch=True) == set([r2])
+    assert rs.rules_which_depend_on(l2, useTags=True, useMatch=False) == set([r3, r4])
+
+    # A pickled ruleset must come back with working indices
+    rs2 = pickle.loads(pickle.dumps(rs, 2))
+    assert str(rs2) == str(rs)
+    assert len(rs2.rules_which_depend_on(l2, useTags=True, useMatch=False)) == 2
+    r = rs2.rule_for_target(l5)
+    r.add(l1)
+    assert rs2.rules_which_depend_on(l1, useTags=True, useMatch=False) == set([rs2.rule_for_target(l2), r])
+
+def ruleset_index_unit_test():
+    """
+    Check the target index in a RuleSet agrees with matching every target.
+    """
+    rs = depend.RuleSet()
+    for text in ('checkout:co1/checked_out', 'checkout:(sub)co1/checked_out',
+                 'package:pkg1{x86}/built', 'package:pkg1{arm}/built',
+                 'package:pkg2{x86}/built', 'package:(sub)pkg1{x86}/built',
+                 'package:*{x86}/installed', 'deployment:dep/*'):
+        rs.add(depend.Rule(Label.from_string(text), pkg.NoAction()))
+
+    queries = ['*:*/*', 'package:pkg1{x86}/built', 'package:pkg1{*}/*',
+               'package:(sub)pkg1{x86}/*', 'package:(*)pkg1{x86}/built',
+               'package:other{x86}/installed', '*:co1/*', 'deployment:dep/deployed',
+               'package:pkg3{arm}/built']
+    for text in queries:
+        label = Label.from_string(text)
+        expected = set(k for k in rs.map if label.just_match(k))
+        assert rs.targets_match(label) == expected, text
+        assert rs.rules_for_target(label) == set(rs.map[k] for k in expected), text
+        expected = set(rs.map[k] for k in rs.map if k.match_without_tag(label))
+        assert rs.rules_for_target(label, useMatch=False, useTags=False) == expected, text
+
+    # Unifying must keep the index up to date
+    rs.unify(Label.from_string('package:pkg1{x86}/*'),
+             Label.from_string('package:(sub)pkg1{x86}/*'))
+    assert Label.from_string('package:pkg1{x86}/built') not in rs.map
+    assert rs.targets_match(Label.from_string('package:pkg1{x86}/*')) == set(
+            [Label.from_string('package:*{x86}/installed')])
+    assert rs.targets_match(Label.from_string('package:(*)*{x86}/built')) == set(
+            [Label.from_string('package:pkg2{x86}/built'),
+             Label.from_string('package:(sub)pkg1{x86}/built')])
+
+    # As must changing domains, once the index is rebuilt
+    for label in rs.map.keys():
+        label._mark_unswept()
+        label._change_domain('outer')
+    rs._rebuild_index()
+    assert rs.targets_match(Label.from_string('checkout:(outer)co1/*')) == set(
+            [Label.from_string('checkout:(outer)co1/checked_out')])
+    assert rs.targets_match(Label.from_string('checkout:co1/*')) == set()
+
+def tag_store_unit_test():
+    """
+    Test the two ways of storing tags, and converting between them.
+    """
+    tmpd = os.tempnam()
+    os.mkdir(tmpd)
+    try:
+        database = db.Database(tmpd)
+        l1 = Label.from_string('checkout:co_1/checked_out')
+        l2 = Label.from_string('package:pkg_1{x86}/built')
+        l3 = Label.from_string('package:(sub1)pkg_2{x86}/built')
+
+        database.set_tag(l1)
+        database.set_tag(l2)
+        database.set_tag(l3)
+        assert os.path.exists(os.path.join(tmpd, '.muddle', 'tags', 'package',
+                                           'pkg_1', 'x86-built'))
+        assert os.path.exists(os.path.join(tmpd, 'domains', 'sub1', '.muddle',
+                                           'tags', 'package', 'pkg_2', 'x86-built'))
+
+        assert db.convert_tag_store(tmpd, True) == 2
+        assert db.convert_tag_store(tmpd, True) is None
+        assert not os.path.exists(os.path.join(tmpd, '.muddle', 'tags'))
+        assert database.is_tag(l1) and database.is_tag(l2) and database.is_tag(l3)
+
+        database.clear_tag(l1)
+        database.set_tag(l2.copy_with_tag('installed'))
+        assert not database.is_tag(l1)
+
+        # Changes are not written until we flush them, and then a new tag
+        # log (as another process would have) sees them
+        other = db.TagLog(tmpd)
+        assert other.is_set(database.tag_key(l1))
+        database.flush_tags()
+        other.refresh()
+        assert not other.is_set(database.tag_key(l1))
+        assert other.is_set(database.tag_key(l2.copy_with_tag('installed')))
+
+        db.clear_tags_of_types(tmpd, ('package',))
+        assert not database.is_tag(l2)
+        assert database.is_tag(l3)      # it's in a different domain
+
+        database.set_tag(l1)
+        assert db.convert_tag_store(tmpd, False) == 1
+        assert not os.path.exists(os.path.join(tmpd, '.muddle', 'TagLog'))
+        assert os.path.exists(os.path.join(tmpd, '.muddle', 'tags', 'checkout',
+                                           'co_1', 'checked_out'))
+        assert database.is_tag(l1)
+
+        # Several processes appending to the same tag log at once
+        assert db.convert_tag_store(tmpd, True) == 1
+        children = []
+        for child in range(4):
+            pid = os.fork()
+            if pid == 0:
+                log = db.TagLog(tmpd)
+                for batch in range(20):
+                    for n in range(50):
+                        log.set('child%d/tag%d-%d'%(child, batch, n))
+                    log.flush()
+                os._exit(0)
+            children.append(pid)
+        for pid in children:
+            assert os.waitpid(pid, 0)[1] == 0
+        tags = db.TagLog(tmpd).items()
+        assert len([key for key in tags if key.startswith('child')]) == 4*20*50
+    finally:
+        utils.recursively_remove(tmpd)
+
+def _child_function(item):
+    print 'Processing %s'%item
+    if item == 'fails':
+        # ShellError can be pickled, but not unpickled
+        utils.run0('false', show_command=False)
+    elif item == 'odd':
+        return utils.ShellError('odd', 2)
+    return item.upper()
+
+def run_in_children_unit_test():
+    """
+    Check that whatever a child raises or returns, we get the other results.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmpd, '.muddle'))
+        with open(os.path.join(tmpd, '.muddle', 'Description'), 'w') as fd:
+            fd.write('builds/01.py\n')
+        builder = mechanics.Builder(tmpd, 'muddle')
+        results = {}
+        for item, output, value, exception in builder.run_in_children(
+                ['one', 'fails', 'odd', 'two'], _child_function, 2):
+            assert output == 'Processing %s\n'%item
+            results[item] = (value, exception)
+
+        assert results['one'] == ('ONE', None)
+        assert results['two'] == ('TWO', None)
+        value, exception = results['fails']
+        assert value is None
+        assert type(exception) == utils.GiveUp
+        assert str(exception) == "Command 'false' failed with retcode 1"
+        value, exception = results['odd']
+        assert value is None
+        assert isinstance(exception, utils.MuddleBug)
+        assert 'Cannot read the result' in str(exception)
+    finally:
+        shutil.rmtree(tmpd)
+
+class _SlowAction(pkg.Action):
+    def build_label(self, builder, label):
+        time.sleep(1)
+
+class _FailingAction(pkg.Action):
+    def build_label(self, builder, label):
+        raise utils.GiveUp('Deliberate failure')
+
+def parallel_build_failure_unit_test():
+    """
+    Check that a rule failing in the parent still lets us finish the children.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmpd, '.muddle'))
+        with open(os.path.join(tmpd, '.muddle', 'Description'), 'w') as fd:
+            fd.write('builds/01.py\n')
+        builder = mechanics.Builder(tmpd, 'muddle')
+        slow = Label(utils.LabelType.Package, 'slow', role='x', tag='built')
+        # Transient, so obeyed in the parent whilst 'slow' is being built
+        failing = Label(utils.LabelType.Package, 'failing', role='x',
+                        tag='built', transient=True)
+        builder.ruleset.add(depend.Rule(slow, _SlowAction()))
+        builder.ruleset.add(depend.Rule(failing, _FailingAction()))
+        try:
+            builder.build_labels_in_parallel([slow, failing], 2)
+        except utils.GiveUp as e:
+            assert str(e) == 'Failed to build package:failing{x}/built[T]'
+        else:
+            assert False, 'Expected the build to fail'
+        # The child building 'slow' was waited for, and its success recorded
+        assert builder.db.is_tag(slow)
+        try:
+            os.waitpid(-1, os.WNOHANG)
+            assert False, 'A child process was not waited for'
+        except OSError as e:
+            assert e.errno == errno.ECHILD
+    finally:
+        shutil.rmtree(tmpd)
+
 def utils_unit_test():
     """
     Unit testing on various utility code.
@@ -277,6 +1072,47 @@ def utils_unit_test():
     s = utils.replace_root_name("/a", "/b", "/d/e")
     assert s == "/d/e"
 
+def command_log_unit_test():
+    """
+    Check logging commands and their output, and keeping only its end.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        database = db.Database(tmpd)
+        label = Label.from_string('package:(sub)fred{x86}/built')
+        log_file = database.log_file_name(label)
+        assert log_file == os.path.join(tmpd, '.muddle', 'logs', 'domains',
+                                        'sub', 'package', 'fred',
+                                        'x86-built.log')
+
+        with utils.logging_output(log_file, quiet=True):
+            utils.run0(['sh', '-c', 'echo out; echo err >&2'])
+            rc, out, err = utils.run3(['sh', '-c', 'echo three >&2'])
+            assert (rc, out, err) == (0, '', 'three\n')
+        with open(log_file) as fd:
+            assert fd.read() == ("> sh -c 'echo out; echo err >&2'\nout\nerr\n"
+                                 "> sh -c 'echo three >&2'\nthree\n")
+
+        # A failing command reports the end of its output, all of which
+        # is in the log
+        cmd = ['sh', '-c', 'seq 100000; exit 3']
+        try:
+            with utils.logging_output(log_file, quiet=True):
+                utils.run0(cmd)
+            assert False, 'run0 did not fail'
+        except utils.ShellError as e:
+            assert e.retcode == 3
+            assert len(e.output) < 2*utils.OUTPUT_TAIL_SIZE
+            assert e.output.startswith('...(all of the output is in %s)'%log_file)
+            assert e.output.endswith('\n99999\n100000')
+        with open(log_file) as fd:
+            assert len(fd.read().splitlines()) == 100001
+
+        # But run1 (and friends) still keep all of it
+        assert len(utils.run1(cmd[:2] + ['seq 100000'],
+                              show_command=False).splitlines()) == 100000
+    finally:
+        shutil.rmtree(tmpd)
 
 def vcs_unit_test():
     """
@@ -448,18 +1284,42 @@ def label_domain_sort():
 def run_tests():
     print "> cpio"
     cpio_unit_test()
+    print "> cpio hard links"
+    cpio_hard_link_unit_test()
+    cpio_hard_link_modes_unit_test()
+    print "> cpio hierarchies"
+    cpio_hierarchy_unit_test()
     print "> Utils"
     utils_unit_test()
+    print "> Command logs"
+    command_log_unit_test()
+    print "> dpkg status"
+    dpkg_status_unit_test()
+    print "> deb"
+    deb_unit_test()
     print "> env"
     env_store_unit_test()
     print "> subst"
     subst_unit_test()
     print "> filespec"
     filespec_unit_test()
+    print "> Deployment instructions"
+    deploy_instructions_unit_test()
     print "> VCS"
     vcs_unit_test()
+    print "> Environments for labels"
+    environments_for_unit_test()
     print "> Depends"
     depend_unit_test()
+    print "> Rule set index"
+    ruleset_index_unit_test()
+    print "> Default variables"
+    default_variables_unit_test()
+    print "> Tag stores"
+    tag_store_unit_test()
+    print "> Running in child processes"
+    run_in_children_unit_test()
+    parallel_build_failure_unit_test()
     print "> Label domain sort"
     label_domain_sort()
 
@@ -237,6 +237,28 @@ def test_git_checkout_build():
         # We should be able to use muddle to push the stamp file
         muddle(['stamp', 'push'])
 
+        banner('Stamping checkout build in parallel, and quickly')
+        # Put one checkout on a branch, with packed refs, so that reading
+        # its revision straight from .git has some work to do
+        with Directory('src/twolevel/checkout2'):
+            git('checkout -b test-branch')
+            git('pack-refs --all')
+        wanted = None
+        for switches in ([], ['-j', '3'], ['-quick'], ['-quick', '-jobs', '3']):
+            muddle(['stamp', 'save'] + switches + ['parallel.stamp'])
+            with open('parallel.stamp') as fd:
+                lines = [line for line in fd if not line.startswith('#')]
+            os.remove('parallel.stamp')
+            if wanted is None:
+                wanted = lines
+                if 'repo_branch = test-branch\n' not in lines:
+                    raise GiveUp('Stamp file does not record test-branch')
+            elif lines != wanted:
+                raise GiveUp('"muddle stamp save %s" gave a different'
+                             ' stamp file'%' '.join(switches))
+        with Directory('src/twolevel/checkout2'):
+            git('checkout master')
+
     # We should be able to check everything out from the repository
     with NewDirectory('test_build2'):
         banner('Building checkout build from init')
@@ -356,6 +378,15 @@ def test_just_pulled():
         muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
         muddle(['checkout', '_all'])
 
+    banner('Build C')
+    with NewDirectory('build_C'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '-j', '3', '_all'])
+        check_specific_files_in_this_dir(['.muddle', 'src'])
+        with Directory('src'):
+            check_specific_files_in_this_dir(['builds', 'checkout1',
+                                              'twolevel', 'multilevel'])
+
     banner('Change Build A')
     with Directory('build_A'):
         with Directory('src'):
@@ -387,6 +418,120 @@ def test_just_pulled():
         if not same_content(_just_pulled_file, ''):
             raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
 
+    banner('Pull into Build C, in parallel')
+    with Directory('build_C') as d:
+        _just_pulled_file = os.path.join(d.where, '.muddle', '_just_pulled')
+        muddle(['pull', '-j', '3', '_all'])
+        if not same_content(_just_pulled_file,
+                            'checkout:builds/checked_out\n'
+                            'checkout:checkout2/checked_out\n'):
+            raise GiveUp('%s does not contain expected labels:\n%s'%(
+                _just_pulled_file,open(_just_pulled_file).readlines()))
+        muddle(['pull', '-jobs', '3', '_all'])
+        if not same_content(_just_pulled_file, ''):
+            raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
+
+    banner('Status of Build C')
+    with Directory('build_C'):
+        for switches in ([], ['-quick'], ['-jobs', '3'], ['-quick', '-jobs', '3']):
+            text = captured_muddle(['status'] + switches + ['_all'])
+            if 'All checkouts seemed clean' not in text:
+                raise GiveUp('Expected build C to be clean, got:\n%s'%text)
+        with Directory('src/checkout1'):
+            append('Makefile.muddle', '# Just a comment\n')
+            touch('new_file.c', '/* Nothing */\n')
+        for switches in ([], ['-quick', '-jobs', '3']):
+            rc, text = captured_muddle2(['status'] + switches + ['_all'])
+            if rc == 0 or ' M Makefile.muddle' not in text or \
+               '?? new_file.c' not in text:
+                raise GiveUp('Expected checkout1 to have changes, got:\n%s'%text)
+        with Directory('src/checkout1'):
+            os.remove('new_file.c')
+            git('commit -a -m "A local change"')
+        rc, text = captured_muddle2(['status', '-quick', '-jobs', '3', '_all'])
+        if rc == 0 or '1 commit ahead of, and 0 behind' not in text:
+            raise GiveUp('Expected checkout1 to be ahead, got:\n%s'%text)
+        rc, text = captured_muddle2(['status', '_all'])
+        if rc == 0 or 'The local repository does not match the remote' not in text:
+            raise GiveUp('Expected checkout1 not to match remote, got:\n%s'%text)
+
+        # A local branch that has never been pushed has nothing to compare
+        # with, which should not stop us reporting on the other checkouts
+        with Directory('src/twolevel/checkout2'):
+            git('checkout -b never-pushed')
+        for switches in (['-quick'], ['-quick', '-jobs', '3']):
+            rc, text = captured_muddle2(['status'] + switches + ['_all'])
+            if rc == 0 or 'There is no origin/never-pushed to compare with' not in text \
+               or '1 commit ahead of, and 0 behind' not in text:
+                raise GiveUp('Expected checkout2 to have no origin branch, and'
+                             ' checkout1 to be ahead, got:\n%s'%text)
+        with Directory('src/twolevel/checkout2'):
+            git('checkout master')
+            git('branch -d never-pushed')
+
+FAILING_CHECKOUT_BUILD = """\
+# A build with a checkout whose revision cannot be worked out
+
+import muddled.checkouts.simple
+
+def describe_to(builder):
+    builder.build_name = 'failing_test'
+    muddled.checkouts.simple.relative(builder, co_name='checkout1')
+    muddled.checkouts.simple.relative(builder, co_name='checkout2')
+    # A Subversion checkout, for which our own "svnversion" will fail
+    muddled.checkouts.simple.absolute(builder, 'svn_checkout',
+                                      'svn+file:///nowhere/svn_checkout')
+"""
+
+def test_stamp_with_failing_checkout(root_dir):
+    """A checkout that fails should be reported the same with or without -j
+    """
+    muddle(['bootstrap', 'git+file://%s/repo'%root_dir, 'failing_test'])
+    with Directory('src'):
+        with Directory('builds'):
+            touch('01.py', FAILING_CHECKOUT_BUILD)
+            os.remove('01.pyc')
+            git('add 01.py')
+            git('commit -m "New build"')
+        for name in ('checkout1', 'checkout2'):
+            with NewDirectory(name):
+                touch('Makefile.muddle', MUDDLE_MAKEFILE)
+                git('init')
+                git('add Makefile.muddle')
+                git('commit -m "First version"')
+        os.mkdir('svn_checkout')
+
+    # Make sure that "svnversion" fails, whether Subversion is installed
+    # or not - ShellError is the interesting case, as it does not survive
+    # the trip back from a child process as it is
+    with NewDirectory('bin') as d:
+        touch('svnversion', '#!/bin/sh\necho "svnversion: no" >&2\nexit 1\n')
+        os.chmod('svnversion', 0755)
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = '%s:%s'%(d.where, old_path)
+    try:
+        results = []
+        for switches in ([], ['-j', '3']):
+            rc, text = captured_muddle2(['stamp', 'save'] + switches + ['failing.stamp'])
+            lines = [line for line in text.splitlines()
+                     if line != 'Using up to 3 jobs']
+            with open('failing.partial') as fd:
+                stamp = [line for line in fd if not line.startswith('#')]
+            os.remove('failing.partial')
+            results.append((rc, lines, stamp))
+    finally:
+        os.environ['PATH'] = old_path
+
+    rc, lines, stamp = results[0]
+    if "* Command 'svnversion' failed with retcode 1" not in lines or \
+       "problem1 = Command 'svnversion' failed with retcode 1\n" not in stamp:
+        raise GiveUp('Expected svn_checkout to be reported as a problem, got:\n%s'%(
+                     '\n'.join(lines)))
+    if results[1] != results[0]:
+        raise GiveUp('"muddle stamp save -j 3" did not report the same as'
+                     ' "muddle stamp save":\n%s\n---\n%s'%('\n'.join(lines),
+                                                         '\n'.join(results[1][1])))
+
 def main(args):
 
     keep = False
@@ -417,6 +562,10 @@ def main(args):
             banner('TEST _JUST_PULLED')
             test_just_pulled()
 
+        with NewDirectory('failing'):
+            banner('TEST STAMP WITH A FAILING CHECKOUT')
+            test_stamp_with_failing_checkout(root_d.where)
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     try:
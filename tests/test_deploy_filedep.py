@@ -245,6 +245,9 @@ def make_old_build_tree():
 
         muddle([])
 
+        # Loading the build description should have been cached
+        check_files(['.muddle/cache/builder'])
+
         shell('ls -lR deploy')
         dt = DirTree('deploy')
         dt.assert_same_as_list(['  everything/',
@@ -295,6 +298,63 @@ def make_old_build_tree():
                     if text != 'Program program2\n':
                         raise GiveUp('Wrong output from bin/program2: %s'%text)
 
+        # And building in parallel should give us the same result
+        muddle(['veryclean'])
+        muddle(['build', '-j', '4', '_all'])
+        check_files(['.muddle/tags/package/first_pkg/role1-postinstalled',
+                     '.muddle/tags/package/second_pkg/role2-postinstalled',
+                     'install/role1/bin/program1',
+                     'install/role2/bin/program2'])
+        muddle(['deploy', '_all'])
+
+        with Directory('deploy'):
+            with Directory('everything'):
+                with Directory('bin'):
+                    text = get_stdout('./program1')
+                    if text != 'Program program1\n':
+                        raise GiveUp('Expected the bin/program1 from role1, but it output %s'%text)
+
+        # Keeping the tags in a single file should make no difference
+        muddle(['tag-store', 'log'])
+        check_files(['.muddle/TagLog'])
+        if os.path.exists('.muddle/tags'):
+            raise GiveUp('.muddle/tags still exists after "muddle tag-store log"')
+        text = captured_muddle(['build', '_all'])
+        if '> Building' in text:
+            raise GiveUp('Expected nothing to build, but got:\n%s'%text)
+        muddle(['veryclean'])
+        muddle([])
+        if os.path.exists('.muddle/tags'):
+            raise GiveUp('.muddle/tags reappeared after building with a TagLog')
+
+        with Directory('deploy'):
+            with Directory('everything'):
+                with Directory('bin'):
+                    text = get_stdout('./program1')
+                    if text != 'Program program1\n':
+                        raise GiveUp('Expected the bin/program1 from role1, but it output %s'%text)
+
+        # We remember what we deployed, so that next time we need only
+        # copy what has changed
+        check_files(['.muddle/cache/deployments/everything'])
+        touch('install/role1/extra.txt', 'Something extra\n')
+        os.remove('install/role2/bin/program2')
+        text = captured_muddle(['redeploy', 'everything'])
+        if 'Deployed 1 changed item, removed 1' not in text:
+            raise GiveUp('Expected an incremental deployment, but got:\n%s'%text)
+        check_files(['deploy/everything/extra.txt',
+                     'deploy/everything/bin/program1'])
+        if os.path.exists('deploy/everything/bin/program2'):
+            raise GiveUp('bin/program2 was not removed from the deployment')
+
+        # But if it might not be what we deployed, we start again
+        muddle(['cleandeploy', 'everything'])
+        text = captured_muddle(['deploy', 'everything'])
+        if 'Deployment directory is missing' not in text:
+            raise GiveUp('Expected a full deployment, but got:\n%s'%text)
+        check_files(['deploy/everything/extra.txt',
+                     'deploy/everything/bin/program1'])
+
 def main(args):
 
     keep = False
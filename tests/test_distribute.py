@@ -474,6 +474,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             # Issue 250
@@ -492,6 +494,8 @@ def main(args):
                                                '.muddle/instructions',
                                                '.muddle/tags/package',
                                                '.muddle/tags/deployment',
+                                               '.muddle/cache',
+                                               '.muddle/logs',
                                               ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VCS')
@@ -508,6 +512,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VERSIONS')
@@ -523,6 +529,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VCS AND VERSIONS')
@@ -538,6 +546,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH "-no-muddle-makefile"')
@@ -555,6 +565,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE')
@@ -571,6 +583,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITHOUT MUDDLE MAKEFILE')
@@ -587,6 +601,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITH VERSIONS')
@@ -602,6 +618,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITH VERSIONS AND VCS')
@@ -618,6 +636,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                           ])
 
             banner('TESTING DISTRIBUTE "mixed"')
@@ -651,6 +671,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                            # but we're not transferring install/,
                                            # so we don't want [post]installed tags
                                            '.muddle/tags/package/second_pkg/*-*installed',
@@ -693,6 +715,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                            # but we're not transferring install/,
                                            # so we don't want [post]installed tags
                                            '.muddle/tags/package/second_pkg/*-*installed',
@@ -712,6 +736,8 @@ def main(args):
                                            'builds/01.pyc',
                                            'deploy',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                            'domains',   # we didn't ask for subdomains
                                            'versions',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -753,6 +779,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                            # -- etc
                                            '.muddle/instructions/first_pkg',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -796,6 +824,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/cache',
+                                           '.muddle/logs',
                                            # -- etc
                                            '.muddle/instructions/first_pkg',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+"""Test using a local mirror of git repositories.
+
+    $ ./test_git_mirror.py [-keep]
+
+With -keep, do not delete the 'transient' directory used for the tests.
+
+Git must be installed. Local bare repositories stand in for the remote
+repositories.
+"""
+
+import os
+import shutil
+import sys
+import traceback
+
+from support_for_tests import *
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.utils import GiveUp, normalise_dir
+from muddled.withdir import Directory, NewDirectory, TransientDirectory
+from muddled.vcs.git_mirror import mirror_path
+
+BUILD_DESC = """\
+# A build with a single checkout
+
+import muddled.checkouts.simple
+
+def describe_to(builder):
+    builder.build_name = 'mirror_test'
+    muddled.checkouts.simple.relative(builder, co_name='checkout1')
+"""
+
+def head_of(git_dir, ref='HEAD'):
+    return get_stdout('git --git-dir=%s rev-parse %s'%(git_dir, ref),
+                      verbose=False).strip()
+
+def setup_repositories(root_repo):
+    banner('Setting up repositories')
+    with NewDirectory('repo'):
+        for name in ('builds', 'versions', 'checkout1'):
+            with NewDirectory(name):
+                git('init --bare')
+
+    with NewDirectory('build1'):
+        muddle(['bootstrap', 'git+%s'%root_repo, 'test_build'])
+        with Directory('src'):
+            with Directory('builds'):
+                touch('01.py', BUILD_DESC)
+                os.remove('01.pyc')
+                git('add 01.py')
+                git('commit -m "New build"')
+                git('push %s/builds HEAD'%root_repo)
+            with NewDirectory('checkout1'):
+                touch('file1', 'Version 1\n')
+                git('init')
+                git('add file1')
+                git('commit -m "First version"')
+                muddle(['import'])
+                muddle(['push'])
+
+def test_checkout_and_pull(root_dir, root_repo, mirror_dir):
+    checkout1_mirror = mirror_path(mirror_dir, '%s/checkout1'%root_repo)
+
+    banner('Checking out using the mirror')
+    with NewDirectory('build2'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_files([checkout1_mirror,
+                     mirror_path(mirror_dir, '%s/builds'%root_repo)])
+        with Directory('src/checkout1'):
+            # The clone should not depend on the mirror
+            check_nosuch_files(['.git/objects/info/alternates'])
+            if head_of('.git') != head_of(checkout1_mirror):
+                raise GiveUp('Checkout and mirror disagree')
+            check_file_v_text('file1', 'Version 1\n')
+
+    banner('Pulling using the mirror')
+    with Directory('build1/src/checkout1'):
+        append('file1', 'Version 2\n')
+        git('commit -a -m "Second version"')
+        muddle(['push'])
+        new_head = head_of('.git')
+
+    with Directory('build2'):
+        muddle(['pull', '_all'])
+        if head_of(checkout1_mirror, 'refs/heads/master') != new_head:
+            raise GiveUp('Mirror was not updated by "muddle pull"')
+        with Directory('src/checkout1'):
+            if head_of('.git') != new_head:
+                raise GiveUp('Checkout was not updated by "muddle pull"')
+            if head_of('.git', 'remotes/origin/master') != new_head:
+                raise GiveUp('origin/master was not updated by "muddle pull"')
+            check_file_v_text('file1', 'Version 1\nVersion 2\n')
+
+        # Pulling again fetches nothing new, so should not try to merge
+        text = captured_muddle(['pull', '_all'])
+        if 'git merge' in text or 'were pulled' in text:
+            raise GiveUp('Unexpected merge when nothing was fetched:\n%s'%text)
+
+        text = captured_muddle(['git-mirror'])
+        check_text_endswith(text.splitlines()[0],
+                            '%s (from $MUDDLE_GIT_MIRROR)'%mirror_dir)
+        if '%s/checkout1'%root_repo not in text:
+            raise GiveUp('Mirror of checkout1 not reported:\n%s'%text)
+
+def test_repair_and_prune(root_dir, root_repo, mirror_dir):
+    checkout1_mirror = mirror_path(mirror_dir, '%s/checkout1'%root_repo)
+    builds_mirror = mirror_path(mirror_dir, '%s/builds'%root_repo)
+
+    banner('Repairing the mirror')
+    with Directory('build2'):
+        text = captured_muddle(['git-mirror', 'repair'])
+        check_text(text, 'Nothing needed repairing\n')
+
+        # A left over lock file, and a mirror with no objects
+        touch(os.path.join(builds_mirror, 'packed-refs.lock'), '')
+        shutil.rmtree(os.path.join(checkout1_mirror, 'objects'))
+        os.mkdir(os.path.join(checkout1_mirror, 'objects'))
+        text = captured_muddle(['git-mirror', 'repair'])
+        if 'removed packed-refs.lock' not in text or \
+           'made again from %s/checkout1'%root_repo not in text:
+            raise GiveUp('Unexpected repair:\n%s'%text)
+        check_nosuch_files([os.path.join(builds_mirror, 'packed-refs.lock')])
+        git('--git-dir=%s fsck --connectivity-only'%checkout1_mirror)
+
+    banner('Choosing a different mirror for one build tree')
+    with Directory('build2'):
+        other_dir = os.path.join(root_dir, 'other-mirror')
+        muddle(['git-mirror', 'set', other_dir])
+        text = captured_muddle(['git-mirror'])
+        check_text(text, 'Git mirror directory %s (from .muddle/GitMirror)\n'%other_dir)
+        muddle(['pull', '_all'])
+        check_files([mirror_path(other_dir, '%s/checkout1'%root_repo)])
+        muddle(['git-mirror', 'unset'])
+
+    banner('Pruning the mirror')
+    with Directory('build2'):
+        text = captured_muddle(['git-mirror', 'prune'])
+        check_text(text, 'Deleted 0 mirrors\n')
+        text = captured_muddle(['git-mirror', 'prune', '0'])
+        check_text(text, 'Deleting %s\nDeleting %s\nDeleted 2 mirrors\n'%(
+                   builds_mirror, checkout1_mirror))
+        check_nosuch_files([builds_mirror, checkout1_mirror])
+        # And checkouts still work without them
+        with Directory('src/checkout1'):
+            git('log -1')
+
+def main(args):
+
+    keep = False
+    if args:
+        if len(args) == 1 and args[0] == '-keep':
+            keep = True
+        else:
+            print __doc__
+            return
+
+    root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
+
+    with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep):
+        root_repo = 'file://' + os.path.join(root_dir, 'repo')
+        mirror_dir = os.path.join(root_dir, 'mirror')
+        setup_repositories(root_repo)
+
+        os.environ['MUDDLE_GIT_MIRROR'] = mirror_dir
+        try:
+            test_checkout_and_pull(root_dir, root_repo, mirror_dir)
+            test_repair_and_prune(root_dir, root_repo, mirror_dir)
+        finally:
+            del os.environ['MUDDLE_GIT_MIRROR']
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
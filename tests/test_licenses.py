@@ -700,6 +700,8 @@ def main_tests(root_dir, d):
                                    '.muddle/instructions',
                                    '.muddle/tags/package',
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                   ])
 
     banner('TESTING DISTRIBUTE BINARY RELEASE')
@@ -720,6 +722,8 @@ def main_tests(root_dir, d):
                                    '.muddle/instructions',
                                    # And all the package tags
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                   ])
 
     banner('TESTING DISTRIBUTE FOR GPL')
@@ -750,6 +754,8 @@ def main_tests(root_dir, d):
                                    '.muddle/instructions',
                                    '.muddle/tags/package',
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    '.muddle/tags/checkout/apache',
                                    '.muddle/tags/checkout/bsd',
                                    '.muddle/tags/checkout/mpl',
@@ -789,6 +795,8 @@ def main_tests(root_dir, d):
                                    '.muddle/instructions',
                                    '.muddle/tags/package',
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    '.muddle/tags/checkout/scripts',
                                    '.muddle/tags/checkout/binary*',
                                    '.muddle/tags/checkout/not_licensed[2345]',
@@ -839,6 +847,8 @@ def main_tests(root_dir, d):
                                    '.muddle/tags/package/scripts',
                                    # We don't do deployment...
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    # And, in our subdomain
                                    'domains/subdomain/src/manhattan',
                                    'domains/subdomain/install',
@@ -908,6 +918,8 @@ def main_tests(root_dir, d):
                                    '.muddle/tags/package/not_licensed*',
                                    '.muddle/tags/package/private*',
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    # And, in our subdomain
                                    'domains/subdomain/src/manhattan',
                                    'domains/subdomain/.muddle/tags/checkout/manhattan',
@@ -985,6 +997,8 @@ package:(subdomain)xyzlib{x86}/distributed DistributePackage: just_open_src_and_
                                    '.muddle/tags/package',
                                    # We don't do deployment...
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    # And, in our subdomain
                                    'domains/subdomain/src/xyzlib',
                                    'domains/subdomain/.muddle/tags/checkout/xyzlib',
@@ -1054,6 +1068,8 @@ package:(subdomain)xyzlib{x86}/distributed DistributePackage: just_open_src_and_
                                    '.muddle/tags/package/scripts',
                                    # We don't do deployment...
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    # And, in our subdomain
                                    'domains/subdomain/src/xyzlib',
                                    'domains/subdomain/.muddle/tags/checkout/xyzlib',
@@ -1121,6 +1137,8 @@ package:(subdomain)xyzlib{x86}/distributed DistributePackage: just_open_src_and_
                                    '.muddle/tags/package/scripts',
                                    # We don't do deployment...
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    # And, in our subdomain
                                    'domains',
                                   ])
@@ -1176,6 +1194,8 @@ def subsequent_tests(root_dir, d):
                                    '.muddle/instructions',
                                    '.muddle/tags/package',
                                    '.muddle/tags/deployment',
+                                   '.muddle/cache',
+                                   '.muddle/logs',
                                    '.muddle/tags/checkout/apache',
                                    '.muddle/tags/checkout/bsd',
                                    '.muddle/tags/checkout/mpl',
@@ -569,6 +569,12 @@ def main(args):
             muddle(['checkout', '_all'])
             pass2_default_dir = d3.where
 
+        with NewCountedDirectory('build.swap.parallel.pull') as d4:
+            banner('CHECK REPOSITORIES OUT', 2)
+            checkout_build_descriptions(root_dir, d4)
+            muddle(['checkout', '-j', '4', '_all'])
+            pass2_parallel_dir = d4.where
+
         with Directory(orig_dir) as d:
             banner('SWAP SUBDOMAIN BUILD DESCRIPTIONS AND PUSH', 2)
             swap_subdomains_and_push(root_dir, d)
@@ -626,6 +632,25 @@ def main(args):
                               'checkout:(sub2(sub3))co0/checked_out\n',
                               ])
 
+        with Directory(pass2_parallel_dir) as d:
+            banner('PULL WITH BUILD DESCRIPTIONS PULLED FIRST, IN PARALLEL', 2)
+            # The build descriptions are still pulled (one at a time) first,
+            # so we should end up in the same place as the serial pull
+            muddle(['pull', '-j', '4', '_all'])
+            check_amended_build_descs(d)
+            check_original_build_descs(d)
+            check_file_v_text(d.join('.muddle', '_just_pulled'),
+                              [
+                              'checkout:(sub1)builds/checked_out\n',
+                              'checkout:(sub1(sub4))builds/checked_out\n',
+                              'checkout:(sub1(sub4))co0/checked_out\n',
+                              'checkout:(sub1(sub5))builds/checked_out\n',
+                              'checkout:(sub1(sub5))co0/checked_out\n',
+                              'checkout:(sub2)builds/checked_out\n',
+                              'checkout:(sub2(sub3))builds/checked_out\n',
+                              'checkout:(sub2(sub3))co0/checked_out\n',
+                              ])
+
 
         banner('TEST NOT CHANGING THE BUILD DESCRIPTIONS')
         # This should work identically by both mechanisms
@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+"""Test the query server
+
+    $ ./test_query_server.py [-keep]
+
+With -keep, do not delete the 'transient' directory used for the tests.
+"""
+
+import os
+import sys
+import traceback
+
+from support_for_tests import *
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.utils import GiveUp, normalise_dir
+from muddled.withdir import Directory, NewDirectory, TransientDirectory
+
+BUILD_DESC = """\
+# A build description whose Makefiles ask muddle questions
+
+import muddled.pkgs.make as make
+
+def describe_to(builder):
+    make.medium(builder, 'first_pkg', ['x86'], 'first_co')
+    make.medium(builder, 'second_pkg', ['x86'], 'second_co',
+                deps=['first_pkg'])
+"""
+
+MUDDLE_MAKEFILE = """\
+# A muddle makefile that uses "muddle query"
+all:
+\techo '$(shell $(MUDDLE) query objdir package:first_pkg{x86})' > $(MUDDLE_OBJ)/first_objdir
+
+config:
+
+install:
+
+clean:
+
+distclean:
+
+.PHONY: all config install clean distclean
+"""
+
+def make_build_tree():
+    muddle(['bootstrap', 'git+file:///nowhere', 'test-build'])
+    with Directory('src'):
+        with Directory('builds'):
+            touch('01.py', BUILD_DESC)
+            os.remove('01.pyc')
+        for name in ('first_co', 'second_co'):
+            with NewDirectory(name):
+                git('init')
+                touch('Makefile.muddle', MUDDLE_MAKEFILE)
+                git('add Makefile.muddle')
+                git('commit -m "A commit"')
+                muddle(['import'])
+
+def server_status():
+    return captured_muddle(['query-server'])
+
+def answered():
+    """Return how many queries the server has answered.
+    """
+    status = server_status()
+    for line in status.splitlines():
+        line = line.strip()
+        if line.startswith('answered '):
+            return int(line.split()[1])
+    raise GiveUp('Query server is not running:\n%s'%status)
+
+QUERIES = (['query', 'objdir', 'package:first_pkg{x86}'],
+           ['query', 'dir', 'checkout:second_co'],
+           ['query', 'packages'],
+           ['query', 'needed-by', 'package:second_pkg{x86}/built'],
+           ['query', 'objdir', 'package:first_pkg'])    # which fails
+
+def test_query_server(root_dir):
+    # What muddle says without a server
+    expected = [captured_muddle2(q) for q in QUERIES]
+    if expected[-1][0] == 0:
+        raise GiveUp('Expected "muddle %s" to fail'%' '.join(QUERIES[-1]))
+
+    check_text(server_status(), 'There is no query server for %s\n'%root_dir)
+    muddle(['query-server', 'start'])
+    try:
+        banner('QUERIES ANSWERED BY THE SERVER')
+        for query, wanted in zip(QUERIES, expected):
+            got = captured_muddle2(query)
+            if got != wanted:
+                raise GiveUp('muddle %s gave %s from the server, but %s'
+                             ' without it'%(' '.join(query), got, wanted))
+        if answered() != len(QUERIES):
+            raise GiveUp('Expected the server to answer %d queries'%len(QUERIES))
+
+        # Queries from subdirectories (and subprocesses) find it too
+        before = answered()
+        with Directory('src'):
+            with Directory('first_co'):
+                text = captured_muddle(['query', 'objdir', 'package:first_pkg{x86}'])
+                check_text(text, expected[0][1])
+        if answered() != before + 1:
+            raise GiveUp('Query from a subdirectory was not answered by the server')
+
+        banner('MAKEFILE QUERIES ANSWERED BY THE SERVER')
+        before = answered()
+        muddle(['build', 'second_pkg{x86}'])
+        check_file_v_text('obj/second_pkg/x86/first_objdir', expected[0][1])
+        if answered() <= before:
+            raise GiveUp('The Makefile query was not answered by the server')
+
+        banner('CHANGING THE BUILD DESCRIPTION')
+        with Directory('src'):
+            with Directory('builds'):
+                append('01.py', "    make.medium(builder, 'third_pkg', ['x86'],"
+                                " 'second_co')\n")
+        text = captured_muddle(['query', 'packages'])
+        if 'third_pkg' not in text:
+            raise GiveUp('Query server did not notice the build description'
+                         ' change:\n%s'%text)
+        if 'loaded the build description 2 times' not in server_status():
+            raise GiveUp('Query server did not reload the build description')
+
+        # And we can still choose to do without it
+        before = answered()
+        os.environ['MUDDLE_NO_QUERY_SERVER'] = 'yes'
+        try:
+            captured_muddle(['query', 'packages'])
+        finally:
+            del os.environ['MUDDLE_NO_QUERY_SERVER']
+        if answered() != before:
+            raise GiveUp('MUDDLE_NO_QUERY_SERVER did not stop the server being used')
+    finally:
+        muddle(['query-server', 'stop'])
+
+    check_text(server_status(), 'There is no query server for %s\n'%root_dir)
+    check_nosuch_files(['.muddle/query.sock'])
+    text = captured_muddle(['query', 'packages'])
+    if 'third_pkg' not in text:
+        raise GiveUp('Query without a server gave:\n%s'%text)
+
+def main(args):
+
+    keep = False
+    if args:
+        if len(args) == 1 and args[0] == '-keep':
+            keep = True
+        else:
+            print __doc__
+            return
+
+    root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
+
+    with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep):
+        with NewDirectory('build') as d:
+            banner('MAKE BUILD TREE')
+            make_build_tree()
+            banner('TEST QUERY SERVER')
+            test_query_server(d.where)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -718,8 +718,6 @@ Pulling checkout:co_repo1/checked_out from file://{root_dir}/repo/main/repo1.1 (
 > git fetch rhubarb
 From file://{root_dir}/repo/main/repo1.1
  * [new branch]      master     -> rhubarb/master
-> git merge --ff-only remotes/rhubarb/master
-Already up-to-date.
 
 Pulling checkout:co_repo1/checked_out from file://{root_dir}/repo/main/repo1.2 (wombat)
 ++ pushd to {root_dir}/build/src/co_repo1
@@ -727,8 +725,6 @@ Pulling checkout:co_repo1/checked_out from file://{root_dir}/repo/main/repo1.2 (
 > git fetch wombat
 From file://{root_dir}/repo/main/repo1.2
  * [new branch]      master     -> wombat/master
-> git merge --ff-only remotes/wombat/master
-Already up-to-date.
 
 Pulling checkout:co_repo1/checked_out from file://{root_dir}/repo/main/repo1.3 (rhubarb)
 